@@ -3,4 +3,8 @@ from GimnTools.ImaGIMN.gimnRec.projectors import *
 from GimnTools.ImaGIMN.gimnRec.backprojectors import *
 from GimnTools.ImaGIMN.gimnRec.corrections import *
 from GimnTools.ImaGIMN.gimnRec.reconstruction_filters import *
+from GimnTools.ImaGIMN.gimnRec.reconstruction_plan import *
 
+from GimnTools.ImaGIMN.gimnRec.iteration_control import *
+from GimnTools.ImaGIMN.gimnRec.priors import *
+from GimnTools.ImaGIMN.gimnRec.subset_schedule import *
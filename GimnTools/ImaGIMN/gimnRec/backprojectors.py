@@ -1,6 +1,6 @@
 import numpy as np
 from scipy.ndimage import rotate as rt_scipy
-from numba import njit
+from numba import njit, prange, get_num_threads
 from GimnTools.ImaGIMN.processing.tools.math  import rotate
 
 
@@ -57,7 +57,7 @@ def backprojector(sinogram, angles, interpolator, center=None):
 #(parallel=True)
 #
 # Quando estamos trabalhando com parallel=True irá demorar muito mais
-@njit
+@njit(nogil=True)
 def inverse_radon(sinogram, angles):
     """
     @brief Reconstructs an image from its sinogram using the inverse backprojection method.
@@ -74,40 +74,234 @@ def inverse_radon(sinogram, angles):
     """
     nb_angles = sinogram.shape[1]  # Número de ângulos (largura do sinograma)
     size = sinogram.shape[0]       # Tamanho da imagem (altura e largura)
-    
+
     # Inicializa a matriz de saída
     reconstructed_image = np.zeros((size, size), dtype=np.float64)
+    backproject_views(reconstructed_image, sinogram, angles)
+
+    # Normaliza a soma sobre todos os ângulos
+    return reconstructed_image * (np.deg2rad(angles.max()) / nb_angles)
+
+
+@njit(nogil=True)
+def backproject_views(reconstructed_image, sinogram, angles):
+    """
+    @brief Accumulates the unnormalized backprojection of a block of views into an image.
+    This is the kernel of inverse_radon. The contributions of each view are added to
+    reconstructed_image in place, so a sinogram can be backprojected block by block and
+    normalized once at the end.
+    @param reconstructed_image (np.ndarray): Square image where the backprojection is accumulated.
+    @param sinogram (np.ndarray): 2D matrix (distances, views) with the views to backproject.
+    @param angles (np.ndarray): Angles (in degrees) of the views in sinogram.
+    """
+    nb_angles = sinogram.shape[1]
+    size = reconstructed_image.shape[0]
+    n_bins = sinogram.shape[0]
     center = (size - 1) / 2  # Centro da imagem
-    
+
+    cos_angles = np.cos(np.deg2rad(angles - 90))
+    sin_angles = np.sin(np.deg2rad(angles - 90))
+
     # Loop sobre cada pixel da imagem de saída
     for i in range(size):
         for j in range(size):
             sum_value = 0.0
             for k in range(nb_angles):
-                angle = np.deg2rad(angles[k]-90)
-                cos_angle = np.cos(angle)  # Coseno do ângulo k
-                sin_angle = np.sin(angle)  # Seno do ângulo k
-                
-                S = ((j-center)*cos_angle + (i-center)* sin_angle)+center
-
-                
-                # Pega a coluna k do sinograma
-                col_sin = sinogram[:,k ]
-                
+                S = ((j-center)*cos_angles[k] + (i-center)*sin_angles[k])+center
+
                 # Se V não for inteiro, faz interpolação
-                if S< 0 or S >= len(col_sin):
+                if S < 0 or S >= n_bins:
                     continue  # Ignora se V estiver fora dos limites
-                
+
                 if S - int(S) != 0:
-                    inter = get_interpolated_pixel_1d(col_sin, S)
-                    sum_value += inter
+                    sum_value += get_interpolated_pixel_1d(sinogram[:, k], S)
                 else:
-                    sum_value += col_sin[int(S)]
-            
-            # Normaliza a soma sobre todos os ângulos
-            reconstructed_image[i, j] = sum_value * (np.deg2rad(angles.max())/ nb_angles)
-    
-    return reconstructed_image
+                    sum_value += sinogram[int(S), k]
+            reconstructed_image[i, j] += sum_value
+
+
+class BackprojectionAccumulator:
+    """
+    @brief Incremental backprojector that consumes a sinogram one block of views at a time.
+
+    It is the counterpart of the streaming projectors (direct_radon_views, radon_m_views and
+    system_matrix_views): each block is added as soon as it is available and only the image
+    being accumulated is kept in memory.
+
+    The supported methods are:
+    - "line_integral": same model as inverse_radon, views with shape (distances, views)
+    - "rotation": same model as backprojector, views with shape (distances, views)
+    - "system_matrix": transposed system matrix, views with shape (views, nrd)
+    """
+
+    def __init__(self, size, angles, method="line_integral", interpolator=None, center=None, sys_mat=None):
+        """
+        @brief Creates an empty accumulator.
+
+        @param size Number of pixels of each side of the image
+        @param angles All the angles (in degrees) of the sinogram that will be accumulated
+        @param method Backprojection model, "line_integral", "rotation" or "system_matrix"
+        @param interpolator Interpolation function, required by the "rotation" method
+        @param center Center of rotation used by the "rotation" method
+        @param sys_mat System matrix, required by the "system_matrix" method
+        """
+        if method not in ("line_integral", "rotation", "system_matrix"):
+            raise ValueError(f"Unknown backprojection method: {method}")
+        if method == "rotation" and interpolator is None:
+            raise ValueError("The rotation backprojection needs an interpolator")
+        if method == "system_matrix" and sys_mat is None:
+            raise ValueError("The system matrix backprojection needs sys_mat")
+
+        self.size = size
+        self.angles = np.ascontiguousarray(angles, dtype=np.float64)
+        self.method = method
+        self.interpolator = interpolator
+        self.center = center
+        self.sys_mat = sys_mat
+        self.reset()
+
+    def reset(self):
+        """
+        @brief Clears the accumulated image.
+        """
+        self.image = np.zeros((self.size, self.size))
+        self.views = 0
+
+    def add(self, views, indices):
+        """
+        @brief Backprojects a block of views and adds it to the accumulated image.
+
+        @param views Block of views, laid out as the sinogram of the selected method
+        @param indices Indices (in the angles array) of the views of the block
+        """
+        indices = np.atleast_1d(indices)
+        if self.method == "line_integral":
+            backproject_views(self.image, np.ascontiguousarray(views, dtype=np.float64), self.angles[indices])
+        elif self.method == "rotation":
+            aux = np.zeros([self.size, self.size])
+            for i, angle in enumerate(self.angles[indices]):
+                aux[:, 0:self.size] = views[:, i]
+                self.image += rotate(aux, angle - 90, self.interpolator, center=self.center)
+        else:
+            nrd = self.sys_mat.shape[0] // self.angles.size
+            rows = np.concatenate([np.arange(a * nrd, (a + 1) * nrd) for a in indices])
+            self.image += (self.sys_mat[rows].T @ np.ravel(views)).reshape(self.size, self.size)
+        self.views += indices.size
+
+    @property
+    def result(self):
+        """
+        @brief Returns the backprojection of all the views added so far.
+
+        The normalization of each method is applied here, so the result of accumulating every
+        view of a sinogram matches the corresponding one-shot backprojector.
+
+        @return Backprojected image
+        """
+        if self.method == "line_integral":
+            return self.image * (np.deg2rad(self.angles.max()) / self.angles.size)
+        if self.method == "rotation":
+            return np.flip(self.image / self.size, axis=1)
+        return self.image.copy()
+
+
+@njit(nogil=True)
+def backproject_events(image, offsets, angles, weights):
+    """
+    @brief Accumulates the weights of the events along their lines of response into an image.
+    This is the exact adjoint of project_events: every weight is spread over the same bilinear
+    neighbours, with the same coefficients, that project_events reads, so the pair can be used
+    directly in the list-mode EM update.
+    @param image (np.ndarray): Square image where the backprojection is accumulated, in place.
+    @param offsets (np.ndarray): Radial position of each event, in pixels from the centre of the image.
+    @param angles (np.ndarray): Angle of each event, in degrees.
+    @param weights (np.ndarray): Value backprojected along each event.
+    """
+    size = image.shape[0]
+    center = (size - 1) / 2
+    radius = center * center
+    for e in range(offsets.size):
+        angle = np.deg2rad(angles[e] - 90)
+        cos = np.cos(angle)
+        sen = np.sin(angle)
+        mc = offsets[e]
+        weight = weights[e]
+        for n in range(size):
+            nc = n - center
+            if mc * mc + nc * nc >= radius:
+                continue
+            x = center + mc * cos - nc * sen
+            y = center + mc * sen + nc * cos
+            # Mesmos vizinhos e pesos da bilinear_interpolation
+            x0 = int(np.floor(x))
+            y0 = int(np.floor(y))
+            x1 = min(x0 + 1, size - 1)
+            y1 = min(y0 + 1, size - 1)
+            dx = x - x0
+            dy = y - y0
+            image[y0, x0] += weight * (1 - dx) * (1 - dy)
+            image[y0, x1] += weight * dx * (1 - dy)
+            image[y1, x0] += weight * (1 - dx) * dy
+            image[y1, x1] += weight * dx * dy
+
+
+@njit(parallel=True, nogil=True)
+def backproject_oblique_segment(volume, sinogram, angles, ring_difference, radius):
+    """
+    @brief Accumulates the backprojection of one oblique segment into a volume.
+    This is the exact adjoint of project_oblique_segment. The angles are split in one block per
+    thread and every block is accumulated in its own copy of the volume, so the threads never
+    write to the same voxel; the copies are added to volume at the end.
+    @param volume (np.ndarray): Volume (rings, pixels, pixels) where the backprojection is accumulated, in place.
+    @param sinogram (np.ndarray): Segment (rings - |d|, pixels, angles) to backproject.
+    @param angles (np.ndarray): Angles (in degrees) of the views in sinogram.
+    @param ring_difference (int): Ring difference d of the segment.
+    @param radius (float): Radius of the detector, in pixels.
+    """
+    rings, size = volume.shape[0], volume.shape[1]
+    center = (size - 1) / 2
+    limit = center * center
+    planes = sinogram.shape[0]
+    first = abs(ring_difference) / 2
+    blocks = min(get_num_threads(), angles.size)
+    partial = np.zeros((blocks, rings, size, size))
+    for b in prange(blocks):
+        image = partial[b]
+        for k in range(b, angles.size, blocks):
+            angle = np.deg2rad(angles[k] - 90)
+            cos = np.cos(angle)
+            sen = np.sin(angle)
+            for m in range(size):
+                mc = m - center
+                slope = ring_difference / (2 * np.sqrt(radius * radius - mc * mc))
+                for n in range(size):
+                    nc = n - center
+                    if mc * mc + nc * nc >= limit:
+                        continue
+                    x = center + mc * cos - nc * sen
+                    y = center + mc * sen + nc * cos
+                    x0 = int(np.floor(x))
+                    y0 = int(np.floor(y))
+                    x1 = min(x0 + 1, size - 1)
+                    y1 = min(y0 + 1, size - 1)
+                    dx = x - x0
+                    dy = y - y0
+                    for i in range(planes):
+                        value = sinogram[i, m, k]
+                        if value == 0:
+                            continue
+                        z = i + first + slope * nc
+                        z0 = int(np.floor(z))
+                        z1 = min(z0 + 1, rings - 1)
+                        dz = z - z0
+                        for zz, wz in ((z0, (1 - dz) * value), (z1, dz * value)):
+                            image[zz, y0, x0] += wz * (1 - dx) * (1 - dy)
+                            image[zz, y0, x1] += wz * dx * (1 - dy)
+                            image[zz, y1, x0] += wz * (1 - dx) * dy
+                            image[zz, y1, x1] += wz * dx * dy
+    for b in range(blocks):
+        volume += partial[b]
+
 
 @njit
 def get_interpolated_pixel_1d(vector, t):
@@ -1,3 +1,7 @@
+import hashlib
+import os
+import tempfile
+from pathlib import Path
 import numpy as np
 from scipy.fft import rfft
 from scipy.ndimage import gaussian_filter
@@ -23,3 +27,116 @@ def rot_center(theta):
     phase = np.arctan2(imag*np.sign(real), real*np.sign(real)) 
     COR = theta.shape[-1]/2-phase*theta.shape[-1]/(2*np.pi)
     return COR
+
+
+def correction_term(term, sinogram, slices=None, name="correction"):
+    """
+    @brief Term of the model of the iterative methods (additive=, weights=) laid out as the reconstructed sinograms.
+
+    @param term A number used by every bin, or an array laid out as the sinogram stack (or as one of
+                its slices); a stack of the whole sinogram is restricted to slices
+    @param sinogram Sinogram stack of the reconstructor, the first dimension is the slice
+    @param slices Indices of the reconstructed slices, None for all of them
+    @param name Name of the term in the error messages
+
+    @return Array laid out as the sinogram of the selected slices
+    """
+    selected = sinogram if slices is None else sinogram[np.atleast_1d(np.arange(sinogram.shape[0])[slices])]
+    term = np.asarray(term, dtype=np.float64)
+    if slices is not None and term.shape == sinogram.shape:
+        term = term[np.atleast_1d(np.arange(sinogram.shape[0])[slices])]
+    if np.any(term < 0):
+        raise ValueError(f"The {name} cannot be negative")
+    if term.shape not in ((), selected.shape, selected.shape[1:]):
+        raise ValueError(f"The {name} must be laid out as the sinogram {selected.shape}")
+    return np.ascontiguousarray(np.broadcast_to(term, selected.shape))
+
+
+def attenuation_key(mu_map, plan, pixel_size=1.0):
+    """
+    @brief Cache key of the attenuation correction factors of a mu-map in the geometry of a plan.
+
+    The key depends on the contents of the mu-map, the pixel size, the engine, the geometry and the
+    angles of the plan, but not on its subsets: every algorithm and number of subsets of the same
+    study share the same factors.
+
+    @param mu_map Attenuation map, (slices, nxd, nxd) or (nxd, nxd)
+    @param plan ReconstructionPlan of the reconstruction
+    @param pixel_size Length of a pixel in the units of 1/mu
+    @return Hexadecimal digest
+    """
+    mu_map = np.ascontiguousarray(mu_map, dtype=np.float64)
+    key = plan.key
+    digest = hashlib.sha1(mu_map.tobytes())
+    digest.update(repr((mu_map.shape, float(pixel_size), key[:5], key[6])).encode())
+    return digest.hexdigest()
+
+
+def attenuation_factors(mu_map, plan, pixel_size=1.0, cache_dir=None, cache=None):
+    """
+    @brief Attenuation correction factors exp(integral of mu) of every slice, projected once per study.
+
+    The mu-map is forward-projected with the engine of the plan, so the factors are laid out as the
+    sinograms of that engine. They are kept in cache (in memory) and in cache_dir (on disk, one .npy
+    file per key, see attenuation_key), so repeated reconstructions of the same study, with other
+    iterations, subsets or algorithms, do not project the mu-map again.
+
+    @param mu_map Attenuation map, (slices, nxd, nxd) or (nxd, nxd) for a single slice
+    @param plan ReconstructionPlan of the reconstruction
+    @param pixel_size Length of a pixel in the units of 1/mu (e.g. 0.1 for 1 mm pixels and mu in 1/cm)
+    @param cache_dir Directory of the factors saved on disk, None keeps them only in memory
+    @param cache Dictionary of the factors already computed, None for none
+
+    @return Array (slices, *sinogram shape of the engine)
+    """
+    mu_map = np.asarray(mu_map, dtype=np.float64)
+    if mu_map.ndim == 2:
+        mu_map = mu_map[None]
+    if mu_map.shape[1:] != (plan.nxd, plan.nxd):
+        raise ValueError(f"The mu-map must have slices of shape {(plan.nxd, plan.nxd)}")
+    if np.any(mu_map < 0):
+        raise ValueError("The mu-map cannot be negative")
+    return cached_correction(attenuation_key(mu_map, plan, pixel_size), "acf",
+                             lambda: np.exp(pixel_size * np.asarray([plan.project(mu) for mu in mu_map])), cache_dir, cache)
+
+
+def cached_correction(key, prefix, compute, cache_dir=None, cache=None):
+    """
+    @brief Correction array looked up in memory, then on disk, and computed only when neither has it.
+
+    @param key Hexadecimal digest identifying the correction (e.g. attenuation_key)
+    @param prefix Prefix of the file name, <prefix>_<key>.npy
+    @param compute Function without arguments returning the array
+    @param cache_dir Directory of the arrays saved on disk, None keeps them only in memory
+    @param cache Dictionary of the arrays already computed, None for none
+
+    @return Array
+    """
+    if cache is not None and key in cache:
+        return cache[key]
+    path = None if cache_dir is None else Path(cache_dir) / f"{prefix}_{key}.npy"
+    if path is not None and path.exists():
+        array = np.load(path)
+    else:
+        array = compute()
+        if path is not None:
+            _save_atomic(path, array)
+    if cache is not None:
+        cache[key] = array
+    return array
+
+
+def _save_atomic(path, array):
+    """
+    @brief Writes an array to a .npy file through a temporary file, so a reader never sees a partial file.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    handle, temporary = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(handle, "wb") as stream:
+            np.save(stream, array)
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
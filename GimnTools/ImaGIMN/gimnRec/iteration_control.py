@@ -0,0 +1,353 @@
+import copy
+import json
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+from scipy.special import xlogy
+
+
+# @file iteration_control.py
+# @brief Per-iteration monitoring of the iterative reconstructions.
+# @details An IterationMonitor is passed to the per-slice loops of MLEM/OSEM. After each iteration it
+# computes vectorized convergence metrics from the projection that the iteration already computed,
+# calls the user callback and decides whether the loop must stop (tol= / max_time=). It also writes
+# checkpoints of the loop (every N iterations and/or T seconds) from which a later call can resume,
+# and captures the estimates of selected iterations (save_iterates=) into an array or HDF5 dataset.
+
+
+def poisson_log_likelihood(sinogram, projection, axis=None):
+    """
+    @brief Poisson log-likelihood of the measured sinogram given the projection of the estimate.
+
+    The constant term log(y!) is omitted.
+
+    @param sinogram Measured sinogram
+    @param projection Forward projection of the estimate, same shape as sinogram
+    @param axis Axis to be reduced, None reduces everything
+    @return sum(y log(p) - p)
+    """
+    projection = np.maximum(projection, 1e-12)
+    return np.sum(xlogy(sinogram, projection) - projection, axis=axis)
+
+
+def relative_change(current, previous, axis=None):
+    """
+    @brief Relative change between two consecutive estimates, ||x_k - x_k-1|| / ||x_k-1||.
+
+    @param current Current estimate
+    @param previous Previous estimate
+    @param axis Axis to be reduced, None reduces everything
+    @return Relative change
+    """
+    difference = np.sqrt(np.sum((current - previous) ** 2, axis=axis))
+    return difference / (np.sqrt(np.sum(previous ** 2, axis=axis)) + 1e-12)
+
+
+def data_residual(sinogram, projection, axis=None):
+    """
+    @brief Relative data-fit residual, ||y - p|| / ||y||.
+
+    @param sinogram Measured sinogram
+    @param projection Forward projection of the estimate, same shape as sinogram
+    @param axis Axis to be reduced, None reduces everything
+    @return Relative residual
+    """
+    residual = np.sqrt(np.sum((sinogram - projection) ** 2, axis=axis))
+    return residual / (np.sqrt(np.sum(sinogram ** 2, axis=axis)) + 1e-12)
+
+
+class IterationState:
+    """
+    @brief Information passed to the on_iteration callback after each iteration.
+
+    - slice: index of the slice (None for the batched reconstructions, which run all the slices)
+    - iteration: index of the iteration that has just finished, starting at 0
+    - image: current estimate (do not modify it)
+    - projection: projection computed by the iteration, that is, of the estimate that entered it
+    - log_likelihood: Poisson log-likelihood of projection
+    - relative_change: relative change of the estimate in this iteration
+    - residual: relative data-fit residual of projection
+    - elapsed: seconds since the start of the reconstruction call
+    """
+
+    def __init__(self, slice, iteration, image, projection, log_likelihood, relative_change, residual, elapsed):
+        self.slice = slice
+        self.iteration = iteration
+        self.image = image
+        self.projection = projection
+        self.log_likelihood = log_likelihood
+        self.relative_change = relative_change
+        self.residual = residual
+        self.elapsed = elapsed
+
+
+class IterationMonitor:
+    """
+    @brief Convergence monitoring and stopping rules of an iterative reconstruction.
+
+    The loop stops when the relative change of the estimate falls below tol, when max_time seconds
+    have passed since the monitor was created, or when on_iteration returns True. With the "process"
+    backend the callback runs in the worker processes, so it must be picklable.
+
+    Checkpoints are written at the end of an iteration into one file per slice inside the checkpoint
+    directory. They hold the estimate of the loop, the number of finished iterations and the state of
+    the random generator of the slice at its start (used by the rotation OSEM to shuffle the angles).
+    The file is written to a temporary name and renamed, so a preempted job never leaves a truncated
+    checkpoint behind.
+
+    With save_iterates the estimates after the listed iterations (counted from 1) are written into
+    iterates[k, slice], k being the position of the iteration in save_iterates. When a slice stops
+    because it converged, its remaining snapshots receive the final estimate; snapshots of iterations
+    that were not reached (max_time, or fewer iterations than listed) are NaN in the array allocated
+    here, and a max_time stop also writes NaN into them. The snapshots already taken are also kept in
+    the checkpoint, so a resumed run returns all of them.
+    """
+
+    def __init__(self, on_iteration=None, tol=None, max_time=None, checkpoint=None, checkpoint_every=None,
+                 checkpoint_seconds=None, resume=False, save_iterates=None, iterates=None):
+        """
+        @brief Creates the monitor of a reconstruction call.
+
+        @param on_iteration Function called as on_iteration(state) with an IterationState
+        @param tol Stops when the relative change of the estimate is below tol
+        @param max_time Wall-clock budget, in seconds, of the whole reconstruction call
+        @param checkpoint Directory where the checkpoints are written
+        @param checkpoint_every Writes a checkpoint every checkpoint_every iterations
+        @param checkpoint_seconds Writes a checkpoint when checkpoint_seconds have passed since the last one
+        @param resume Continues each slice from its checkpoint, when there is one
+        @param save_iterates Iterations whose estimates are captured, e.g. [1, 2, 4, 8]
+        @param iterates Array or h5py dataset with shape (len(save_iterates), slices, nxd, nxd) that
+                        receives the estimates, allocated by allocate when None
+        """
+        self.on_iteration = on_iteration
+        self.tol = tol
+        self.max_time = max_time
+        self.checkpoint = checkpoint
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_seconds = checkpoint_seconds
+        self.resume = resume
+        self.save_iterates = None if save_iterates is None else sorted(int(n) for n in save_iterates)
+        self.iterates = iterates
+        self.slice = None
+        self.started = time.time()
+        self._previous = None
+        self._saved_at = None
+        self._random_state = None
+        self._restored = None
+        self._snapshots = {}
+
+    def for_slice(self, slice_index):
+        """
+        @brief Independent copy of the monitor used by the loop of one slice.
+
+        @param slice_index Index of the slice
+        @return IterationMonitor
+        """
+        monitor = copy.copy(self)
+        monitor.slice = slice_index
+        monitor._previous = None
+        monitor._saved_at = None
+        monitor._random_state = None
+        monitor._restored = None
+        monitor._snapshots = {}
+        return monitor
+
+    def allocate(self, slices, image_shape):
+        """
+        @brief Allocates the array of the captured estimates, unless one was given.
+
+        @param slices Number of slices of the reconstruction
+        @param image_shape Shape of each reconstructed slice
+        @return The array (or dataset) of the captured estimates, None without save_iterates
+        """
+        if self.save_iterates is not None and self.iterates is None:
+            self.iterates = np.full((len(self.save_iterates), slices) + tuple(image_shape), np.nan)
+        return self.iterates
+
+    def _capture(self, number, image):
+        """
+        @brief Captures the estimate of iteration number (counted from 1), if it is in save_iterates.
+        """
+        if number in self.save_iterates:
+            self._snapshots[number] = np.array(image, dtype=np.float64, copy=True)
+            self._store(self.save_iterates.index(number), image)
+
+    def _store(self, index, image):
+        """
+        @brief Writes an estimate into the position index of the captured estimates.
+        """
+        if self.slice is None:
+            # reconstrução em lote: uma coluna por fatia
+            self.iterates[index] = np.reshape(np.transpose(image), self.iterates.shape[1:])
+        else:
+            self.iterates[index, self.slice] = np.reshape(image, self.iterates.shape[2:])
+
+    @property
+    def checkpoint_path(self):
+        """
+        @brief File of the checkpoint of this slice (or of the batched reconstruction).
+        """
+        if self.checkpoint is None:
+            return None
+        name = "batch.npz" if self.slice is None else f"slice_{self.slice:04d}.npz"
+        return os.path.join(self.checkpoint, name)
+
+    def restored(self):
+        """
+        @brief Contents of the checkpoint to resume from, loaded on first use.
+
+        @return Dictionary with the arrays of the checkpoint, or None when not resuming
+        """
+        if self._restored is None and self.resume and self.checkpoint_path is not None \
+                and os.path.exists(self.checkpoint_path):
+            with np.load(self.checkpoint_path) as data:
+                self._restored = {key: data[key] for key in data.files}
+        return self._restored
+
+    def random_generator(self, seed=None):
+        """
+        @brief Random generator of the slice.
+
+        When resuming it is restored from the state saved in the checkpoint, so the slice draws the
+        same random numbers as the interrupted run; otherwise it is created from seed.
+
+        @param seed Seed (or np.random.SeedSequence) of the slice
+        @return np.random.Generator
+        """
+        saved = self.restored()
+        if saved is not None and "random_state" in saved:
+            state = json.loads(str(saved["random_state"]))
+            generator = np.random.Generator(getattr(np.random, state["bit_generator"])())
+            generator.bit_generator.state = state
+        else:
+            generator = np.random.default_rng(seed)
+        self._random_state = generator.bit_generator.state
+        return generator
+
+    def start(self, estimate, image=None):
+        """
+        @brief Registers the initial estimate of the loop, restoring the checkpoint when resuming.
+
+        @param estimate Estimate of the loop, overwritten in place with the one of the checkpoint
+        @param image Image used by the metrics when it is not the estimate itself
+        @return Index of the first iteration to be run
+        """
+        self._saved_at = time.time()
+        first = 0
+        saved = self.restored()
+        if saved is not None:
+            if saved["estimate"].shape != np.shape(estimate):
+                raise ValueError(f"The checkpoint {self.checkpoint_path} does not match the reconstruction")
+            estimate[...] = saved["estimate"]
+            first = sys.maxsize if bool(saved["converged"]) else int(saved["iteration"])
+            image = None
+            if self.save_iterates is not None and "iterate_numbers" in saved:
+                for number, snapshot in zip(saved["iterate_numbers"], saved["iterates"]):
+                    self._capture(int(number), snapshot)
+        self._previous = np.array(estimate if image is None else image, dtype=np.float64, copy=True)
+        return first
+
+    def save_checkpoint(self, iterations, estimate, converged=False):
+        """
+        @brief Writes the checkpoint of the slice atomically.
+
+        @param iterations Number of iterations already finished
+        @param estimate Estimate of the loop
+        @param converged The loop stopped because it converged, resuming does not run more iterations
+        """
+        arrays = {"estimate": np.asarray(estimate), "iteration": iterations, "converged": converged}
+        if self._snapshots:
+            numbers = sorted(self._snapshots)
+            arrays.update(iterate_numbers=np.array(numbers),
+                          iterates=np.stack([self._snapshots[number] for number in numbers]))
+        if self._random_state is not None:
+            arrays["random_state"] = json.dumps(self._random_state)
+        handle, temporary = tempfile.mkstemp(dir=self.checkpoint, suffix=".tmp")
+        try:
+            with os.fdopen(handle, "wb") as stream:
+                np.savez(stream, **arrays)
+            os.replace(temporary, self.checkpoint_path)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        self._saved_at = time.time()
+
+    def update(self, iteration, image, sinogram, projection, axis=None, estimate=None):
+        """
+        @brief Computes the metrics of an iteration, calls the callback and checks the stopping rules.
+
+        @param iteration Index of the iteration that has just finished
+        @param image Current estimate
+        @param sinogram Measured sinogram
+        @param projection Projection computed by the iteration, laid out as sinogram
+        @param axis Axis that holds the pixels/bins in batched reconstructions (the other axis is the slice)
+        @param estimate Estimate of the loop to be checkpointed when it is not image
+        @return True if the loop must stop
+        """
+        elapsed = time.time() - self.started
+        change = np.inf if self._previous is None else relative_change(image, self._previous, axis)
+        self._previous = np.array(image, dtype=np.float64, copy=True)
+
+        converged = False
+        if self.on_iteration is not None:
+            state = IterationState(self.slice, iteration, image, projection,
+                                   poisson_log_likelihood(sinogram, projection, axis), change,
+                                   data_residual(sinogram, projection, axis), elapsed)
+            converged = bool(self.on_iteration(state))
+        if self.tol is not None and np.all(change < self.tol):
+            converged = True
+        out_of_time = self.max_time is not None and elapsed >= self.max_time
+
+        if self.save_iterates is not None:
+            for index, number in enumerate(self.save_iterates):
+                if number == iteration + 1 or (converged and number > iteration + 1):
+                    self._capture(number, image)
+                elif out_of_time and number > iteration + 1:
+                    self._store(index, np.full(np.shape(image), np.nan))
+        if self.checkpoint is not None and (converged or out_of_time or self._checkpoint_due(iteration)):
+            self.save_checkpoint(iteration + 1, image if estimate is None else estimate, converged)
+        return converged or out_of_time
+
+    def _checkpoint_due(self, iteration):
+        """
+        @brief Checks whether a checkpoint has to be written after the iteration.
+        """
+        if self.checkpoint_every is not None and (iteration + 1) % self.checkpoint_every == 0:
+            return True
+        return self.checkpoint_seconds is not None and time.time() - self._saved_at >= self.checkpoint_seconds
+
+
+def iteration_monitor(on_iteration=None, tol=None, max_time=None, checkpoint=None, checkpoint_every=None,
+                      checkpoint_seconds=None, resume=False, save_iterates=None, iterates=None):
+    """
+    @brief Creates an IterationMonitor, or None when nothing has to be monitored.
+
+    @param resume True resumes from the checkpoint directory, a path resumes from that directory
+    @return IterationMonitor or None
+    """
+    if resume and resume is not True:
+        checkpoint = resume if checkpoint is None else checkpoint
+    if resume and checkpoint is None:
+        raise ValueError("resume needs the checkpoint directory")
+    if checkpoint is not None:
+        if checkpoint_every is None and checkpoint_seconds is None:
+            checkpoint_every = 1
+        os.makedirs(checkpoint, exist_ok=True)
+    if on_iteration is None and tol is None and max_time is None and checkpoint is None and save_iterates is None:
+        return None
+    return IterationMonitor(on_iteration, tol, max_time, checkpoint, checkpoint_every, checkpoint_seconds,
+                            bool(resume), save_iterates, iterates)
+
+
+def monitored_result(rec, monitor):
+    """
+    @brief Result of a reconstruction method, with the captured estimates when save_iterates was used.
+
+    @return rec, or (rec, iterates)
+    """
+    if monitor is not None and monitor.save_iterates is not None:
+        return rec, monitor.iterates
+    return rec
@@ -1,6 +1,6 @@
 import numpy as np
 from GimnTools.ImaGIMN.processing.tools.math import rotate
-from numba import njit
+from numba import njit, prange
 
 
 def radon_m(image, angles, interpolator, center=None):
@@ -38,7 +38,80 @@ def projector(image, angles, interpolator, center=None):
         sino[:, i] = test.sum(axis=1)
     return sino
 
-@njit
+def angle_blocks(n_angles, block_size=1):
+    """
+    Splits the angle indices of a sinogram into contiguous blocks of views.
+
+    @param n_angles (int): Number of projection angles.
+    @param block_size (int, optional): Number of views per block (default is 1).
+
+    @return Generator of numpy arrays with the angle indices of each block.
+    """
+    block_size = max(1, int(block_size))
+    for start in range(0, n_angles, block_size):
+        yield np.arange(start, min(start + block_size, n_angles))
+
+
+def radon_m_views(image, angles, interpolator, center=None, block_size=1):
+    """
+    Streams the projections of radon_m one block of views at a time.
+
+    Only the views of the current block are held in memory, so consumers can process or write
+    each block while the next one is being projected.
+
+    @param image (numpy.ndarray): Input image.
+    @param angles (numpy.ndarray): Angles at which projections will be calculated.
+    @param interpolator (function): Interpolation function to be used.
+    @param center (tuple, optional): Center of the image (default is the center of the image).
+    @param block_size (int, optional): Number of views yielded per block (default is 1).
+
+    @return Generator of (indices, views) where views has shape (image.shape[0], len(indices)).
+    """
+    angles = np.asarray(angles)
+    for indices in angle_blocks(angles.size, block_size):
+        views = np.zeros([image.shape[0], indices.size])
+        for i, angle in enumerate(angles[indices]):
+            views[:, i] = rotate(image, angle, interpolator, center=center).sum(axis=1)
+        yield indices, views
+
+
+def direct_radon_views(image, angles, block_size=1):
+    """
+    Streams the projections of direct_radon one block of views at a time.
+
+    @param image (numpy.ndarray): Square input image.
+    @param angles (numpy.ndarray): Projection angles in degrees.
+    @param block_size (int, optional): Number of views yielded per block (default is 1).
+
+    @return Generator of (indices, views) where views has shape (image.shape[0], len(indices)).
+    """
+    angles = np.ascontiguousarray(angles, dtype=np.float64)
+    for indices in angle_blocks(angles.size, block_size):
+        yield indices, direct_radon(image, angles[indices])
+
+
+def system_matrix_views(image, sys_mat, nrd, block_size=1):
+    """
+    Streams the forward model of a system matrix one block of views at a time.
+
+    The system matrix rows are ordered angle by angle (nrd rows per angle), so each block is
+    obtained from a contiguous band of rows and the full sinogram is never materialized.
+
+    @param image (numpy.ndarray): Input image with shape (nxd, nxd).
+    @param sys_mat (numpy.ndarray): System matrix with shape (nrd * nphi, nxd * nxd).
+    @param nrd (int): Number of radial bins of the sinogram.
+    @param block_size (int, optional): Number of views yielded per block (default is 1).
+
+    @return Generator of (indices, views) where views has shape (len(indices), nrd).
+    """
+    flat = np.ravel(image)
+    n_angles = sys_mat.shape[0] // nrd
+    for indices in angle_blocks(n_angles, block_size):
+        rows = slice(indices[0] * nrd, (indices[-1] + 1) * nrd)
+        yield indices, (sys_mat[rows] @ flat).reshape(indices.size, nrd)
+
+
+@njit(nogil=True)
 def direct_radon (imagem , angles):
     """
     @brief Computes the Radon transform (sinogram) of a given image for specified projection angles.
@@ -85,6 +158,91 @@ def direct_radon (imagem , angles):
     return sinograma
 
 
+@njit(nogil=True)
+def project_events(image, offsets, angles, out):
+    """
+    @brief Computes the line integral of the image along the line of response of each event.
+    Each event is a line of the direct_radon geometry with a continuous radial position, so the
+    projection of an event at the centre of a bin equals the corresponding sinogram bin of
+    direct_radon. This is the forward projector of the list-mode reconstruction.
+    @param image 2D square numpy array.
+    @param offsets Radial position of each event, in pixels from the centre of the image.
+    @param angles Angle of each event, in degrees.
+    @param out Array (events,) that receives the projections.
+    @see backproject_events
+    """
+    size = image.shape[0]
+    center = (size - 1) / 2
+    radius = center * center
+    for e in range(offsets.size):
+        angle = np.deg2rad(angles[e] - 90)
+        cos = np.cos(angle)
+        sen = np.sin(angle)
+        mc = offsets[e]
+        value = 0.0
+        for n in range(size):
+            nc = n - center
+            if mc * mc + nc * nc < radius:
+                value += bilinear_interpolation(image, center + mc * cos - nc * sen, center + mc * sen + nc * cos)
+        out[e] = value
+
+
+@njit(parallel=True, nogil=True)
+def project_oblique_segment(volume, angles, ring_difference, radius, out):
+    """
+    @brief Projects a volume along the oblique lines of response of one segment.
+    A line of the segment with ring difference d is the line of direct_radon in the transaxial
+    plane, tilted so that it goes from ring i (at the start of the line) to ring i + d (at its
+    end), the ends being on a cylinder of the given radius. The axial position is linearly
+    interpolated between slices. The transaxial footprint of a line (sample positions and bilinear
+    weights) does not depend on the plane, so it is computed once and reused for every plane of
+    the segment. With d = 0 every plane is the direct_radon of the corresponding slice.
+    @param volume 3D numpy array (rings, pixels, pixels), one slice per ring.
+    @param angles 1D array of projection angles in degrees.
+    @param ring_difference Ring difference d of the segment.
+    @param radius Radius of the detector, in pixels; must be larger than the half-size of the image.
+    @param out Array (rings - |d|, pixels, angles) that receives the segment.
+    @see backproject_oblique_segment
+    """
+    rings, size = volume.shape[0], volume.shape[1]
+    center = (size - 1) / 2
+    limit = center * center
+    planes = out.shape[0]
+    first = abs(ring_difference) / 2
+    for k in prange(angles.size):
+        angle = np.deg2rad(angles[k] - 90)
+        cos = np.cos(angle)
+        sen = np.sin(angle)
+        for m in range(size):
+            mc = m - center
+            # Inclinação axial: d anéis ao longo do comprimento da LOR entre os detectores
+            slope = ring_difference / (2 * np.sqrt(radius * radius - mc * mc))
+            for i in range(planes):
+                out[i, m, k] = 0.0
+            for n in range(size):
+                nc = n - center
+                if mc * mc + nc * nc >= limit:
+                    continue
+                x = center + mc * cos - nc * sen
+                y = center + mc * sen + nc * cos
+                x0 = int(np.floor(x))
+                y0 = int(np.floor(y))
+                x1 = min(x0 + 1, size - 1)
+                y1 = min(y0 + 1, size - 1)
+                dx = x - x0
+                dy = y - y0
+                for i in range(planes):
+                    z = i + first + slope * nc
+                    z0 = int(np.floor(z))
+                    z1 = min(z0 + 1, rings - 1)
+                    dz = z - z0
+                    plane0 = ((1 - dx) * (1 - dy) * volume[z0, y0, x0] + dx * (1 - dy) * volume[z0, y0, x1]
+                              + (1 - dx) * dy * volume[z0, y1, x0] + dx * dy * volume[z0, y1, x1])
+                    plane1 = ((1 - dx) * (1 - dy) * volume[z1, y0, x0] + dx * (1 - dy) * volume[z1, y0, x1]
+                              + (1 - dx) * dy * volume[z1, y1, x0] + dx * dy * volume[z1, y1, x1])
+                    out[i, m, k] += (1 - dz) * plane0 + dz * plane1
+
+
 @njit
 def bilinear_interpolation(image, x, y):
     """
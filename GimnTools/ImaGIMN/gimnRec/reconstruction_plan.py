@@ -0,0 +1,501 @@
+import copy
+import json
+import numpy as np
+
+from GimnTools.ImaGIMN.gimnRec.projectors import direct_radon, radon_m
+from GimnTools.ImaGIMN.gimnRec.backprojectors import inverse_radon, backprojector
+from GimnTools.ImaGIMN.processing.interpolators import reconstruction as interpolators
+from GimnTools.ImaGIMN.gimnRec.priors import neighbourhood
+
+
+# @file reconstruction_plan.py
+# @brief Geometry that is shared by every slice, algorithm and call of the iterative reconstructors.
+# @details The system matrix, the subset partitions and the sensitivity images only depend on the
+# geometry, the angles and the number of subsets, so they are computed once by a ReconstructionPlan
+# and the per-slice work of MLEM/OSEM is reduced to the iterations themselves.
+
+
+ENGINES = ("line_integral", "rotation", "system_matrix")
+ORDERINGS = ("contiguous", "interleaved", "bit_reversal", "golden_angle", "max_separation")
+
+
+def make_geometry(pixels, bins=None, center=None):
+    """
+    @brief Builds the geometry dictionary used by ReconstructionPlan.
+
+    @param pixels Number of pixels of each side of the reconstructed image (nxd)
+    @param bins Number of radial bins of the sinogram (nrd), defaults to pixels
+    @param center Center of rotation, None means the default center of each engine
+    @return Dictionary with the keys "pixels", "bins" and "center"
+    """
+    return {"pixels": int(pixels),
+            "bins": int(pixels if bins is None else bins),
+            "center": center}
+
+
+class ReconstructionPlan:
+    """
+    @brief Precomputed geometry of an iterative reconstruction.
+
+    A plan holds everything that does not depend on the measured data:
+    - subset_indices: angle indices of each subset, in the order the subsets are visited (see subset_ordering)
+    - subset_angles: angles of each subset
+    - sensitivity: backprojection of a sinogram of ones (or of the weights, see weighted) over all the angles
+    - subset_sensitivity: backprojection of a sinogram of ones (or of the weights) over each subset
+    - system_matrix, subset_rows and subset_matrices for the "system_matrix" engine
+    - neighbourhood: offsets and weights of the neighbours used by the priors of the MAP methods
+
+    The engines are:
+    - "line_integral": direct_radon / inverse_radon, sinograms ordered (distances, angles)
+    - "rotation": projector / backprojector by image rotation, sinograms ordered (distances, angles)
+    - "system_matrix": explicit system matrix, sinograms ordered (angles, distances)
+    """
+
+    def __init__(self, geometry, angles, subsets=1, engine="system_matrix", interpolator=None, base=None,
+                 ordering="max_separation"):
+        """
+        @brief Computes the plan.
+
+        @param geometry Dictionary created by make_geometry (or a number of pixels)
+        @param angles Projection angles in degrees
+        @param subsets Number of subsets, 1 for MLEM
+        @param engine Projection engine, "line_integral", "rotation" or "system_matrix"
+        @param interpolator Interpolation function, required by the "rotation" engine
+        @param base Plan with the same geometry and angles whose system matrix and sensitivity
+                    image are reused instead of recomputed
+        @param ordering How the angles are split in subsets and the order the subsets are visited (see subset_ordering)
+        """
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown reconstruction engine: {engine}")
+        if ordering not in ORDERINGS:
+            raise ValueError(f"Unknown subset ordering: {ordering}")
+        if engine == "rotation" and interpolator is None:
+            raise ValueError("The rotation engine needs an interpolator")
+        if not isinstance(geometry, dict):
+            geometry = make_geometry(geometry)
+
+        self.geometry = make_geometry(geometry["pixels"], geometry.get("bins"), geometry.get("center"))
+        self.angles = np.ascontiguousarray(angles, dtype=np.float64)
+        self.subsets = int(subsets)
+        self.engine = engine
+        self.interpolator = interpolator
+        self.ordering = ordering
+        self.system_matrix = None
+        self.subset_rows = None
+        self.weights = None
+        self._sensitivity = None
+        self._subset_sensitivity = None
+        self._neighbourhoods = {}
+        self._regions = {}
+        self._subset_matrices = None
+
+        self.subset_indices = subset_ordering(self.nphi, self.subsets, ordering)
+        if base is not None:
+            self.system_matrix = base.system_matrix
+            if base.weights is None:
+                self._sensitivity = base._sensitivity
+        if self.engine == "system_matrix":
+            if self.system_matrix is None:
+                # importado aqui para evitar import circular com os reconstrutores
+                from GimnTools.ImaGIMN.gimnRec.reconstructors.system_matrix_reconstruction import system_matrix
+                self.system_matrix = system_matrix(self.nxd, self.nrd, self.nphi, self.angles, self.center)
+            self.subset_rows = [subset_rows(indices, self.nrd) for indices in self.subset_indices]
+
+    def with_subsets(self, subsets):
+        """
+        @brief Creates a plan with another number of subsets that shares this plan's geometry.
+
+        @param subsets Number of subsets of the new plan
+        @return ReconstructionPlan
+        """
+        return ReconstructionPlan(self.geometry, self.angles, subsets, self.engine, self.interpolator, base=self,
+                                  ordering=self.ordering)
+
+    def weighted(self, weights):
+        """
+        @brief Copy of the plan whose sensitivity images are backprojections of multiplicative weights.
+
+        With the weights w of a slice (attenuation, normalization) the expected counts are w A x + r
+        and the EM updates are normalized by A^T w instead of A^T 1. The copy shares the system matrix,
+        the subsets and the regions of this plan (whose sensitivities stay unweighted); its sensitivity
+        images are computed on first use.
+
+        @param weights Weights of one slice, laid out as the sinogram of the engine, None for none
+        @return ReconstructionPlan (this plan when weights is None)
+        """
+        if weights is None:
+            return self
+        plan = copy.copy(self)
+        plan.weights = np.asarray(weights, dtype=np.float64)
+        plan._sensitivity = None
+        plan._subset_sensitivity = None
+        return plan
+
+    @property
+    def nxd(self):
+        """
+        @brief Number of pixels of each side of the image.
+        """
+        return self.geometry["pixels"]
+
+    @property
+    def nrd(self):
+        """
+        @brief Number of radial bins of the sinogram.
+        """
+        return self.geometry["bins"]
+
+    @property
+    def nphi(self):
+        """
+        @brief Number of projection angles.
+        """
+        return self.angles.size
+
+    @property
+    def center(self):
+        """
+        @brief Center of rotation of the geometry.
+        """
+        return self.geometry["center"]
+
+    @property
+    def subset_angles(self):
+        """
+        @brief Angles of each subset.
+        """
+        return [self.angles[indices] for indices in self.subset_indices]
+
+    @property
+    def subset_matrices(self):
+        """
+        @brief Rows of the system matrix that belong to each subset.
+
+        Non-contiguous subsets are copies of their rows, made on first use and kept by the plan (and
+        its weighted copies), so the slices reconstructed with the plan share them.
+        """
+        if self._subset_matrices is None:
+            self._subset_matrices = [self.rows_of(rows) for rows in self.subset_rows]
+        return self._subset_matrices
+
+    def rows_of(self, rows):
+        """
+        @brief Selects rows of the system matrix, as a view whenever the rows are contiguous.
+
+        @param rows Row indices
+        @return Matrix with the selected rows
+        """
+        rows = np.asarray(rows)
+        if rows.size and rows[-1] - rows[0] + 1 == rows.size and np.all(np.diff(rows) == 1):
+            return self.system_matrix[rows[0]:rows[-1] + 1]
+        return self.system_matrix[rows]
+
+    @property
+    def subset_order(self):
+        """
+        @brief Angle indices of all the subsets and the offsets where each subset starts.
+
+        @return (order, offsets), the indices of subset i are order[offsets[i]:offsets[i + 1]]
+        """
+        order = np.concatenate(self.subset_indices).astype(np.int64)
+        offsets = np.cumsum([0] + [indices.size for indices in self.subset_indices]).astype(np.int64)
+        return order, offsets
+
+    @property
+    def subset_row_order(self):
+        """
+        @brief System matrix rows of all the subsets and the offsets where each subset starts.
+
+        @return (rows, offsets), the rows of subset i are rows[offsets[i]:offsets[i + 1]]
+        """
+        rows = np.concatenate(self.subset_rows).astype(np.int64)
+        offsets = np.cumsum([0] + [r.size for r in self.subset_rows]).astype(np.int64)
+        return rows, offsets
+
+    @property
+    def subset_bounds(self):
+        """
+        @brief First and last + 1 system matrix rows of each subset.
+
+        @return Array (subsets, 2), or None when the rows of a subset are not contiguous
+        """
+        bounds = np.zeros((self.subsets, 2), dtype=np.int64)
+        for i, rows in enumerate(self.subset_rows):
+            if rows.size and (rows[-1] - rows[0] + 1 != rows.size or np.any(np.diff(rows) != 1)):
+                return None
+            bounds[i] = (rows[0], rows[-1] + 1) if rows.size else (0, 0)
+        return bounds
+
+    def neighbourhood(self, ndim=2):
+        """
+        @brief Offsets and weights of the 8 (2D) or 26 (3D) neighbours of the priors, computed once per plan.
+
+        @param ndim 2 for in-plane priors, 3 for priors that also couple neighbouring slices
+        @return (offsets, weights), see priors.neighbourhood
+        """
+        if ndim not in self._neighbourhoods:
+            self._neighbourhoods[ndim] = neighbourhood(ndim)
+        return self._neighbourhoods[ndim]
+
+    def region(self, roi, margin=0):
+        """
+        @brief System matrix restricted to an in-plane region of interest, computed once per plan and region.
+
+        The region is widened by margin pixels on every side and clipped to the image. Only the
+        rows of each subset whose lines cross the region are kept, so the iterations inside the
+        region cost in proportion to its size instead of the whole field of view.
+
+        @param roi (x0, x1, y0, y1), columns x0:x1 and rows y0:y1 of the image
+        @param margin Pixels added around the region
+        @return (columns, rows, matrices, sensitivities): flat image indices of the region and, for
+                each subset, its system matrix rows, the submatrix on those rows and columns and its
+                sensitivity on the region
+        """
+        if self.engine != "system_matrix":
+            raise ValueError("The region of interest needs the system_matrix engine")
+        x0, x1, y0, y1 = (int(v) for v in roi)
+        x0, y0 = max(x0 - margin, 0), max(y0 - margin, 0)
+        x1, y1 = min(x1 + margin, self.nxd), min(y1 + margin, self.nxd)
+        if x0 >= x1 or y0 >= y1:
+            raise ValueError(f"Empty region of interest: {roi}")
+        key = (x0, x1, y0, y1)
+        if key not in self._regions:
+            columns = (np.arange(y0, y1)[:, None] * self.nxd + np.arange(x0, x1)[None, :]).ravel()
+            rows, matrices, sensitivities = [], [], []
+            for subset in self.subset_rows:
+                block = self.system_matrix[subset][:, columns]
+                # linhas que não cruzam a região não mudam a estimativa dentro dela
+                crossing = np.any(block != 0, axis=1)
+                rows.append(subset[crossing])
+                matrices.append(np.ascontiguousarray(block[crossing]))
+                sensitivities.append(matrices[-1].sum(axis=0))
+            self._regions[key] = (columns, rows, matrices, sensitivities)
+        return self._regions[key]
+
+    @property
+    def key(self):
+        """
+        @brief Hashable identification of the plan, used to cache plans.
+        """
+        return plan_key(self.geometry, self.angles, self.subsets, self.engine, self.interpolator, self.ordering)
+
+    @property
+    def sensitivity(self):
+        """
+        @brief Backprojection of a sinogram of ones (or of the weights) over all the angles, computed on first use.
+        """
+        if self._sensitivity is None:
+            if self.weights is not None and self.subsets > 1 and self.engine == "system_matrix":
+                # a retroprojeção pela matriz é linear: a soma dos subsets é a de todos os ângulos
+                self._sensitivity = sum(self.subset_sensitivity)
+            else:
+                self._sensitivity = self.backproject(self._weights_of())
+        return self._sensitivity
+
+    @property
+    def subset_sensitivity(self):
+        """
+        @brief Backprojection of a sinogram of ones (or of the weights) over each subset, computed on first use.
+        """
+        if self._subset_sensitivity is None:
+            if self.subsets == 1:
+                self._subset_sensitivity = [self.sensitivity]
+            elif self.engine == "system_matrix":
+                self._subset_sensitivity = [self.backproject(self._weights_of(rows), rows) for rows in self.subset_rows]
+            else:
+                self._subset_sensitivity = [self.backproject(self._weights_of(indices), indices)
+                                            for indices in self.subset_indices]
+        return self._subset_sensitivity
+
+    def _weights_of(self, selection=None):
+        """
+        @brief Weights of the system matrix rows (or angles) of selection, ones for a plan without weights.
+        """
+        if self.engine == "system_matrix":
+            weights = np.ones(self.system_matrix.shape[0]) if self.weights is None else self.weights.ravel()
+            return weights if selection is None else weights[selection]
+        weights = np.ones((self.nrd, self.nphi)) if self.weights is None else self.weights
+        return weights if selection is None else weights[:, selection]
+
+    def project(self, image, selection=None):
+        """
+        @brief Forward-projects an image (over a subset of the angles) with the engine of the plan.
+
+        @param image Image with shape (nxd, nxd)
+        @param selection Angle indices of the projection, None for all
+        @return Sinogram laid out as expected by the engine, (angles, distances) for the "system_matrix"
+                engine and (distances, angles) for the others
+        """
+        image = np.ascontiguousarray(image, dtype=np.float64)
+        if self.engine == "system_matrix":
+            rows = None if selection is None else subset_rows(selection, self.nrd)
+            matrix = self.system_matrix if rows is None else self.rows_of(rows)
+            return (matrix @ image.ravel()).reshape(-1, self.nrd)
+        angles = self.angles if selection is None else self.angles[selection]
+        if self.engine == "line_integral":
+            return direct_radon(image, angles)
+        return radon_m(image, angles, self.interpolator, center=self.center)
+
+    def backproject(self, sinogram, selection=None):
+        """
+        @brief Backprojects a sinogram (or a subset of it) with the engine of the plan.
+
+        @param sinogram Sinogram laid out as expected by the engine, or a flat vector of
+                        system matrix rows for the "system_matrix" engine
+        @param selection Angle indices (or system matrix rows) of the sinogram, None for all
+        @return Backprojected image with shape (nxd, nxd)
+        """
+        if self.engine == "system_matrix":
+            matrix = self.system_matrix if selection is None else self.rows_of(selection)
+            return (matrix.T @ np.ravel(sinogram)).reshape(self.nxd, self.nxd)
+        angles = self.angles if selection is None else self.angles[selection]
+        if self.engine == "line_integral":
+            return inverse_radon(np.ascontiguousarray(sinogram, dtype=np.float64), angles)
+        return backprojector(sinogram, angles, self.interpolator, center=self.center)
+
+    def save(self, path):
+        """
+        @brief Serializes the plan into a numpy .npz file.
+
+        @param path Destination file
+        """
+        arrays = {"angles": self.angles, "sensitivity": self.sensitivity}
+        for i, (indices, sens) in enumerate(zip(self.subset_indices, self.subset_sensitivity)):
+            arrays[f"subset_indices_{i}"] = indices
+            arrays[f"subset_sensitivity_{i}"] = sens
+        if self.system_matrix is not None:
+            arrays["system_matrix"] = self.system_matrix
+        meta = {"geometry": self.geometry,
+                "subsets": self.subsets,
+                "engine": self.engine,
+                "ordering": self.ordering,
+                "interpolator": None if self.interpolator is None else self.interpolator.__name__}
+        np.savez_compressed(path, meta=json.dumps(meta), **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """
+        @brief Loads a plan saved with save, without recomputing anything.
+
+        @param path File written by save
+        @return ReconstructionPlan
+        """
+        with np.load(path) as data:
+            meta = json.loads(str(data["meta"]))
+            plan = cls.__new__(cls)
+            plan.geometry = meta["geometry"]
+            plan.subsets = meta["subsets"]
+            plan.engine = meta["engine"]
+            # planos salvos antes das ordenações usavam blocos contíguos
+            plan.ordering = meta.get("ordering", "contiguous")
+            plan.interpolator = None if meta["interpolator"] is None else getattr(interpolators, meta["interpolator"])
+            plan.angles = data["angles"]
+            plan._sensitivity = data["sensitivity"]
+            plan.subset_indices = [data[f"subset_indices_{i}"] for i in range(plan.subsets)]
+            plan._subset_sensitivity = [data[f"subset_sensitivity_{i}"] for i in range(plan.subsets)]
+            plan.system_matrix = data["system_matrix"] if "system_matrix" in data else None
+            plan.subset_rows = None
+            plan.weights = None
+            plan._neighbourhoods = {}
+            plan._regions = {}
+            plan._subset_matrices = None
+            if plan.system_matrix is not None:
+                plan.subset_rows = [subset_rows(indices, plan.nrd) for indices in plan.subset_indices]
+        return plan
+
+
+def subset_ordering(nphi, subsets, ordering="max_separation"):
+    """
+    @brief Splits the angle indices in subsets and orders the subsets.
+
+    - "contiguous": blocks of neighbouring angles visited in order (np.array_split)
+    - "interleaved": subset s has the angles s, s + subsets, s + 2 subsets, ..., visited in order
+    - "bit_reversal": interleaved subsets visited in the bit-reversed order of their index
+    - "golden_angle": interleaved subsets visited in steps of the golden ratio of the angular period
+    - "max_separation": interleaved subsets, each one chosen as far as possible from all the
+      subsets already visited (and, on ties, from the last one)
+
+    The interleaved subsets are spread over all the angles, and the orderings keep consecutive
+    subsets angularly apart, so each update brings information the previous ones did not.
+
+    @param nphi Number of angles
+    @param subsets Number of subsets
+    @param ordering One of ORDERINGS
+    @return List with the angle indices of each subset, in the order they are visited
+    """
+    if ordering == "contiguous":
+        return np.array_split(np.arange(nphi), subsets)
+    interleaved = [np.arange(s, nphi, subsets) for s in range(subsets)]
+    if ordering == "interleaved" or subsets == 1:
+        order = list(range(subsets))
+    elif ordering == "bit_reversal":
+        bits = int(np.ceil(np.log2(subsets)))
+        reversed_index = [int(format(j, f"0{bits}b")[::-1], 2) for j in range(2 ** bits)]
+        order = [s for s in reversed_index if s < subsets]
+    elif ordering == "golden_angle":
+        golden = (np.sqrt(5) - 1) / 2
+        order = []
+        j = 0
+        while len(order) < subsets and j < 100 * subsets:
+            s = int(np.floor((j * golden) % 1 * subsets))
+            if s not in order:
+                order.append(s)
+            j += 1
+        order += [s for s in range(subsets) if s not in order]
+    else:
+        # distância angular circular entre subsets intercalados, em unidades de subset
+        order = [0]
+        remaining = list(range(1, subsets))
+        while remaining:
+            def separation(s):
+                distances = [min(abs(s - t), subsets - abs(s - t)) for t in order]
+                return (min(distances), distances[-1])
+            best = max(remaining, key=separation)
+            order.append(best)
+            remaining.remove(best)
+    return [interleaved[s] for s in order]
+
+
+def subset_rows(angle_indices, nrd):
+    """
+    @brief Rows of the system matrix that correspond to a set of angles.
+
+    @param angle_indices Angle indices of the subset
+    @param nrd Number of radial bins of the sinogram
+    @return Array with the row indices, angle by angle
+    """
+    angle_indices = np.asarray(angle_indices)
+    return (angle_indices[:, None] * nrd + np.arange(nrd)[None, :]).ravel()
+
+
+def plan_key(geometry, angles, subsets, engine, interpolator=None, ordering="max_separation"):
+    """
+    @brief Builds the cache key of a plan.
+
+    @return Hashable tuple that identifies the plan
+    """
+    angles = np.ascontiguousarray(angles, dtype=np.float64)
+    center = geometry.get("center")
+    if center is not None:
+        center = tuple(np.ravel(center).tolist())
+    return (engine, geometry["pixels"], geometry.get("bins", geometry["pixels"]), center,
+            angles.tobytes(), int(subsets), None if interpolator is None else interpolator.__name__, ordering)
+
+
+def cached_plan(cache, geometry, angles, subsets=1, engine="system_matrix", interpolator=None, ordering="max_separation"):
+    """
+    @brief Returns the plan stored in cache, computing it only the first time.
+
+    @param cache Dictionary used to store the plans (usually owned by a reconstructor)
+    @return ReconstructionPlan
+    """
+    key = plan_key(geometry, angles, subsets, engine, interpolator, ordering)
+    if key not in cache:
+        # planos com a mesma geometria e ângulos compartilham a matriz do sistema
+        base = None
+        for cached in cache.values():
+            if cached.key[:5] == key[:5] and cached.key[6] == key[6]:
+                base = cached
+                break
+        cache[key] = ReconstructionPlan(geometry, angles, subsets, engine, interpolator, base=base, ordering=ordering)
+    return cache[key]
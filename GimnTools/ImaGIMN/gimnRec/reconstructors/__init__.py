@@ -1,4 +1,6 @@
 from GimnTools.ImaGIMN.gimnRec.reconstructors.rotation_reconstruction import *
 from GimnTools.ImaGIMN.gimnRec.reconstructors.system_matrix_reconstruction import *
 from GimnTools.ImaGIMN.gimnRec.reconstructors.line_integral_reconstructor import *
+from GimnTools.ImaGIMN.gimnRec.reconstructors.list_mode_reconstruction import *
+from GimnTools.ImaGIMN.gimnRec.reconstructors.fully_3d_reconstruction import *
 
@@ -0,0 +1,67 @@
+import numpy as np
+
+
+# @file acceleration.py
+# @brief Momentum acceleration of the EM/OS-EM updates.
+# @details The accelerated loop extrapolates the estimate along the direction of the last update,
+# y = x_k + beta_k (x_k - x_k-1), and applies the EM (or OS-EM) pass of the engine to y. The
+# extrapolated point is kept strictly positive, because EM cannot bring back a pixel that reaches
+# zero, and the momentum is restarted whenever the new update turns against the previous one.
+
+MOMENTUM = ("nesterov", "relaxed")
+
+
+def momentum_em(em_pass, estimate, iterations, momentum="nesterov", relaxation=0.5, restart=True,
+                monitor=None, sinogram=None, projection=None):
+    """
+    @brief Runs EM/OS-EM passes with Nesterov or relaxed momentum and adaptive restart.
+
+    @param em_pass Function em_pass(estimate, projection) that applies one EM (or OS-EM) pass
+                   in place and writes the projection it computed into projection
+    @param estimate Initial estimate, updated in place with the result
+    @param iterations Number of passes
+    @param momentum "nesterov": beta_k = (t_k - 1) / t_k+1 with t_k+1 = (1 + sqrt(1 + 4 t_k²)) / 2,
+                    "relaxed": constant beta_k = relaxation
+    @param relaxation Momentum of the "relaxed" scheme, between 0 and 1
+    @param restart Restarts the momentum when (x_k+1 - x_k)·(x_k - x_k-1) < 0
+    @param monitor IterationMonitor of the slice, None runs all the passes
+    @param sinogram Measured sinogram, used by the monitor
+    @param projection Array that receives the projections of each pass
+    @return The estimate
+    """
+    if momentum not in MOMENTUM:
+        raise ValueError(f"Unknown momentum: {momentum}")
+
+    first = 0
+    if monitor is not None:
+        first = monitor.start(estimate)
+    previous = estimate.copy()
+    extrapolated = np.empty_like(estimate)
+    t = 1.0
+    for it in range(first, iterations):
+        if momentum == "nesterov":
+            t_next = 0.5 * (1.0 + np.sqrt(1.0 + 4.0 * t * t))
+            beta = (t - 1.0) / t_next
+        else:
+            t_next = t
+            beta = relaxation
+
+        # ponto extrapolado, mantido estritamente positivo
+        np.subtract(estimate, previous, out=extrapolated)
+        extrapolated *= beta
+        extrapolated += estimate
+        np.maximum(extrapolated, 1e-3 * estimate, out=extrapolated)
+        em_pass(extrapolated, projection)
+
+        # reinício adaptativo: a nova atualização contraria a anterior, o próximo passo é sem momento
+        if restart and np.vdot(extrapolated - estimate, estimate - previous) < 0:
+            t_next = 1.0
+            previous[...] = extrapolated
+        else:
+            previous[...] = estimate
+        estimate[...] = extrapolated
+        t = t_next
+
+        if monitor is not None and monitor.update(it, estimate, sinogram, projection):
+            break
+    return estimate
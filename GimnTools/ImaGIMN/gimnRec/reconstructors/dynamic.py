@@ -0,0 +1,95 @@
+import numpy as np
+from pathlib import Path
+
+from GimnTools.ImaGIMN.gimnRec.corrections import correction_term
+
+
+# @file dynamic.py
+# @brief Reconstruction of the time frames of a dynamic study (reconstruct_frames of the reconstructors).
+# @details The frames of a study share the geometry, so they share one ReconstructionPlan, with its
+# system matrix and sensitivity images, and the corrections of the study (attenuation and
+# normalization). A batch of frames is reconstructed as one stack with frames * slices slices, the
+# extra slices being extra right-hand sides of the batched kernels (or extra work of the slice
+# workers), and every frame of the batch is written to the output as soon as the batch is done, so a
+# study larger than the memory can be reconstructed into a file.
+
+
+def frame_output(output, shape):
+    """
+    @brief Array that receives the reconstructed frames.
+
+    @param output None for an array in memory, the path of a .npy file (created with
+                  np.lib.format.open_memmap, so the frames go to disk as they are written), or an
+                  array or h5py dataset with the given shape
+    @param shape Shape (frames, slices, nxd, nxd)
+    @return Array-like indexed by frame
+    """
+    if output is None:
+        return np.zeros(shape)
+    if isinstance(output, (str, Path)):
+        return np.lib.format.open_memmap(str(output), mode="w+", dtype=np.float64, shape=shape)
+    if tuple(output.shape) != tuple(shape):
+        raise ValueError(f"The output must have shape {tuple(shape)}")
+    return output
+
+
+def frame_term(term, sinograms, start, stop, name="correction"):
+    """
+    @brief Term of the model (additive=, weights=) of the frames start:stop, laid out as their stacked slices.
+
+    @param term None, a number, an array laid out as one frame (or one of its slices) shared by every
+                frame, or an array laid out as sinograms with the term of each frame
+    @param sinograms Sinograms of the study (frames, slices, ...)
+    @param start First frame of the batch
+    @param stop Frame after the last one of the batch
+    @param name Name of the term in the error messages
+
+    @return Array (frames * slices, ...), or None
+    """
+    if term is None:
+        return None
+    term = np.asarray(term, dtype=np.float64)
+    if term.shape == tuple(sinograms.shape):
+        term = term[start:stop]
+        if np.any(term < 0):
+            raise ValueError(f"The {name} cannot be negative")
+        return np.ascontiguousarray(term.reshape((-1,) + tuple(sinograms.shape[2:])))
+    term = correction_term(term, np.empty(sinograms.shape[1:]), None, name)
+    return np.concatenate([term] * (stop - start))
+
+
+def stream_frames(sinograms, reconstruct, frame_shape, image_shape, frames_per_batch=1, output=None, additive=None,
+                  on_frame=None):
+    """
+    @brief Reconstructs the frames batch by batch and writes each one to the output as soon as its batch is done.
+
+    @param sinograms Sinograms of the study (frames, *frame_shape), an array, memmap or h5py dataset
+    @param reconstruct Function reconstruct(stack, start, stop, additive) returning the volume
+                       (frames * slices, *image_shape) of the stacked slices of the frames start:stop
+    @param frame_shape Shape of the sinogram stack of one frame (slices, ...)
+    @param image_shape Shape of each reconstructed slice
+    @param frames_per_batch Number of frames reconstructed together
+    @param output Receives the frames (see frame_output)
+    @param additive Additive term (see frame_term)
+    @param on_frame Function called as on_frame(frame, volume) after each frame is written
+
+    @return output, (frames, slices, *image_shape)
+    """
+    if sinograms.ndim != len(frame_shape) + 1 or tuple(sinograms.shape[1:]) != tuple(frame_shape):
+        raise ValueError(f"The frames must be laid out as the sinogram of the reconstructor {tuple(frame_shape)}")
+    if frames_per_batch < 1:
+        raise ValueError("frames_per_batch must be at least 1")
+    frames, slices = sinograms.shape[0], frame_shape[0]
+    output = frame_output(output, (frames, slices) + tuple(image_shape))
+    for start in range(0, frames, frames_per_batch):
+        stop = min(start + frames_per_batch, frames)
+        stack = np.asarray(sinograms[start:stop], dtype=np.float64).reshape((-1,) + tuple(frame_shape[1:]))
+        volume = reconstruct(stack, start, stop, frame_term(additive, sinograms, start, stop, "additive term"))
+        for frame in range(start, stop):
+            output[frame] = volume[(frame - start) * slices:(frame - start + 1) * slices]
+            # memmap: o quadro vai para o disco antes do próximo lote
+            if hasattr(output, "flush"):
+                output.flush()
+            if on_frame is not None:
+                on_frame(frame, output[frame])
+    return output
@@ -0,0 +1,327 @@
+import numpy as np
+from numba import njit
+
+from GimnTools.ImaGIMN.gimnRec.projectors import direct_radon, project_events
+from GimnTools.ImaGIMN.gimnRec.backprojectors import inverse_radon, backproject_events
+
+
+# @file em_kernels.py
+# @brief Compiled MLEM/OSEM loops of a single slice.
+# @details The kernels are compiled with nogil=True, so while a slice is being reconstructed the
+# interpreter lock is released and other threads can reconstruct other slices at the same time,
+# all of them reading the same system matrix and plan without any copy. The estimate is updated
+# in place, which also lets the caller run the loop one iteration at a time; the projection that
+# each iteration computes is written to an output array, so monitoring needs no extra projection.
+# The expected counts are w A x + r, with w the multiplicative weights of each bin (attenuation,
+# normalization) and r the additive term (randoms and scatter) of the measured sinogram, so the
+# corrections are modelled in the ratio w y / (w A x + r) instead of applied to y; the sensitivity
+# images passed to the kernels are then the backprojections of w (see ReconstructionPlan.weighted).
+
+
+_FLOAT_MAX = 1.7976931348623157e308
+
+
+@njit(nogil=True)
+def mlem_system_matrix_kernel(sys_mat, sino, additive, weights, sens, iterations, recon, projection):
+    """
+    @brief MLEM iterations with an explicit system matrix.
+
+    @param sys_mat System matrix with shape (nrd * nphi, nxd * nxd)
+    @param sino Flat sinogram of the slice, ordered as the rows of sys_mat
+    @param additive Additive term of the model (randoms and scatter), ordered as sino; zeros for none
+    @param weights Multiplicative weights of the model (attenuation, normalization), ordered as sino; ones for none
+    @param sens Flat sensitivity image
+    @param iterations Number of iterations
+    @param recon Flat estimate, updated in place
+    @param projection Receives the projection computed by the last iteration
+    """
+    for it in range(iterations):
+        fpsino = weights * np.dot(sys_mat, recon) + additive
+        projection[:] = fpsino
+        ratio = weights * sino / (fpsino + 1.0e-9)
+        recon *= np.dot(sys_mat.T, ratio) / (sens + 1e-9)
+
+
+@njit(nogil=True)
+def osem_system_matrix_kernel(sys_mat, sino, additive, weights, bounds, subset_sens, iterations, recon, projection):
+    """
+    @brief OSEM iterations with an explicit system matrix.
+
+    @param sys_mat System matrix with shape (nrd * nphi, nxd * nxd)
+    @param sino Flat sinogram of the slice, ordered as the rows of sys_mat
+    @param additive Additive term of the model (randoms and scatter), ordered as sino; zeros for none
+    @param weights Multiplicative weights of the model (attenuation, normalization), ordered as sino; ones for none
+    @param bounds Array (subsets, 2) with the first and last + 1 rows of each subset
+    @param subset_sens Flat sensitivity image of each subset, shape (subsets, nxd * nxd)
+    @param iterations Number of iterations
+    @param recon Flat estimate, updated in place
+    @param projection Receives the subset projections computed by the last iteration
+    """
+    for it in range(iterations):
+        for ss in range(bounds.shape[0]):
+            start = bounds[ss, 0]
+            stop = bounds[ss, 1]
+            sub_mat = sys_mat[start:stop]
+            fpsino = weights[start:stop] * np.dot(sub_mat, recon) + additive[start:stop]
+            projection[start:stop] = fpsino
+            ratio = weights[start:stop] * sino[start:stop] / (fpsino + 1e-12)
+            recon *= np.dot(sub_mat.T, ratio) / (subset_sens[ss] + 1e-12)
+
+
+@njit(nogil=True)
+def osem_system_matrix_rows_kernel(sys_mat, sino, additive, weights, rows, offsets, subset_sens, iterations, recon, projection):
+    """
+    @brief OSEM iterations with an explicit system matrix and subsets of non-contiguous rows.
+
+    The rows of each subset are read in place, one at a time, so interleaved subsets need no
+    copy of the system matrix.
+
+    @param sys_mat System matrix with shape (nrd * nphi, nxd * nxd)
+    @param sino Flat sinogram of the slice, ordered as the rows of sys_mat
+    @param additive Additive term of the model (randoms and scatter), ordered as sino; zeros for none
+    @param weights Multiplicative weights of the model (attenuation, normalization), ordered as sino; ones for none
+    @param rows System matrix rows of all the subsets, one subset after the other
+    @param offsets Position in rows where each subset starts, with the total length at the end
+    @param subset_sens Flat sensitivity image of each subset, shape (subsets, nxd * nxd)
+    @param iterations Number of iterations
+    @param recon Flat estimate, updated in place
+    @param projection Receives the subset projections computed by the last iteration
+    """
+    back = np.zeros_like(recon)
+    for it in range(iterations):
+        for ss in range(offsets.size - 1):
+            back[:] = 0.0
+            for r in rows[offsets[ss]:offsets[ss + 1]]:
+                row = sys_mat[r]
+                fp = weights[r] * np.dot(row, recon) + additive[r]
+                projection[r] = fp
+                back += row * (weights[r] * sino[r] / (fp + 1e-12))
+            recon *= back / (subset_sens[ss] + 1e-12)
+
+
+@njit(nogil=True)
+def mlem_line_integral_kernel(sinogram, additive, weights, angles, sens, iterations, recon, projection):
+    """
+    @brief MLEM iterations with the direct_radon / inverse_radon pair.
+
+    @param sinogram Sinogram of the slice, ordered (distances, angles)
+    @param additive Additive term of the model (randoms and scatter), ordered as sinogram; zeros for none
+    @param weights Multiplicative weights of the model (attenuation, normalization), ordered as sinogram; ones for none
+    @param angles Projection angles in degrees
+    @param sens Sensitivity image
+    @param iterations Number of iterations
+    @param recon Estimate, updated in place
+    @param projection Receives the projection computed by the last iteration
+    """
+    rows, cols = sinogram.shape
+    for it in range(iterations):
+        proj = weights * direct_radon(np.abs(recon), angles) + additive
+        projection[:, :] = proj
+        diff = weights * sinogram / (proj + 1e-10)
+        for i in range(rows):
+            for j in range(cols):
+                value = diff[i, j]
+                if np.isnan(value):
+                    diff[i, j] = 0.0
+                elif value > 100:
+                    diff[i, j] = 1.0
+                elif np.isinf(value):
+                    diff[i, j] = -_FLOAT_MAX
+        back = inverse_radon(diff, angles)
+        for i in range(back.shape[0]):
+            for j in range(back.shape[1]):
+                value = back[i, j]
+                if np.isnan(value):
+                    value = 1.0
+                elif np.isinf(value):
+                    value = _FLOAT_MAX
+                recon[i, j] *= abs(value)
+        recon /= (sens + 1e-9)
+
+
+@njit(nogil=True)
+def osem_line_integral_kernel(sinogram, additive, weights, angles, order, offsets, iterations, recon, projection):
+    """
+    @brief OSEM iterations with the direct_radon / inverse_radon pair.
+
+    The division by the sensitivity image is left to the caller, as in the original algorithm.
+
+    @param sinogram Sinogram of the slice, ordered (distances, angles)
+    @param additive Additive term of the model (randoms and scatter), ordered as sinogram; zeros for none
+    @param weights Multiplicative weights of the model (attenuation, normalization), ordered as sinogram; ones for none
+    @param angles Projection angles in degrees
+    @param order Angle indices of all the subsets, one subset after the other
+    @param offsets Position in order where each subset starts, with the total length at the end
+    @param iterations Number of iterations
+    @param recon Estimate, updated in place
+    @param projection Receives the subset projections computed by the last iteration
+    """
+    rows = sinogram.shape[0]
+    for it in range(iterations):
+        for ss in range(offsets.size - 1):
+            indices = order[offsets[ss]:offsets[ss + 1]]
+            angles_subset = angles[indices]
+            rec_sub = weights[:, indices] * direct_radon(recon, angles_subset) + additive[:, indices]
+            coef = weights[:, indices] * sinogram[:, indices] / (rec_sub + 1e-10)
+            for i in range(rows):
+                for j in range(indices.size):
+                    projection[i, indices[j]] = rec_sub[i, j]
+                    if coef[i, j] > 1000:
+                        coef[i, j] = 1.0
+            recon *= np.abs(inverse_radon(coef, angles_subset))
+
+
+@njit(nogil=True)
+def mlem_system_matrix_batch_kernel(sys_mat, sinos, additive, weights, sens, iterations, recons, projection):
+    """
+    @brief MLEM iterations of all the slices at once, with the slices as matrix columns.
+
+    Each iteration reads the system matrix once for every slice, as two matrix-matrix products.
+
+    @param sys_mat System matrix with shape (nrd * nphi, nxd * nxd)
+    @param sinos Sinograms with shape (nrd * nphi, slices), one flat slice per column
+    @param additive Additive terms of the model, laid out as sinos; zeros for none
+    @param weights Multiplicative weights of the model, laid out as sinos; ones for none
+    @param sens Flat sensitivity images with shape (nxd * nxd, 1), or (nxd * nxd, slices) with weights
+    @param iterations Number of iterations
+    @param recons Estimates with shape (nxd * nxd, slices), updated in place
+    @param projection Receives the projections computed by the last iteration
+    """
+    for it in range(iterations):
+        fpsino = weights * np.dot(sys_mat, recons) + additive
+        projection[:, :] = fpsino
+        ratio = weights * sinos / (fpsino + 1.0e-9)
+        recons *= np.dot(sys_mat.T, ratio) / (sens + 1e-9)
+
+
+@njit(nogil=True)
+def osem_system_matrix_batch_kernel(sys_mat, sinos, additive, weights, bounds, subset_sens, iterations, recons, projection):
+    """
+    @brief OSEM iterations of all the slices at once, with the slices as matrix columns.
+
+    @param sys_mat System matrix with shape (nrd * nphi, nxd * nxd)
+    @param sinos Sinograms with shape (nrd * nphi, slices), one flat slice per column
+    @param additive Additive terms of the model, laid out as sinos; zeros for none
+    @param weights Multiplicative weights of the model, laid out as sinos; ones for none
+    @param bounds Array (subsets, 2) with the first and last + 1 rows of each subset
+    @param subset_sens Sensitivity images of the subsets, shape (subsets, nxd * nxd, 1), or (subsets, nxd * nxd, slices) with weights
+    @param iterations Number of iterations
+    @param recons Estimates with shape (nxd * nxd, slices), updated in place
+    @param projection Receives the subset projections computed by the last iteration
+    """
+    for it in range(iterations):
+        for ss in range(bounds.shape[0]):
+            start = bounds[ss, 0]
+            stop = bounds[ss, 1]
+            sub_mat = sys_mat[start:stop]
+            fpsino = weights[start:stop] * np.dot(sub_mat, recons) + additive[start:stop]
+            projection[start:stop, :] = fpsino
+            ratio = weights[start:stop] * sinos[start:stop] / (fpsino + 1e-12)
+            recons *= np.dot(sub_mat.T, ratio) / (subset_sens[ss] + 1e-12)
+
+
+@njit(nogil=True)
+def osem_system_matrix_rows_batch_kernel(sys_mat, sinos, additive, weights, rows, offsets, subset_sens, iterations, recons,
+                                         projection):
+    """
+    @brief OSEM iterations of all the slices at once with subsets of non-contiguous rows.
+
+    The rows of each subset are read in place, one at a time, as in osem_system_matrix_rows_kernel,
+    with the slices as matrix columns, so interleaved subsets need no copy of the system matrix.
+
+    @param sys_mat System matrix with shape (nrd * nphi, nxd * nxd)
+    @param sinos Sinograms with shape (nrd * nphi, slices), one flat slice per column
+    @param additive Additive terms of the model, laid out as sinos; zeros for none
+    @param weights Multiplicative weights of the model, laid out as sinos; ones for none
+    @param rows System matrix rows of all the subsets, one subset after the other
+    @param offsets Position in rows where each subset starts, with the total length at the end
+    @param subset_sens Sensitivity images of the subsets, shape (subsets, nxd * nxd, 1), or (subsets, nxd * nxd, slices) with weights
+    @param iterations Number of iterations
+    @param recons Estimates with shape (nxd * nxd, slices), updated in place
+    @param projection Receives the subset projections computed by the last iteration
+    """
+    back = np.zeros_like(recons)
+    for it in range(iterations):
+        for ss in range(offsets.size - 1):
+            back[:] = 0.0
+            for r in rows[offsets[ss]:offsets[ss + 1]]:
+                row = sys_mat[r]
+                fp = weights[r] * np.dot(row, recons) + additive[r]
+                projection[r] = fp
+                ratio = weights[r] * sinos[r] / (fp + 1e-12)
+                # back += row^T ratio, produto externo da linha com as fatias
+                for p in range(row.size):
+                    if row[p] != 0.0:
+                        back[p] += row[p] * ratio
+            recons *= back / (subset_sens[ss] + 1e-12)
+
+
+@njit(nogil=True)
+def os_pass_line_integral_kernel(sinogram, additive, weights, angles, order, offsets, subset_sens, recon, projection):
+    """
+    @brief One pass over all the subsets of the ordered-subsets EM update with direct_radon / inverse_radon.
+
+    Unlike osem_line_integral_kernel every subset update is normalized by its own sensitivity image,
+    x <- x * A_s^T(w_s y_s / (w_s A_s x + r_s)) / A_s^T w_s, so one pass with a single subset is an MLEM iteration.
+
+    @param sinogram Sinogram of the slice, ordered (distances, angles)
+    @param additive Additive term of the model (randoms and scatter), ordered as sinogram; zeros for none
+    @param weights Multiplicative weights of the model (attenuation, normalization), ordered as sinogram; ones for none
+    @param angles Projection angles in degrees
+    @param order Angle indices of all the subsets, one subset after the other
+    @param offsets Position in order where each subset starts, with the total length at the end
+    @param subset_sens Sensitivity image of each subset, shape (subsets, nxd, nxd)
+    @param recon Estimate, updated in place
+    @param projection Receives the subset projections computed by the pass
+    """
+    rows = sinogram.shape[0]
+    for ss in range(offsets.size - 1):
+        indices = order[offsets[ss]:offsets[ss + 1]]
+        angles_subset = angles[indices]
+        rec_sub = weights[:, indices] * direct_radon(recon, angles_subset) + additive[:, indices]
+        ratio = np.zeros_like(rec_sub)
+        for i in range(rows):
+            for j in range(indices.size):
+                projection[i, indices[j]] = rec_sub[i, j]
+                if rec_sub[i, j] > 0:
+                    ratio[i, j] = weights[i, indices[j]] * sinogram[i, indices[j]] / rec_sub[i, j]
+        recon *= inverse_radon(ratio, angles_subset) / (subset_sens[ss] + 1e-9)
+
+
+@njit(nogil=True)
+def osem_list_mode_kernel(offsets, angles, weights, bounds, sens, iterations, recon, projection):
+    """
+    @brief List-mode OSEM iterations with the project_events / backproject_events pair.
+
+    Only the lines of response of the detected events are projected and backprojected. The events
+    are split in subsets along the stream, every subset sees the whole scanner, so its sensitivity
+    is sens / subsets; a single subset is list-mode MLEM.
+
+    @param offsets Radial position of each event, in pixels from the centre of the image
+    @param angles Angle of each event, in degrees
+    @param weights Counts of each event (1 for a pure list)
+    @param bounds Array (subsets, 2) with the first and last + 1 events of each subset
+    @param sens Sensitivity image A^T 1 of all the lines of response of the acquisition
+    @param iterations Number of iterations
+    @param recon Estimate, updated in place
+    @param projection Receives the event projections computed by the last iteration
+    """
+    subset_sens = sens / bounds.shape[0]
+    back = np.zeros_like(recon)
+    for it in range(iterations):
+        for ss in range(bounds.shape[0]):
+            start = bounds[ss, 0]
+            stop = bounds[ss, 1]
+            project_events(recon, offsets[start:stop], angles[start:stop], projection[start:stop])
+            ratio = np.zeros(stop - start)
+            for e in range(stop - start):
+                if projection[start + e] > 0:
+                    ratio[e] = weights[start + e] / projection[start + e]
+            back[:, :] = 0.0
+            backproject_events(back, offsets[start:stop], angles[start:stop], ratio)
+            for i in range(recon.shape[0]):
+                for j in range(recon.shape[1]):
+                    if subset_sens[i, j] > 0:
+                        recon[i, j] *= back[i, j] / subset_sens[i, j]
+                    else:
+                        recon[i, j] = 0.0
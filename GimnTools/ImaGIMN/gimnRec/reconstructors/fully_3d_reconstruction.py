@@ -0,0 +1,142 @@
+import numpy as np
+
+from GimnTools.ImaGIMN.gimnRec.projectors import project_oblique_segment
+from GimnTools.ImaGIMN.gimnRec.backprojectors import backproject_oblique_segment
+from GimnTools.ImaGIMN.gimnRec.reconstruction_plan import cached_plan, make_geometry
+
+
+# @file fully_3d_reconstruction.py
+# @brief Fully 3D MLEM/OSEM of an ObliqueSinogram.
+# @details The volume has one slice per detector ring and is projected segment by segment with
+# project_oblique_segment, so only the projection of one segment (and one subset of angles) is
+# held in memory at a time. The subsets of angles come from the ReconstructionPlan of the 2D
+# engines, and the sensitivity volume of each subset is computed once per plan.
+
+
+class fully_3d_reconstructor:
+    """
+    @brief Reconstructs a volume from all the segments of an ObliqueSinogram.
+
+    The transaxial geometry is the one of line_integral_reconstructor (distance bins equal to the
+    pixels of the image); the axial voxel is the ring pitch.
+    """
+
+    def __init__(self, oblique, radius):
+        """
+        @brief Stores the oblique sinogram and the detector geometry.
+
+        @param oblique ObliqueSinogram to reconstruct
+        @param radius Radius of the detector, in pixels; must be larger than half the image size
+        """
+        if radius <= (oblique.distances - 1) / 2:
+            raise ValueError("The detector radius must be larger than half the image size")
+        self.__oblique = oblique
+        self.__radius = float(radius)
+        self.__plans = {}
+        self.__sensitivities = {}
+
+    @property
+    def oblique(self):
+        """
+        @brief Returns the oblique sinogram being reconstructed.
+        """
+        return self.__oblique
+
+    @property
+    def radius(self):
+        """
+        @brief Returns the radius of the detector, in pixels.
+        """
+        return self.__radius
+
+    def get_plan(self, angles, subsets=1):
+        """
+        @brief Returns the plan with the subsets of angles, computed only on the first call.
+
+        @param angles Angles of the sinogram, in degrees
+        @param subsets Number of subsets
+
+        @return ReconstructionPlan of the "line_integral" engine
+        """
+        return cached_plan(self.__plans, make_geometry(self.__oblique.distances), angles, subsets, "line_integral")
+
+    def subset_sensitivity(self, plan):
+        """
+        @brief Returns the sensitivity volume A_s^T 1 of each subset of the plan, over all segments.
+
+        @param plan ReconstructionPlan given by get_plan
+        @return Array (subsets, rings, pixels, pixels)
+        """
+        if plan.key not in self.__sensitivities:
+            rings, size = self.__oblique.rings, self.__oblique.distances
+            sens = np.zeros((plan.subsets, rings, size, size))
+            for ss, angles in enumerate(plan.subset_angles):
+                for d in self.__oblique.ring_differences:
+                    ones = np.ones((rings - abs(d), size, angles.size))
+                    backproject_oblique_segment(sens[ss], ones, angles, d, self.__radius)
+            self.__sensitivities[plan.key] = sens
+        return self.__sensitivities[plan.key]
+
+    def forward_project(self, volume, angles):
+        """
+        @brief Projects a volume on every segment of the oblique sinogram.
+
+        @param volume Volume (rings, pixels, pixels)
+        @param angles Angles, in degrees
+
+        @return Dictionary {ring difference: segment (rings - |d|, pixels, angles)}
+        """
+        projection = {}
+        for d in self.__oblique.ring_differences:
+            projection[d] = np.zeros((self.__oblique.rings - abs(d), volume.shape[1], len(angles)))
+            project_oblique_segment(volume, np.asarray(angles, dtype=np.float64), d, self.__radius, projection[d])
+        return projection
+
+    def osem(self, iterations, subsets_n, angles, verbose=False, plan=None):
+        """
+        @brief Reconstructs the oblique sinogram with fully 3D OSEM.
+
+        For every subset the segments are projected and backprojected one at a time.
+
+        @param iterations Number of iterations
+        @param subsets_n Number of subsets of angles
+        @param angles Angles of the sinogram, in degrees
+        @param verbose Flag to print the iteration number during reconstruction
+        @param plan ReconstructionPlan to be used, by default the cached plan of angles and subsets_n
+
+        @return Reconstructed volume (rings, pixels, pixels)
+        """
+        if plan is None:
+            plan = self.get_plan(angles, subsets_n)
+        subset_sens = self.subset_sensitivity(plan)
+        rings, size = self.__oblique.rings, self.__oblique.distances
+        volume = np.ones((rings, size, size))
+        back = np.zeros_like(volume)
+        for it in range(iterations):
+            if verbose:
+                print(f"iteration {it + 1}")
+            for ss, indices in enumerate(plan.subset_indices):
+                angles_subset = plan.angles[indices]
+                back[...] = 0.0
+                for d in self.__oblique.ring_differences:
+                    measured = self.__oblique.segment(d)[:, :, indices]
+                    projection = np.zeros(measured.shape)
+                    project_oblique_segment(volume, angles_subset, d, self.__radius, projection)
+                    ratio = np.divide(measured, projection, out=np.zeros_like(projection), where=projection > 0)
+                    backproject_oblique_segment(back, ratio, angles_subset, d, self.__radius)
+                sens = subset_sens[ss]
+                volume = np.divide(volume * back, sens, out=np.zeros_like(volume), where=sens > 0)
+        return volume
+
+    def mlem(self, iterations, angles, verbose=False, plan=None):
+        """
+        @brief Reconstructs the oblique sinogram with fully 3D MLEM, that is, OSEM with a single subset.
+
+        @param iterations Number of iterations
+        @param angles Angles of the sinogram, in degrees
+        @param verbose Flag to print the iteration number during reconstruction
+        @param plan ReconstructionPlan to be used, by default the cached plan of angles
+
+        @return Reconstructed volume (rings, pixels, pixels)
+        """
+        return self.osem(iterations, 1, angles, verbose, plan)
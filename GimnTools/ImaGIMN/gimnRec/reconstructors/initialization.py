@@ -0,0 +1,80 @@
+import numpy as np
+
+
+# @file initialization.py
+# @brief Initial estimate of the iterative reconstructions (init= of the reconstructors).
+# @details The iterations start from a uniform image by default, and the first ones only recover
+# the low frequencies of the object. init="fbp" starts from the FBP of each slice instead, clipped
+# to positive values and scaled so that its projection has the counts of the sinogram; an array
+# starts from the given images.
+
+
+def initial_estimate(init, fbp_volume, project, sinogram, image_shape, floor=1e-3):
+    """
+    @brief Initial estimate of every slice of an iterative reconstruction.
+
+    Each slice of the clipped FBP is scaled so that the counts of its projection, with the
+    projector of the reconstruction, are the counts of its sinogram. Its pixels are kept above floor
+    times the maximum of the slice, because an EM update never changes a pixel that is zero.
+
+    @param init None for the uniform image, "fbp" or an array with the image of each slice (or one
+                image used by every slice)
+    @param fbp_volume Function returning the FBP of the stack (slices, *image_shape), called only for "fbp"
+    @param project Function returning the projection of one image, used only for "fbp"
+    @param sinogram Sinogram stack, the first dimension is the slice
+    @param image_shape Shape of each reconstructed slice
+    @param floor Fraction of the maximum of each slice below which the FBP is raised
+
+    @return Array (slices, *image_shape), or None for the uniform image
+    """
+    if init is None:
+        return None
+    slices = sinogram.shape[0]
+    if isinstance(init, str):
+        if init != "fbp":
+            raise ValueError(f"Unknown initial estimate: {init}")
+        volume = np.maximum(np.reshape(fbp_volume(), (slices,) + tuple(image_shape)), 0.0)
+        return scale_to_counts(volume, sinogram, project, floor)
+    init = np.asarray(init, dtype=np.float64)
+    if init.shape != (slices,) + tuple(image_shape) and init.shape != tuple(image_shape):
+        raise ValueError(f"The initial estimate must have shape {(slices,) + tuple(image_shape)} or {tuple(image_shape)}")
+    return np.array(np.broadcast_to(init, (slices,) + tuple(image_shape)))
+
+
+def corrected_sinogram(sinogram, additive=None, weights=None):
+    """
+    @brief Sinogram of the image alone, (y - r) / w, used where the model cannot be (the FBP and the count scaling).
+
+    @param sinogram Sinogram stack
+    @param additive Additive term laid out as sinogram, None for none
+    @param weights Multiplicative weights laid out as sinogram, None for none; bins of weight zero are zero
+    @return Sinogram stack (sinogram itself when there are no corrections)
+    """
+    if additive is None and weights is None:
+        return sinogram
+    sinogram = np.asarray(sinogram, dtype=np.float64)
+    if additive is not None:
+        sinogram = sinogram - additive
+    if weights is not None:
+        sinogram = np.divide(sinogram, weights, out=np.zeros_like(sinogram), where=weights > 0)
+    return sinogram
+
+
+def scale_to_counts(volume, sinogram, project, floor=0.0):
+    """
+    @brief Scales each slice so that the counts of its projection are the counts of its sinogram.
+
+    @param volume Stack of positive images (slices, ...), scaled in place
+    @param sinogram Sinogram stack, the first dimension is the slice
+    @param project Function returning the projection of one image
+    @param floor Fraction of the maximum of each slice below which the pixels are raised
+
+    @return volume
+    """
+    for slice_z in range(volume.shape[0]):
+        counts = np.sum(sinogram[slice_z])
+        expected = np.sum(project(volume[slice_z]))
+        volume[slice_z] *= counts / expected if expected > 0 else 0.0
+        if floor > 0:
+            volume[slice_z] = np.maximum(volume[slice_z], floor * volume[slice_z].max())
+    return volume
@@ -4,10 +4,22 @@ from GimnTools.ImaGIMN.gimnRec.projectors import *
 from GimnTools.ImaGIMN.gimnRec.reconstruction_filters import *
 from GimnTools.ImaGIMN.processing.interpolators.reconstruction import *
 from GimnTools.ImaGIMN.gimnRec.corrections import *
-
-
-
-class line_integral_reconstructor(image):
+from GimnTools.ImaGIMN.gimnRec.reconstruction_plan import cached_plan, make_geometry
+from GimnTools.ImaGIMN.gimnRec.reconstructors.slice_parallel import reconstruct_slices
+from GimnTools.ImaGIMN.gimnRec.reconstructors.reconstructor_settings import reconstructor_settings
+from GimnTools.ImaGIMN.gimnRec.iteration_control import iteration_monitor, monitored_result
+from GimnTools.ImaGIMN.gimnRec.subset_schedule import subset_schedule
+from GimnTools.ImaGIMN.gimnRec.reconstructors.multiresolution import multigrid_estimate, multigrid_levels
+from GimnTools.ImaGIMN.gimnRec.reconstructors.dynamic import frame_term, stream_frames
+from GimnTools.ImaGIMN.gimnRec.reconstructors.em_kernels import mlem_line_integral_kernel, osem_line_integral_kernel
+from GimnTools.ImaGIMN.gimnRec.reconstructors.em_kernels import os_pass_line_integral_kernel
+from GimnTools.ImaGIMN.gimnRec.reconstructors.acceleration import momentum_em
+from GimnTools.ImaGIMN.gimnRec.reconstructors import map_em
+from GimnTools.ImaGIMN.gimnRec.priors import tv_gradient
+
+
+
+class line_integral_reconstructor(reconstructor_settings, image):
     """
     @brief Creates a Reconstructor class that will inherit the image class.
 
@@ -28,7 +40,7 @@ class line_integral_reconstructor(image):
     __reconstructed_osem = None
     __reconstructed_fbp = None
 
-    def __init__(self, sinogram, center_of_rotation=None):
+    def __init__(self, sinogram, center_of_rotation=None, workers=1, backend="process"):
         """
         @brief Constructs the reconstructor class, it will initiate the super class of reconstructor, that inherits an image class.
 
@@ -39,9 +51,12 @@ class line_integral_reconstructor(image):
         @param sinogram_order Order of the sinogram dimensions, default is ("slice", "angles", "distances")
         @param center_of_rotation Center of rotation
         @param transpose Flag to transpose the sinogram
+        @param workers Number of workers used to reconstruct the slices in parallel
+        @param backend Kind of worker, "process" or "thread" (see set_workers)
         """
         super(line_integral_reconstructor, self).__init__(image=sinogram)
         self.__sinogram = sinogram
+        self._init_settings(workers, backend)
 
     @property
     def sinogram(self):
@@ -75,8 +90,77 @@ class line_integral_reconstructor(image):
         """
         self.__center_of_rotation = center_of_rotation
 
+    def get_plan(self, angles, subsets=1):
+        """
+        @brief Returns the reconstruction plan for the given angles and subsets.
+
+        The plan is computed only on the first call and shared by every slice, algorithm and
+        later call with the same geometry.
+
+        @param angles Angles for reconstruction, in degrees
+        @param subsets Number of subsets
+
+        @return ReconstructionPlan of the "line_integral" engine
+        """
+        return cached_plan(self.plans, make_geometry(self.sinogram.shape[1]), angles, subsets, "line_integral",
+                           ordering=self.subset_ordering)
+
+    def get_schedule_plans(self, schedule, plan):
+        """
+        @brief Returns the plans of every number of subsets used by a subset schedule.
+
+        The plans come from the plan cache, so they share the geometry (and system matrix) of plan
+        and are computed only once.
+
+        @param schedule SubsetSchedule
+        @param plan Plan of the number of subsets of the call
+
+        @return Tuple of ReconstructionPlan, one per number of subsets
+        """
+        return tuple(plan if subsets == plan.subsets else self.get_plan(plan.angles, subsets)
+                     for subsets in schedule.subset_counts(plan.subsets))
+
+    def _fbp_volume(self, plan, sinogram):
+        """
+        @brief FBP of every slice with the Ram-Lak filter and the backprojector of the plan, without clipping.
+        """
+        return np.asarray([inverse_radon(apply_filter_to_sinogram(ramLak, sino), plan.angles)
+                           for sino in np.asarray(sinogram, dtype=np.float64)])
+
+    def _project_slice(self, image, plan):
+        """
+        @brief Projection of one image with the projector of the plan.
+        """
+        return direct_radon(image, plan.angles)
+
+    def get_multigrid_estimate(self, multigrid, plan, sinogram, init=None, additive=None, weights=None):
+        """
+        @brief Returns the initial estimate given by the coarse levels of a multigrid reconstruction.
+
+        @param multigrid True or a list of (factor, iterations) levels (see multiresolution.multigrid_levels)
+        @param plan Plan of the full grid; the levels use its subsets
+        @param sinogram Sinogram stack of the reconstructed slices
+        @param init Must be None, the coarsest level starts from the uniform image
+        @param additive Additive term of the selected slices (see get_additive)
+        @param weights Weights of the selected slices (see get_weights)
+
+        @return Array (slices, nxd, nxd)
+        """
+        if init is not None:
+            raise ValueError("multigrid and init cannot be used together")
+
+        def iterate(coarse, coarse_plan, iterations, estimate, coarse_additive, coarse_weights):
+            return reconstruct_slices(_osem_slice, coarse, (coarse_plan.nxd, coarse_plan.nxd), (coarse_plan, iterations),
+                                      self.workers, self.backend, init=estimate, additive=coarse_additive,
+                                      weights=coarse_weights)
 
-    def osem(self, iterations, subsets_n, angles, verbose=False, ):
+        return multigrid_estimate(multigrid_levels(multigrid), sinogram, plan, self.plans, 1, iterate, self._project_slice,
+                                  additive, weights)
+
+    def osem(self, iterations, subsets_n, angles, verbose=False, plan=None, on_iteration=None, tol=None, max_time=None,
+             checkpoint=None, checkpoint_every=None, checkpoint_seconds=None, resume=False,
+             save_iterates=None, iterates=None, schedule=None, init=None, slices=None, multigrid=None, additive=None,
+             weights=None):
         """
         @brief Reconstructs the sinogram using the Ordered Subset Expectation Maximization (OSEM) algorithm for a given number of iterations.
 
@@ -84,52 +168,55 @@ class line_integral_reconstructor(image):
 
         @param iterations Number of iterations
         @param subsets_n Number of subsets
-        @param interpolation Interpolator to be used, can be: linear_interpolation, beta_spline_interpolation, bilinear_interpolation, or beta_spline_interpolation_o5
-        @param angles Angles for reconstruction, should be a numpy array of angles in radians
+        @param angles Angles for reconstruction, should be a numpy array of angles in degrees
         @param verbose Flag to print the iteration number during reconstruction
+        @param plan ReconstructionPlan to be used, by default the cached plan of angles and subsets_n
+        @param on_iteration Function called as on_iteration(state) after each iteration (see IterationState)
+        @param tol Stops a slice when the relative change of its estimate is below tol
+        @param max_time Stops the iterations after max_time seconds
+        @param checkpoint Directory where the checkpoints of the slices are written
+        @param checkpoint_every Writes a checkpoint every checkpoint_every iterations (1 if neither this nor checkpoint_seconds is given)
+        @param checkpoint_seconds Writes a checkpoint every checkpoint_seconds seconds
+        @param resume Continues from the checkpoints (True uses checkpoint, or the directory to resume from)
+        @param save_iterates Iterations (counted from 1) whose estimates are captured; the method then returns (rec, iterates)
+        @param iterates Array or h5py dataset (len(save_iterates), slices, nxd, nxd) that receives them, allocated when None
+        @param schedule Subset schedule: list of (iterations, subsets) stages, "adaptive" or a SubsetSchedule;
+                        None keeps subsets_n subsets in every iteration
+        @param init Initial estimate: None for the uniform image, "fbp" for the positive FBP scaled to the
+                    counts of each slice, or an array (slices, nxd, nxd) or (nxd, nxd)
+        @param slices Indices of the slices to reconstruct (list, array or slice), None for all; the others are skipped
+        @param multigrid Coarse-to-fine start: True or a list of (factor, iterations) levels run before the iterations
+                         at full resolution, on grids factor times coarser (see multiresolution.multigrid_levels)
+        @param additive Additive term (randoms and scatter) of the expected counts, y / (A x + r) in the updates:
+                        a number or an array laid out as the sinogram (see get_additive)
+        @param weights Multiplicative weights of the expected counts w A x + r (normalization, other corrections): a number
+                       or an array laid out as the sinogram (see get_weights); the attenuation of set_attenuation is
+                       always included
 
         @return Reconstructed image using the OSEM algorithm
         """
-        from matplotlib import pyplot as plt
-        slices = self.sinogram.shape[0]
-        pixels = self.sinogram.shape[1]
-        rec = np.ones((self.sinogram.shape[0], self.sinogram.shape[1], self.sinogram.shape[1]))
-        slice_count = self.slice_n()
-
-        sino_ones = np.ones_like(self.sinogram[0])
-        sens_image = inverse_radon(sino_ones,angles)
-
-
-
-        for slice_z in range(slices):
-
-            sinogram = self.sinogram[slice_z, :, :]
-            angles_subset = np.array_split(angles, subsets_n)
-            subsets = np.array_split(sinogram, subsets_n, axis=1)
-            reconstruction = np.ones([pixels, pixels])
-
-            
-            for it in range(iterations):
-                
-                for i, subset in enumerate(subsets):
-                    #aqui ele vai pegar a imagem estimada, e projetar apenas nos angulos do subset desejado
-                    rec_sub = direct_radon(reconstruction, angles_subset[i])
-                    #calcula-se a razão do subset pelo subset estimado nesta iteração
-                    coef = (subset / (rec_sub+1e-10))
-
-                    # isso daqui ta pra quando um pixel cresce demais, ele volta pra um, pra nao estragar. 
-                    coef[coef>1000]=1
-                    backprojection = np.abs(inverse_radon(coef, angles_subset[i]))
-                    reconstruction *= backprojection
-
-            
-            reconstruction = reconstruction/(sens_image+1e-9)
-
-            #reconstruction = (reconstruction/reconstruction.sum())*slice_count[slice_z]
-            rec[slice_z, :, :] = reconstruction
+        if plan is None:
+            plan = self.get_plan(angles, subsets_n)
+        sinogram = self.slice_sinogram(slices)
+        additive = self.get_additive(additive, slices)
+        weights = self.get_weights(weights, plan, slices)
+        monitor = iteration_monitor(on_iteration, tol, max_time, checkpoint, checkpoint_every,
+                                    checkpoint_seconds, resume, save_iterates, iterates)
+        if multigrid is None:
+            init = self.get_initial_estimate(init, plan, slices, additive, weights)
+        else:
+            init = self.get_multigrid_estimate(multigrid, plan, sinogram, init, additive, weights)
+        if schedule is None:
+            rec = reconstruct_slices(_osem_slice, sinogram, (plan.nxd, plan.nxd), (plan, iterations, monitor), self.workers, self.backend,
+                                     init=init, additive=additive, weights=weights)
+        else:
+            schedule = subset_schedule(schedule)
+            rec = reconstruct_slices(_scheduled_osem_slice, sinogram, (plan.nxd, plan.nxd),
+                                     (self.get_schedule_plans(schedule, plan), iterations, schedule, monitor),
+                                     self.workers, self.backend, init=init, additive=additive, weights=weights)
 
         self.__reconstructed_osem = rec
-        return rec
+        return monitored_result(rec, monitor)
 
     def fbp(self, filter_type, angles):
         """
@@ -184,122 +271,564 @@ class line_integral_reconstructor(image):
         # Additional normalization logic can be added here
         return norm
 
-    def mlem(self, iterations, angles, verbose=False):
+    def mlem(self, iterations, angles, verbose=False, plan=None, on_iteration=None, tol=None, max_time=None,
+             checkpoint=None, checkpoint_every=None, checkpoint_seconds=None, resume=False,
+             save_iterates=None, iterates=None, init=None, slices=None, multigrid=None, additive=None, weights=None):
         """
         @brief Reconstructs the sinogram using the Maximum Likelihood Expectation Maximization (MLEM) algorithm for a given number of iterations.
 
         This reconstruction is done using the rotations of the "reconstructed image" in order to obtain the projections.
 
         @param iterations Number of iterations
-        @param interpolation Interpolator to be used, can be: linear_interpolation, beta_spline_interpolation, bilinear_interpolation, or beta_spline_interpolation_o5
-        @param angles Angles for reconstruction, should be a numpy array of angles in radians
+        @param angles Angles for reconstruction, should be a numpy array of angles in degrees
         @param verbose Flag to print the iteration number during reconstruction
+        @param plan ReconstructionPlan to be used, by default the cached plan of angles
+        @param on_iteration Function called as on_iteration(state) after each iteration (see IterationState)
+        @param tol Stops a slice when the relative change of its estimate is below tol
+        @param max_time Stops the iterations after max_time seconds
+        @param checkpoint Directory where the checkpoints of the slices are written
+        @param checkpoint_every Writes a checkpoint every checkpoint_every iterations (1 if neither this nor checkpoint_seconds is given)
+        @param checkpoint_seconds Writes a checkpoint every checkpoint_seconds seconds
+        @param resume Continues from the checkpoints (True uses checkpoint, or the directory to resume from)
+        @param save_iterates Iterations (counted from 1) whose estimates are captured; the method then returns (rec, iterates)
+        @param iterates Array or h5py dataset (len(save_iterates), slices, nxd, nxd) that receives them, allocated when None
+        @param init Initial estimate: None for the uniform image, "fbp" for the positive FBP scaled to the
+                    counts of each slice, or an array (slices, nxd, nxd) or (nxd, nxd)
+        @param slices Indices of the slices to reconstruct (list, array or slice), None for all; the others are skipped
+        @param multigrid Coarse-to-fine start: True or a list of (factor, iterations) levels run before the iterations
+                         at full resolution, on grids factor times coarser (see multiresolution.multigrid_levels)
+        @param additive Additive term (randoms and scatter) of the expected counts, y / (A x + r) in the updates:
+                        a number or an array laid out as the sinogram (see get_additive)
+        @param weights Multiplicative weights of the expected counts w A x + r (normalization, other corrections): a number
+                       or an array laid out as the sinogram (see get_weights); the attenuation of set_attenuation is
+                       always included
 
         @return Reconstructed image using the MLEM algorithm
         """
         if self.sinogram is None:
             print("No sinogram Loaded")
             return -1
-        
-        slice_count = self.slice_n()
-        slices = self.sinogram.shape[0]
-        pixels = self.sinogram.shape[1]
-        rec = np.ones((self.sinogram.shape[0], self.sinogram.shape[1], self.sinogram.shape[1]))
-        #Generate a sinogram of ones for sensitivity image calculation
-        
 
-        sino_ones = np.ones_like(self.sinogram[0])
-        sens_image = inverse_radon(sino_ones,angles)
-        # Reshape the sinogram into 1D for subset processing
+        if plan is None:
+            plan = self.get_plan(angles)
+        sinogram = self.slice_sinogram(slices)
+        additive = self.get_additive(additive, slices)
+        weights = self.get_weights(weights, plan, slices)
+        monitor = iteration_monitor(on_iteration, tol, max_time, checkpoint, checkpoint_every,
+                                    checkpoint_seconds, resume, save_iterates, iterates)
+        if multigrid is None:
+            init = self.get_initial_estimate(init, plan, slices, additive, weights)
+        else:
+            init = self.get_multigrid_estimate(multigrid, plan, sinogram, init, additive, weights)
+        rec = reconstruct_slices(_mlem_slice, sinogram, (plan.nxd, plan.nxd), (plan, iterations, monitor), self.workers, self.backend,
+                                 init=init, additive=additive, weights=weights)
 
-        for slice_z in range(slices):
-            sinogram = self.sinogram[slice_z]
-            imagem_estimada = np.ones([pixels, pixels])
-            for it in range(iterations):
-                proje_estimada = direct_radon(np.abs(imagem_estimada),angles)   
-                diff = np.nan_to_num(sinogram / (proje_estimada+1e-10))
-                diff[diff>100] = 1
-                imagem_estimada *= np.abs(np.nan_to_num(inverse_radon(diff,angles),copy=True,nan=1))
-                imagem_estimada /= (sens_image+1e-9)
-                
-            #imagem_estimada = (imagem_estimada/imagem_estimada.sum())*slice_count[slice_z]
-            rec[slice_z, :, :] = imagem_estimada
-            
-            
         self.__reconstructed_mlem = rec
-        return rec
+        return monitored_result(rec, monitor)
 
-
-    def compute_tv_gradient(self, image, epsilon=1e-8):
+    def reconstruct_frames(self, sinograms, iterations, angles, subsets_n=1, output=None, frames_per_batch=4, plan=None,
+                           additive=None, weights=None, on_frame=None):
         """
-        Calcula o gradiente da TV usando diferenças para frente, evitando o efeito wrap-around.
+        @brief Reconstructs the time frames of a dynamic study with one plan, sensitivity and set of corrections.
+
+        Each frame is laid out as the sinogram stack of the reconstructor (e.g. built with the sum of
+        the frames). The frames of a batch are reconstructed together as extra slices, shared by the
+        workers, and each frame is written to output as soon as its batch is done.
+
+        @param sinograms Sinograms (frames, slices, distances, angles): an array, memmap or h5py dataset
+        @param iterations Number of iterations of every frame
+        @param angles Angles for reconstruction, in degrees
+        @param subsets_n 1 for MLEM, more for OSEM with subsets_n subsets
+        @param output None for an array in memory, the path of a .npy file written frame by frame, or an
+                      array or h5py dataset (frames, slices, nxd, nxd) (see dynamic.frame_output)
+        @param frames_per_batch Number of frames reconstructed together
+        @param plan ReconstructionPlan to be used, by default the cached plan of angles and subsets_n
+        @param additive Additive term: a number, an array laid out as one frame, shared by every frame, or
+                        laid out as sinograms with the term of each frame
+        @param weights Multiplicative weights shared by every frame (see get_weights); the attenuation and
+                       normalization of the reconstructor are included
+        @param on_frame Function called as on_frame(frame, volume) after each frame is written
+
+        @return output with the reconstructed frames
         """
-        grad = np.zeros_like(image)
-        # Diferenças para a direção x (vertical)
-        diff_x = np.zeros_like(image)
-        diff_x[:-1, :] = image[1:, :] - image[:-1, :]
-        # Diferenças para a direção y (horizontal)
-        diff_y = np.zeros_like(image)
-        diff_y[:, :-1] = image[:, 1:] - image[:, :-1]
+        if plan is None:
+            plan = self.get_plan(angles, subsets_n)
+        weights = self.get_weights(weights, plan)
+        function = _mlem_slice if plan.subsets == 1 else _osem_slice
+
+        def reconstruct(stack, start, stop, stack_additive):
+            return reconstruct_slices(function, stack, (plan.nxd, plan.nxd), (plan, iterations), self.workers, self.backend,
+                                      additive=stack_additive, weights=frame_term(weights, sinograms, start, stop, "weights"))
 
-        # Gradiente normalizado (suavização)
-        grad_x = diff_x / (np.abs(diff_x) + epsilon)
-        grad_y = diff_y / (np.abs(diff_y) + epsilon)
+        return stream_frames(sinograms, reconstruct, self.sinogram.shape, (plan.nxd, plan.nxd), frames_per_batch, output,
+                             additive, on_frame)
 
-        # Divergência dos gradientes
-        div_x = np.zeros_like(image)
-        div_y = np.zeros_like(image)
-        div_x[1:, :] = grad_x[1:, :] - grad_x[:-1, :]
-        div_y[:, 1:] = grad_y[:, 1:] - grad_y[:, :-1]
 
-        grad = div_x + div_y
-        return grad
+    def compute_tv_gradient(self, image, epsilon=1e-8, out=None):
+        """
+        Calcula o gradiente da TV anisotrópica suavizada (ver priors.tv_gradient), sem efeito wrap-around.
+        """
+        return tv_gradient(image, epsilon, out=out)
 
-    def osem_tv(self, iterations, subsets_n, angles, beta=0.2, tv_epsilon=1e-8, verbose=False):
+    def osem_tv(self, iterations, subsets_n, angles, beta=0.2, tv_epsilon=1e-8, verbose=False, plan=None,
+                on_iteration=None, tol=None, max_time=None, checkpoint=None, checkpoint_every=None,
+                checkpoint_seconds=None, resume=False, save_iterates=None, iterates=None, init=None, slices=None):
         """
         Reconstrução usando OSEM com regularização TV.
         
         Primeiro é aplicada a atualização OSEM e, em seguida, um passo de
         descida de gradiente é feito para reduzir o termo TV.
+
+        on_iteration, tol, max_time, checkpoint, checkpoint_every, checkpoint_seconds, resume, save_iterates e iterates:
+        monitoramento, critérios de parada, checkpoints e captura de iterações (ver mlem)
+        init: estimativa inicial (ver mlem); por padrão a retroprojeção do sinograma
+        slices: índices das fatias reconstruídas (ver mlem)
         """
-        slices = self.sinogram.shape[0]
-        pixels = self.sinogram.shape[1]
-        rec = np.zeros((slices, pixels, pixels))
-        slice_count = self.slice_n()
+        if plan is None:
+            plan = self.get_plan(angles, subsets_n)
+        sinogram = self.slice_sinogram(slices)
+        monitor = iteration_monitor(on_iteration, tol, max_time, checkpoint, checkpoint_every,
+                                    checkpoint_seconds, resume, save_iterates, iterates)
+        rec = reconstruct_slices(_osem_tv_slice, sinogram, (plan.nxd, plan.nxd),
+                                 (plan, iterations, beta, tv_epsilon, monitor), self.workers, self.backend,
+                                 init=self.get_initial_estimate(init, plan, slices))
+        return monitored_result(rec, monitor)
+
+    def accelerated_osem(self, iterations, subsets_n, angles, momentum="nesterov", relaxation=0.5, restart=True,
+                         plan=None, on_iteration=None, tol=None, max_time=None, checkpoint=None, checkpoint_every=None,
+                         checkpoint_seconds=None, resume=False, save_iterates=None, iterates=None, init=None, slices=None,
+                         additive=None, weights=None):
+        """
+        @brief Reconstructs the sinogram with OSEM (MLEM when subsets_n is 1) accelerated by momentum.
 
-        # Cálculo da sensibilidade
-        sino_ones = np.ones_like(self.sinogram[0])
-        sens_image = inverse_radon(sino_ones, angles)
-        sens_image = np.clip(sens_image, 1e-6, None)
+        Each iteration extrapolates the estimate along its last update and applies one OSEM pass of the
+        direct_radon / inverse_radon pair to the extrapolated point; the momentum is restarted whenever
+        the new update turns against the previous one (see acceleration.momentum_em).
 
-        for slice_z in range(slices):
-            current_counts = slice_count[slice_z]
-            sinogram = self.sinogram[slice_z]
-            # Inicialização: pode usar FBP para obter uma boa aproximação inicial
-            reconstruction = inverse_radon(sinogram, angles)
-            reconstruction = np.clip(reconstruction, 1e-6, None)
-            # Dividir sinograma e ângulos em subconjuntos
-            subsets = np.array_split(sinogram, subsets_n, axis=1)
-            angle_subsets = np.array_split(angles, subsets_n)
-            for it in range(iterations):
-                # Atualização OSEM
-                total_update = np.ones((pixels, pixels))
-                for subset, angles_ss in zip(subsets, angle_subsets):
-                    proj = direct_radon(reconstruction, angles_ss)
-                    ratio = subset / (proj + 1e-10)
-                    backproj = inverse_radon(ratio, angles_ss)
-                    total_update *= backproj ** (1.0 / subsets_n)
-                reconstruction *= total_update
-                reconstruction = reconstruction / sens_image
-
-                # Passo de regularização TV (descida de gradiente)
-                grad_tv = self.compute_tv_gradient(reconstruction, tv_epsilon)
-                reconstruction = reconstruction - beta * grad_tv
-                reconstruction = np.clip(reconstruction, 1e-6, None)
-
-                # Normalização para preservar o total de contagens da fatia
-                factor = current_counts / (reconstruction.sum() + 1e-10)
-                reconstruction *= factor
-
-            rec[slice_z] = reconstruction
-        return rec
+        @param iterations Number of iterations (passes over all the subsets)
+        @param subsets_n Number of subsets
+        @param angles Angles for reconstruction, should be a numpy array of angles in degrees
+        @param momentum "nesterov" or "relaxed"
+        @param relaxation Constant momentum of the "relaxed" scheme
+        @param restart Adaptive restart of the momentum
+        @param plan ReconstructionPlan to be used, by default the cached plan of angles and subsets_n
+        @param on_iteration, tol, max_time, checkpoint, checkpoint_every, checkpoint_seconds, resume,
+               save_iterates, iterates Monitoring, stopping rules, checkpoints and captured iterations (see mlem);
+               a resumed run restarts the momentum
+        @param init Initial estimate (see mlem)
+        @param slices Indices of the slices to reconstruct (list, array or slice), None for all; the others are skipped
+        @param additive Additive term of the expected counts (see mlem)
+        @param weights Multiplicative weights of the expected counts (see mlem)
+
+        @return Reconstructed image
+        """
+        if plan is None:
+            plan = self.get_plan(angles, subsets_n)
+        sinogram = self.slice_sinogram(slices)
+        additive = self.get_additive(additive, slices)
+        weights = self.get_weights(weights, plan, slices)
+        monitor = iteration_monitor(on_iteration, tol, max_time, checkpoint, checkpoint_every,
+                                    checkpoint_seconds, resume, save_iterates, iterates)
+        rec = reconstruct_slices(_accelerated_osem_slice, sinogram, (plan.nxd, plan.nxd),
+                                 (plan, iterations, momentum, relaxation, restart, monitor), self.workers, self.backend,
+                                 init=self.get_initial_estimate(init, plan, slices, additive, weights), additive=additive,
+                                 weights=weights)
+        return monitored_result(rec, monitor)
+
+    def bsrem(self, iterations, subsets_n, angles, prior="relative_difference", beta=0.1, delta=1.0, relaxation=1.0,
+              relaxation_decay=0.1, upper=None, plan=None, on_iteration=None, tol=None, max_time=None, checkpoint=None,
+              checkpoint_every=None, checkpoint_seconds=None, resume=False, save_iterates=None, iterates=None,
+              init=None, slices=None):
+        """
+        @brief Regularized reconstruction with BSREM (block sequential regularized EM).
+
+        Unlike osem_tv, the iterates converge to the maximum of the penalized likelihood
+        L(x) - beta R(x), thanks to the decreasing relaxation alpha_n = relaxation / (1 + relaxation_decay n)
+        (see map_em.bsrem). With beta = 0 and relaxation_decay = 0 it is OSEM.
+
+        @param iterations Number of iterations (passes over all the subsets)
+        @param subsets_n Number of subsets
+        @param angles Angles for reconstruction, should be a numpy array of angles in degrees
+        @param prior "quadratic", "logcosh" or "relative_difference" (see priors.prior_gradient)
+        @param beta Regularization strength
+        @param delta Parameter of the prior potential
+        @param relaxation Initial relaxation
+        @param relaxation_decay Decay of the relaxation per iteration
+        @param upper Upper bound of the estimate, None for no bound
+        @param plan ReconstructionPlan to be used, by default the cached plan of angles and subsets_n
+        @param on_iteration, tol, max_time, checkpoint, checkpoint_every, checkpoint_seconds, resume,
+               save_iterates, iterates Monitoring, stopping rules, checkpoints and captured iterations (see mlem)
+        @param init Initial estimate (see mlem)
+        @param slices Indices of the slices to reconstruct (list, array or slice), None for all; the others are skipped
+
+        @return Reconstructed image
+        """
+        if plan is None:
+            plan = self.get_plan(angles, subsets_n)
+        sinogram = self.slice_sinogram(slices)
+        monitor = iteration_monitor(on_iteration, tol, max_time, checkpoint, checkpoint_every,
+                                    checkpoint_seconds, resume, save_iterates, iterates)
+        rec = reconstruct_slices(_bsrem_slice, sinogram, (plan.nxd, plan.nxd),
+                                 (plan, iterations, prior, beta, delta, relaxation, relaxation_decay, upper, monitor),
+                                 self.workers, self.backend, init=self.get_initial_estimate(init, plan, slices))
+        return monitored_result(rec, monitor)
+
+    def osl_map_em(self, iterations, subsets_n, angles, prior="huber", beta=0.1, delta=1.0, axial=False, plan=None,
+                   on_iteration=None, tol=None, max_time=None, checkpoint=None, checkpoint_every=None,
+                   checkpoint_seconds=None, resume=False, save_iterates=None, iterates=None, init=None, slices=None):
+        """
+        @brief Regularized reconstruction with one-step-late MAP-EM over ordered subsets.
+
+        The prior gradient is evaluated at the current estimate and added to the sensitivity in the
+        denominator of the EM update (see map_em.osl_em). With beta = 0 it is OSEM.
+
+        @param iterations Number of iterations (passes over all the subsets)
+        @param subsets_n Number of subsets
+        @param angles Angles for reconstruction, should be a numpy array of angles in degrees
+        @param prior "quadratic", "huber" or "relative_difference" (see priors.prior_gradient)
+        @param beta Regularization strength
+        @param delta Parameter of the prior potential
+        @param axial False regularizes each slice with its 8 in-plane neighbours; True reconstructs the
+                     whole volume at once with the 26 neighbours, coupling neighbouring slices
+        @param plan ReconstructionPlan to be used, by default the cached plan of angles and subsets_n
+        @param on_iteration, tol, max_time, checkpoint, checkpoint_every, checkpoint_seconds, resume,
+               save_iterates, iterates Monitoring, stopping rules, checkpoints and captured iterations (see mlem);
+               with axial=True the metrics have one value per slice
+        @param init Initial estimate (see mlem)
+        @param slices Indices of the slices to reconstruct (list, array or slice), None for all; the others are skipped
+
+        @return Reconstructed image
+        """
+        if plan is None:
+            plan = self.get_plan(angles, subsets_n)
+        sinogram = self.slice_sinogram(slices)
+        monitor = iteration_monitor(on_iteration, tol, max_time, checkpoint, checkpoint_every,
+                                    checkpoint_seconds, resume, save_iterates, iterates)
+        init = self.get_initial_estimate(init, plan, slices)
+        if axial:
+            rec = _osl_volume(sinogram, plan, iterations, prior, beta, delta, monitor, init)
+        else:
+            rec = reconstruct_slices(_osl_slice, sinogram, (plan.nxd, plan.nxd),
+                                     (plan, iterations, prior, beta, delta, monitor), self.workers, self.backend,
+                                     init=init)
+        return monitored_result(rec, monitor)
+
+
+def _additive(additive, sinogram):
+    """
+    @brief Additive term passed to the kernels, zeros when the slice has none.
+    """
+    return np.zeros_like(sinogram) if additive is None else np.ascontiguousarray(additive, dtype=np.float64)
+
+
+def _weights(weights, sinogram):
+    """
+    @brief Multiplicative weights passed to the kernels, ones when the slice has none.
+    """
+    return np.ones_like(sinogram) if weights is None else np.ascontiguousarray(weights, dtype=np.float64)
+
+
+def _mlem_slice(sinogram, plan, iterations, monitor=None, init=None, additive=None, weights=None):
+    """
+    @brief MLEM iterations of a single slice.
+
+    @param sinogram Sinogram of the slice, ordered (distances, angles)
+    @param plan ReconstructionPlan of the "line_integral" engine
+    @param iterations Number of iterations
+    @param monitor IterationMonitor of the slice, None runs all the iterations
+    @param init Initial image of the slice, None for the uniform image
+    @param additive Additive term of the slice, ordered as sinogram, None for none
+    @param weights Multiplicative weights of the slice, ordered as sinogram, None for none
+
+    @return Reconstructed slice
+    """
+    imagem_estimada = np.ones([plan.nxd, plan.nxd]) if init is None else init
+    plan = plan.weighted(weights)
+    sinogram = np.ascontiguousarray(sinogram, dtype=np.float64)
+    additive = _additive(additive, sinogram)
+    weights = _weights(weights, sinogram)
+    projection = np.zeros_like(sinogram)
+    if monitor is None:
+        mlem_line_integral_kernel(sinogram, additive, weights, plan.angles, plan.sensitivity, iterations, imagem_estimada,
+                                  projection)
+        return imagem_estimada
+
+    for it in range(monitor.start(imagem_estimada), iterations):
+        mlem_line_integral_kernel(sinogram, additive, weights, plan.angles, plan.sensitivity, 1, imagem_estimada, projection)
+        if monitor.update(it, imagem_estimada, sinogram, projection):
+            break
+    return imagem_estimada
+
+
+def _osem_slice(sinogram, plan, iterations, monitor=None, init=None, additive=None, weights=None):
+    """
+    @brief OSEM iterations of a single slice.
+
+    @param sinogram Sinogram of the slice, ordered (distances, angles)
+    @param plan ReconstructionPlan of the "line_integral" engine
+    @param iterations Number of iterations
+    @param monitor IterationMonitor of the slice, None runs all the iterations
+    @param init Initial image of the slice, None for the uniform image
+    @param additive Additive term of the slice, ordered as sinogram, None for none
+    @param weights Multiplicative weights of the slice, ordered as sinogram, None for none
+
+    @return Reconstructed slice
+    """
+    plan = plan.weighted(weights)
+    # o kernel trabalha com a estimativa multiplicada pela sensibilidade
+    reconstruction = np.ones([plan.nxd, plan.nxd]) if init is None else init * (plan.sensitivity+1e-9)
+    sinogram = np.ascontiguousarray(sinogram, dtype=np.float64)
+    additive = _additive(additive, sinogram)
+    weights = _weights(weights, sinogram)
+    projection = np.zeros_like(sinogram)
+    order, offsets = plan.subset_order
+    if monitor is None:
+        osem_line_integral_kernel(sinogram, additive, weights, plan.angles, order, offsets, iterations, reconstruction, projection)
+        return reconstruction/(plan.sensitivity+1e-9)
+
+    for it in range(monitor.start(reconstruction, reconstruction/(plan.sensitivity+1e-9)), iterations):
+        osem_line_integral_kernel(sinogram, additive, weights, plan.angles, order, offsets, 1, reconstruction, projection)
+        if monitor.update(it, reconstruction/(plan.sensitivity+1e-9), sinogram, projection, estimate=reconstruction):
+            break
+    return reconstruction/(plan.sensitivity+1e-9)
+
+
+def _scheduled_osem_slice(sinogram, plans, iterations, schedule, monitor=None, init=None, additive=None, weights=None):
+    """
+    @brief OSEM iterations of a single slice with a subset schedule.
+
+    @param sinogram Sinogram of the slice, ordered (distances, angles)
+    @param plans Plans of every number of subsets of the schedule (see get_schedule_plans)
+    @param iterations Number of iterations
+    @param schedule SubsetSchedule
+    @param monitor IterationMonitor of the slice, None runs all the iterations
+    @param init Initial image of the slice, None for the uniform image
+    @param additive Additive term of the slice, ordered as sinogram, None for none
+    @param weights Multiplicative weights of the slice, ordered as sinogram, None for none
+
+    @return Reconstructed slice
+    """
+    plans = {plan.subsets: plan.weighted(weights) for plan in plans}
+    plan = next(iter(plans.values()))
+    schedule = schedule.for_slice(plan.subsets)
+    # a imagem de sensibilidade é a mesma para qualquer número de subsets
+    sensitivity = plan.sensitivity + 1e-9
+    reconstruction = np.ones([plan.nxd, plan.nxd]) if init is None else init * sensitivity
+    sinogram = np.ascontiguousarray(sinogram, dtype=np.float64)
+    additive = _additive(additive, sinogram)
+    weights = _weights(weights, sinogram)
+    projection = np.zeros_like(sinogram)
+    first = 0
+    if monitor is not None:
+        first = monitor.start(reconstruction, reconstruction/sensitivity)
+
+    for it in range(first, iterations):
+        order, offsets = plans[schedule.subsets_at(it)].subset_order
+        osem_line_integral_kernel(sinogram, additive, weights, plan.angles, order, offsets, 1, reconstruction, projection)
+        if monitor is not None and monitor.update(it, reconstruction/sensitivity, sinogram, projection,
+                                                  estimate=reconstruction):
+            break
+        schedule.update(sinogram, projection)
+    return reconstruction/sensitivity
+
+
+def _osem_tv_slice(sinogram, plan, iterations, beta, tv_epsilon, monitor=None, init=None):
+    """
+    @brief OSEM iterations with a TV gradient step of a single slice.
+
+    @param sinogram Sinogram of the slice, ordered (distances, angles)
+    @param plan ReconstructionPlan of the "line_integral" engine
+    @param iterations Number of iterations
+    @param beta Step of the TV gradient descent
+    @param tv_epsilon Small value for numerical stability of the TV gradient
+    @param monitor IterationMonitor of the slice, None runs all the iterations
+    @param init Initial image of the slice, None for the backprojection of the sinogram
+
+    @return Reconstructed slice
+    """
+    subsets_n = plan.subsets
+    current_counts = sinogram.sum()
+    sens_image = np.clip(plan.sensitivity, 1e-6, None)
+
+    # Inicialização: retroprojeção do sinograma, ou a estimativa inicial recebida
+    if init is None:
+        init = inverse_radon(np.ascontiguousarray(sinogram, dtype=np.float64), plan.angles)
+    reconstruction = np.clip(init, 1e-6, None)
+    # Dividir sinograma e ângulos em subconjuntos
+    subsets = [sinogram[:, indices] for indices in plan.subset_indices]
+    angle_subsets = plan.subset_angles
+    projection = np.zeros(sinogram.shape)
+    grad_tv = np.empty((plan.nxd, plan.nxd))
+    first = 0
+    if monitor is not None:
+        first = monitor.start(reconstruction)
+    for it in range(first, iterations):
+        # Atualização OSEM
+        total_update = np.ones((plan.nxd, plan.nxd))
+        for subset, angles_ss, indices in zip(subsets, angle_subsets, plan.subset_indices):
+            proj = direct_radon(reconstruction, angles_ss)
+            projection[:, indices] = proj
+            ratio = subset / (proj + 1e-10)
+            backproj = inverse_radon(ratio, angles_ss)
+            total_update *= backproj ** (1.0 / subsets_n)
+        reconstruction *= total_update
+        reconstruction = reconstruction / sens_image
+
+        # Passo de regularização TV (descida de gradiente)
+        tv_gradient(reconstruction, tv_epsilon, out=grad_tv)
+        reconstruction -= beta * grad_tv
+        reconstruction = np.clip(reconstruction, 1e-6, None)
+
+        # Normalização para preservar o total de contagens da fatia
+        factor = current_counts / (reconstruction.sum() + 1e-10)
+        reconstruction *= factor
+
+        if monitor is not None and monitor.update(it, reconstruction, sinogram, projection):
+            break
+
+    return reconstruction
+
+
+def _accelerated_osem_slice(sinogram, plan, iterations, momentum, relaxation, restart, monitor=None, init=None, additive=None,
+                            weights=None):
+    """
+    @brief Momentum-accelerated OSEM iterations of a single slice.
+
+    @param sinogram Sinogram of the slice, ordered (distances, angles)
+    @param plan ReconstructionPlan of the "line_integral" engine
+    @param iterations Number of iterations
+    @param momentum "nesterov" or "relaxed"
+    @param relaxation Constant momentum of the "relaxed" scheme
+    @param restart Adaptive restart of the momentum
+    @param monitor IterationMonitor of the slice, None runs all the iterations
+    @param init Initial image of the slice, None for the uniform image
+    @param additive Additive term of the slice, ordered as sinogram, None for none
+    @param weights Multiplicative weights of the slice, ordered as sinogram, None for none
+
+    @return Reconstructed slice
+    """
+    plan = plan.weighted(weights)
+    sinogram = np.ascontiguousarray(sinogram, dtype=np.float64)
+    additive = _additive(additive, sinogram)
+    weights = _weights(weights, sinogram)
+    projection = np.zeros_like(sinogram)
+    order, offsets = plan.subset_order
+    subset_sens = np.asarray(plan.subset_sensitivity)
+
+    def em_pass(estimate, projection):
+        os_pass_line_integral_kernel(sinogram, additive, weights, plan.angles, order, offsets, subset_sens, estimate, projection)
+
+    return momentum_em(em_pass, np.ones((plan.nxd, plan.nxd)) if init is None else init, iterations, momentum, relaxation, restart,
+                       monitor, sinogram, projection)
+
+
+def _bsrem_slice(sinogram, plan, iterations, prior, beta, delta, relaxation, relaxation_decay, upper, monitor=None, init=None):
+    """
+    @brief BSREM iterations of a single slice.
+
+    @param sinogram Sinogram of the slice, ordered (distances, angles)
+    @param plan ReconstructionPlan of the "line_integral" engine
+    @param iterations Number of iterations
+    @param prior, beta, delta, relaxation, relaxation_decay, upper See line_integral_reconstructor.bsrem
+    @param monitor IterationMonitor of the slice, None runs all the iterations
+    @param init Initial image of the slice, None for the uniform image
+
+    @return Reconstructed slice
+    """
+    sinogram = np.ascontiguousarray(sinogram, dtype=np.float64)
+    projection = np.zeros_like(sinogram)
+    subsets = [np.ascontiguousarray(sinogram[:, indices]) for indices in plan.subset_indices]
+    angles = plan.subset_angles
+    adjoint, subset_sens = _adjoint_scale(plan)
+
+    def subset_backprojection(ss, estimate):
+        proj = direct_radon(estimate, angles[ss])
+        projection[:, plan.subset_indices[ss]] = proj
+        ratio = np.divide(subsets[ss], proj, out=np.zeros_like(proj), where=proj > 0)
+        return inverse_radon(ratio, angles[ss]) * adjoint[ss]
+
+    return map_em.bsrem(subset_backprojection, subset_sens, np.ones((plan.nxd, plan.nxd)) if init is None else init, iterations,
+                        prior, beta, delta, relaxation, relaxation_decay, upper, monitor, sinogram, projection,
+                        plan.neighbourhood(2))
+
+
+def _adjoint_scale(plan):
+    """
+    @brief Factors that bring the subset backprojections of inverse_radon to the scale of the adjoint of direct_radon.
+
+    inverse_radon is normalized by the angles of the subset, so without these factors the gradient of
+    the likelihood and the one of the prior of the MAP methods would not be comparable.
+
+    @return (factors, subset_sens), one factor and one rescaled sensitivity image per subset
+    """
+    ones = np.ones((plan.nxd, plan.nxd))
+    adjoint = [np.sum(direct_radon(ones, angles_ss)) / np.sum(sens)
+               for angles_ss, sens in zip(plan.subset_angles, plan.subset_sensitivity)]
+    return adjoint, [sens * factor for sens, factor in zip(plan.subset_sensitivity, adjoint)]
+
+
+def _osl_slice(sinogram, plan, iterations, prior, beta, delta, monitor=None, init=None):
+    """
+    @brief One-step-late MAP-EM iterations of a single slice.
+
+    @param sinogram Sinogram of the slice, ordered (distances, angles)
+    @param plan ReconstructionPlan of the "line_integral" engine
+    @param iterations Number of iterations
+    @param prior, beta, delta See line_integral_reconstructor.osl_map_em
+    @param monitor IterationMonitor of the slice, None runs all the iterations
+    @param init Initial image of the slice, None for the uniform image
+
+    @return Reconstructed slice
+    """
+    sinogram = np.ascontiguousarray(sinogram, dtype=np.float64)
+    projection = np.zeros_like(sinogram)
+    subsets = [np.ascontiguousarray(sinogram[:, indices]) for indices in plan.subset_indices]
+    angles = plan.subset_angles
+    adjoint, subset_sens = _adjoint_scale(plan)
+
+    def subset_backprojection(ss, estimate):
+        proj = direct_radon(estimate, angles[ss])
+        projection[:, plan.subset_indices[ss]] = proj
+        ratio = np.divide(subsets[ss], proj, out=np.zeros_like(proj), where=proj > 0)
+        return inverse_radon(ratio, angles[ss]) * adjoint[ss]
+
+    return map_em.osl_em(subset_backprojection, subset_sens, np.ones((plan.nxd, plan.nxd)) if init is None else init, iterations,
+                         prior, beta, delta, plan.neighbourhood(2), monitor, sinogram, projection)
+
+
+def _osl_volume(sinogram, plan, iterations, prior, beta, delta, monitor=None, init=None):
+    """
+    @brief One-step-late MAP-EM of all the slices at once, with a prior that couples neighbouring slices.
+
+    @param sinogram Sinogram stack, ordered (slices, distances, angles)
+    @param plan ReconstructionPlan of the "line_integral" engine
+    @param iterations Number of iterations
+    @param prior, beta, delta See line_integral_reconstructor.osl_map_em
+    @param monitor IterationMonitor, the metrics have one value per slice
+    @param init Initial volume, None for the uniform image
+
+    @return Reconstructed volume (slices, nxd, nxd)
+    """
+    sinogram = np.ascontiguousarray(sinogram, dtype=np.float64)
+    slices = sinogram.shape[0]
+    projection = np.zeros_like(sinogram)
+    angles = plan.subset_angles
+    adjoint, subset_sens = _adjoint_scale(plan)
+    if monitor is not None:
+        monitor.allocate(slices, (plan.nxd, plan.nxd))
+
+    def subset_backprojection(ss, estimate):
+        indices = plan.subset_indices[ss]
+        back = np.empty_like(estimate)
+        for z in range(slices):
+            proj = direct_radon(estimate[z], angles[ss])
+            projection[z][:, indices] = proj
+            ratio = np.divide(sinogram[z][:, indices], proj, out=np.zeros_like(proj), where=proj > 0)
+            back[z] = inverse_radon(ratio, angles[ss]) * adjoint[ss]
+        return back
+
+    # o monitor recebe os sinogramas com uma coluna por fatia
+    columns = (sinogram.reshape(slices, -1).T, projection.reshape(slices, -1).T)
+    estimate = np.ones((slices, plan.nxd, plan.nxd)) if init is None else init
+    return map_em.osl_em(subset_backprojection, subset_sens, estimate, iterations,
+                         prior, beta, delta, plan.neighbourhood(3), monitor, *columns)
@@ -0,0 +1,157 @@
+import numpy as np
+
+from GimnTools.ImaGIMN.gimnRec.backprojectors import backproject_events
+from GimnTools.ImaGIMN.gimnRec.reconstructors.em_kernels import osem_list_mode_kernel
+
+
+# @file list_mode_reconstruction.py
+# @brief List-mode MLEM/OSEM straight from the coincidence events.
+# @details The events produced by process_root.coincidence_to_lor (distance, angle and slice of
+# each line of response) are reconstructed without binning them in a sinogram: every iteration
+# projects and backprojects only along the detected lines of response. For low-count acquisitions
+# the number of events is far below the number of sinogram bins, so an iteration is cheaper, and
+# the continuous distance and angle of each event are kept instead of being rounded to a bin.
+
+
+class list_mode_reconstructor:
+    """
+    @brief Reconstructs a stack of slices from a list of coincidence events.
+
+    The geometry is the one of line_integral_reconstructor: an event at distance d and angle phi is
+    the line of direct_radon at the radial position d / pixel_size (in pixels from the centre of the
+    image) and angle phi. With the sinograms of coincidence_to_lor, pixel_size is
+    crystal_size[1] / distance bins.
+    """
+
+    def __init__(self, events, image_size, angles, pixel_size=1.0, slices=None, weights=None):
+        """
+        @brief Stores the events of each slice.
+
+        Events outside the field of view or outside the slice range are discarded.
+
+        @param events DataFrame (or dictionary of arrays) with the columns 'distance', 'angle' and 'slice'
+        @param image_size Number of pixels of the side of the reconstructed slices
+        @param angles Angles, in degrees, sampled by the acquisition; they define the sensitivity image
+        @param pixel_size Size of a pixel in the units of the distances
+        @param slices Number of slices, by default the largest slice index of the events + 1
+        @param weights Counts of each event, 1 by default
+        """
+        offsets = np.asarray(events['distance'], dtype=np.float64) / pixel_size
+        event_angles = np.asarray(events['angle'], dtype=np.float64)
+        slice_index = np.asarray(events['slice'], dtype=np.int64)
+        if weights is None:
+            weights = np.ones(offsets.size)
+        weights = np.asarray(weights, dtype=np.float64)
+        if slices is None:
+            slices = int(slice_index.max()) + 1 if slice_index.size else 1
+
+        center = (image_size - 1) / 2
+        keep = (np.abs(offsets) < center) & (slice_index >= 0) & (slice_index < slices)
+        # Ordena os eventos por fatia, mantendo a ordem de aquisição dentro de cada fatia
+        order = np.argsort(slice_index[keep], kind="stable")
+        self.__offsets = offsets[keep][order]
+        self.__angles = event_angles[keep][order]
+        self.__weights = weights[keep][order]
+        self.__slice_starts = np.searchsorted(slice_index[keep][order], np.arange(slices + 1))
+        self.__image_size = image_size
+        self.__acquisition_angles = np.asarray(angles, dtype=np.float64)
+        self.__sensitivity = None
+
+    @property
+    def image_size(self):
+        """
+        @brief Returns the number of pixels of the side of the reconstructed slices.
+        """
+        return self.__image_size
+
+    @property
+    def slices(self):
+        """
+        @brief Returns the number of slices.
+        """
+        return self.__slice_starts.size - 1
+
+    @property
+    def events(self):
+        """
+        @brief Returns the number of events kept for the reconstruction.
+        """
+        return self.__offsets.size
+
+    @property
+    def sensitivity(self):
+        """
+        @brief Returns the sensitivity image A^T 1 over all the lines of response of the acquisition.
+
+        The lines are the bin centres of every distance bin at every acquisition angle, backprojected
+        with the same projector as the events. It is computed on the first call and shared by all
+        slices and reconstructions.
+        """
+        if self.__sensitivity is None:
+            size = self.__image_size
+            bins = np.arange(size) - (size - 1) / 2
+            offsets = np.tile(bins, self.__acquisition_angles.size)
+            angles = np.repeat(self.__acquisition_angles, size)
+            self.__sensitivity = np.zeros((size, size))
+            backproject_events(self.__sensitivity, offsets, angles, np.ones(offsets.size))
+        return self.__sensitivity
+
+    def event_subsets(self, slice_index, subsets_n):
+        """
+        @brief Splits the event stream of a slice in subsets.
+
+        The events are dealt to the subsets in turn (event i goes to subset i % subsets_n), so that
+        every subset spans the whole acquisition even when the stream is ordered by gantry position.
+        Each subset is taken as a random sample of the acquisition (sensitivity sens / subsets),
+        which holds for a stream in acquisition order but not for events sorted by bin.
+
+        @param slice_index Index of the slice
+        @param subsets_n Number of subsets
+
+        @return Tuple (offsets, angles, weights, bounds) with the events ordered subset after subset
+                and the (subsets, 2) array of the first and last + 1 events of each subset
+        """
+        start, stop = self.__slice_starts[slice_index], self.__slice_starts[slice_index + 1]
+        order = np.concatenate([np.arange(ss, stop - start, subsets_n) for ss in range(subsets_n)])
+        sizes = np.array([len(range(ss, stop - start, subsets_n)) for ss in range(subsets_n)])
+        ends = np.cumsum(sizes)
+        bounds = np.stack([ends - sizes, ends], axis=1).astype(np.int64)
+        order = order.astype(np.int64) + start
+        return self.__offsets[order], self.__angles[order], self.__weights[order], bounds
+
+    def osem(self, iterations, subsets_n, verbose=False):
+        """
+        @brief Reconstructs the events with list-mode OSEM.
+
+        @param iterations Number of iterations
+        @param subsets_n Number of subsets the event stream of each slice is split in
+        @param verbose Flag to print the slice number during reconstruction
+
+        @return Reconstructed slices, shape (slices, image_size, image_size)
+        """
+        size = self.__image_size
+        # Pixels na borda do campo de visão quase não são vistos pelas LORs da aquisição, mas os
+        # eventos, com posição contínua, ainda passam por eles; ficam fora da reconstrução
+        sens = np.where(self.sensitivity > 0.05 * self.sensitivity.max(), self.sensitivity, 0.0)
+        rec = np.zeros((self.slices, size, size))
+        for z in range(self.slices):
+            if verbose:
+                print(f"slice {z}")
+            offsets, angles, weights, bounds = self.event_subsets(z, subsets_n)
+            if offsets.size == 0:
+                continue
+            rec[z] = 1.0
+            projection = np.zeros(offsets.size)
+            osem_list_mode_kernel(offsets, angles, weights, bounds, sens, iterations, rec[z], projection)
+        return rec
+
+    def mlem(self, iterations, verbose=False):
+        """
+        @brief Reconstructs the events with list-mode MLEM, that is, OSEM with a single subset.
+
+        @param iterations Number of iterations
+        @param verbose Flag to print the slice number during reconstruction
+
+        @return Reconstructed slices, shape (slices, image_size, image_size)
+        """
+        return self.osem(iterations, 1, verbose)
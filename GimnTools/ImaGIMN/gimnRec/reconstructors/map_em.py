@@ -0,0 +1,126 @@
+import numpy as np
+
+from GimnTools.ImaGIMN.gimnRec.priors import prior_gradient, prior_code, neighbourhood, osl_update_kernel
+
+
+# @file map_em.py
+# @brief Regularized (MAP) EM loops shared by the reconstruction engines.
+# @details The engines provide, for each subset s, the EM backprojection A_s^T(y_s / A_s x) and the
+# subset sensitivity A_s^T 1; the loops here combine them with the gradient of a prior.
+
+
+def bsrem(subset_backprojection, subset_sens, estimate, iterations, prior="relative_difference", beta=0.1,
+          delta=1.0, relaxation=1.0, relaxation_decay=0.1, upper=None, monitor=None, sinogram=None,
+          projection=None, neighbours=None):
+    """
+    @brief Block sequential regularized EM (BSREM) with a relaxation schedule.
+
+    For each subset s the estimate is moved along the scaled gradient of the subset objective
+    Phi_s(x) = L_s(x) - beta / subsets R(x):
+
+        x <- x + alpha_n D_s (A_s^T(y_s / A_s x) - A_s^T 1 - beta / subsets grad R(x))
+        D_s = x / (A_s^T 1 + beta / subsets kappa(x))
+
+    with alpha_n = relaxation / (1 + relaxation_decay n) at iteration n and kappa a bound of the
+    curvature of the prior, which keeps strong priors stable; the estimate is then kept inside
+    [tiny, upper]. With beta = 0 and alpha_n = 1 the update is exactly the OSEM one; the decreasing
+    relaxation makes the iterates converge to the MAP solution instead of a limit cycle. Pixels that
+    are outside the field of view (no sensitivity) are set to zero.
+
+    @param subset_backprojection Function f(ss, estimate) that returns A_s^T(y_s / A_s x) with the shape of
+                                 estimate and writes A_s x into projection
+    @param subset_sens List with the sensitivity image of each subset, with the shape of estimate
+    @param estimate Initial estimate (2D image), updated in place with the result
+    @param iterations Number of passes over all the subsets
+    @param prior Prior of priors.PRIORS
+    @param beta Regularization strength
+    @param delta Parameter of the prior potential
+    @param relaxation Initial relaxation alpha_0
+    @param relaxation_decay Decay of the relaxation, alpha_n = alpha_0 / (1 + relaxation_decay n)
+    @param upper Upper bound of the estimate, None for no bound
+    @param monitor IterationMonitor of the slice, None runs all the iterations
+    @param sinogram Measured sinogram, used by the monitor
+    @param projection Array that receives the subset projections
+    @param neighbours (offsets, weights) of the prior, by default the 8 in-plane neighbours
+    @return The estimate
+    """
+    subsets = len(subset_sens)
+    if neighbours is None:
+        neighbours = neighbourhood(2)
+    gradient = np.empty_like(estimate)
+    curvature = np.empty_like(estimate)
+    # pixels fora do campo de visão (sensibilidade ~0) não são atualizados; valem zero no resultado
+    sensitivity = np.sum(subset_sens, axis=0)
+    mask = sensitivity > 1e-3 * sensitivity.max()
+    estimate[~mask] = 1e-9
+
+    first = 0
+    if monitor is not None:
+        first = monitor.start(estimate)
+    for it in range(first, iterations):
+        alpha = relaxation / (1.0 + relaxation_decay * it)
+        for ss in range(subsets):
+            backprojection = subset_backprojection(ss, estimate)
+            prior_gradient(estimate, prior, delta, neighbours, gradient, curvature)
+            step = backprojection - subset_sens[ss] - (beta / subsets) * gradient
+            scale = subset_sens[ss] + (beta / subsets) * curvature
+            estimate += np.where(mask, alpha * estimate * step / np.maximum(scale, 1e-12), 0.0)
+            np.clip(estimate, 1e-9, upper, out=estimate)
+
+        if monitor is not None and monitor.update(it, estimate, sinogram, projection):
+            break
+    estimate[~mask] = 0.0
+    return estimate
+
+
+def osl_em(subset_backprojection, subset_sens, estimate, iterations, prior="huber", beta=0.1, delta=1.0,
+           neighbours=None, monitor=None, sinogram=None, projection=None):
+    """
+    @brief One-step-late (OSL) MAP-EM over ordered subsets.
+
+    Green's update, with the gradient of the prior evaluated at the current estimate:
+
+        x <- x A_s^T(y_s / A_s x) / (A_s^T 1 + beta / subsets grad R(x))
+
+    computed by the fused osl_update_kernel. OSL is stable while beta / subsets |grad R| stays below
+    the subset sensitivity; stronger priors need bsrem. The estimate may be a 2D slice or a (slices, rows,
+    columns) volume; with a 3D neighbourhood the prior also couples neighbouring slices. For a volume
+    the monitor works as in the batched reconstructions: sinogram and projection are given with one
+    column per slice and the metrics are computed per slice.
+
+    @param subset_backprojection Function f(ss, estimate) that returns A_s^T(y_s / A_s x) with the shape of
+                                 estimate and writes A_s x into projection
+    @param subset_sens List with the sensitivity image (rows, columns) of each subset
+    @param estimate Initial estimate, updated in place with the result
+    @param iterations Number of passes over all the subsets
+    @param prior Prior of priors.PRIORS
+    @param beta Regularization strength, 0 gives OSEM
+    @param delta Parameter of the prior potential
+    @param neighbours (offsets, weights) of the prior, by default the 8 in-plane neighbours
+    @param monitor IterationMonitor (of the slice, or of the whole volume), None runs all the iterations
+    @param sinogram Measured sinogram, used by the monitor
+    @param projection Array that receives the subset projections
+    @return The estimate
+    """
+    subsets = len(subset_sens)
+    if neighbours is None:
+        neighbours = neighbourhood(2)
+    volume = estimate.reshape((1,) + estimate.shape) if estimate.ndim == 2 else estimate
+    updated = np.empty_like(volume)
+    kind = prior_code(prior)
+    # com um volume o monitor recebe uma coluna por fatia, como nas reconstruções em lote
+    image, axis = (estimate, None) if estimate.ndim == 2 else (volume.reshape(volume.shape[0], -1).T, 0)
+
+    first = 0
+    if monitor is not None:
+        first = monitor.start(image)
+    for it in range(first, iterations):
+        for ss in range(subsets):
+            backprojection = subset_backprojection(ss, estimate).reshape(volume.shape)
+            osl_update_kernel(volume, backprojection, subset_sens[ss], beta / subsets, neighbours[0],
+                              neighbours[1], kind, float(delta), updated)
+            volume[...] = updated
+
+        if monitor is not None and monitor.update(it, image, sinogram, projection, axis):
+            break
+    return estimate
@@ -0,0 +1,132 @@
+import numpy as np
+
+from GimnTools.ImaGIMN.gimnRec.reconstruction_plan import cached_plan, make_geometry
+from GimnTools.ImaGIMN.gimnRec.reconstructors.initialization import corrected_sinogram, scale_to_counts
+
+
+# @file multiresolution.py
+# @brief Coarse-to-fine (multigrid) start of MLEM/OSEM (multigrid= of the reconstructors).
+# @details The first EM iterations only recover the low frequencies of the object, which a coarse
+# grid represents as well as the full one at a fraction of the cost. Each level sums groups of
+# factor distance bins of the sinogram (the counts are kept), reconstructs on an image with factor
+# times fewer pixels per side, and hands its estimate to the next level upsampled by linear
+# interpolation and scaled to the counts of the sinogram. The plans of the coarse geometries are
+# kept in the plan cache of the reconstructor, like the plans of the full grid.
+
+
+DEFAULT_LEVELS = ((4, 4), (2, 2))
+
+
+def multigrid_levels(multigrid):
+    """
+    @brief Converts the multigrid= argument of the reconstructors into a list of levels.
+
+    @param multigrid True for DEFAULT_LEVELS (4 iterations at 1/4 and 2 at 1/2 of the resolution) or
+                     a list of (factor, iterations), visited from the largest factor to the smallest
+    @return List of (factor, iterations)
+    """
+    levels = DEFAULT_LEVELS if multigrid is True else multigrid
+    levels = sorted(((int(factor), int(iterations)) for factor, iterations in levels), reverse=True)
+    if not levels or any(factor < 2 or iterations < 1 for factor, iterations in levels):
+        raise ValueError("Every multigrid level needs a factor of at least 2 and at least one iteration")
+    return levels
+
+
+def coarse_geometry(geometry, factor):
+    """
+    @brief Geometry of a grid with factor times fewer pixels and radial bins.
+
+    @param geometry Dictionary created by make_geometry
+    @param factor Integer downsampling factor; must divide the pixels and the bins
+    @return Dictionary created by make_geometry
+    """
+    if geometry["pixels"] % factor or geometry["bins"] % factor:
+        raise ValueError(f"The multigrid factor {factor} does not divide the {geometry['pixels']} pixels "
+                         f"and {geometry['bins']} bins of the geometry")
+    center = geometry.get("center")
+    if center is not None:
+        center = np.asarray(center, dtype=np.float64) / factor
+        center = float(center) if center.ndim == 0 else tuple(center.tolist())
+    return make_geometry(geometry["pixels"] // factor, geometry["bins"] // factor, center)
+
+
+def level_plan(cache, plan, factor):
+    """
+    @brief Plan of a coarse level, with the angles, subsets and engine of plan, kept in cache.
+
+    @param cache Plan cache of the reconstructor
+    @param plan Plan of the full grid
+    @param factor Downsampling factor of the level
+    @return ReconstructionPlan
+    """
+    return cached_plan(cache, coarse_geometry(plan.geometry, factor), plan.angles, plan.subsets, plan.engine,
+                       plan.interpolator, plan.ordering)
+
+
+def downsample_sinogram(sinogram, factor, axis):
+    """
+    @brief Sums groups of factor adjacent bins of a sinogram stack along one axis.
+
+    @param sinogram Sinogram stack
+    @param factor Number of bins added together
+    @param axis Axis of the distance bins
+    @return Sinogram stack with factor times fewer bins along axis
+    """
+    sinogram = np.asarray(sinogram, dtype=np.float64)
+    shape = sinogram.shape[:axis] + (sinogram.shape[axis] // factor, factor) + sinogram.shape[axis + 1:]
+    return sinogram.reshape(shape).sum(axis=axis + 1)
+
+
+def upsample_volume(volume, pixels):
+    """
+    @brief Linear interpolation of every slice of a volume onto a grid with more pixels.
+
+    The interpolation is separable, so it is done with one small interpolation matrix per side
+    instead of a loop over the pixels (processing.tools.utils.resize).
+
+    @param volume Volume (slices, n, n)
+    @param pixels Pixels of each side of the output
+    @return Volume (slices, pixels, pixels)
+    """
+    n = volume.shape[1]
+    # centros dos pixels finos nas coordenadas do grid grosso
+    position = np.clip((np.arange(pixels) + 0.5) * n / pixels - 0.5, 0, n - 1)
+    lower = np.minimum(np.floor(position).astype(np.int64), n - 2) if n > 1 else np.zeros(pixels, dtype=np.int64)
+    weight = position - lower
+    interpolation = np.zeros((pixels, n))
+    interpolation[np.arange(pixels), lower] = 1 - weight
+    if n > 1:
+        interpolation[np.arange(pixels), lower + 1] += weight
+    return np.einsum("ij,zjk,lk->zil", interpolation, volume, interpolation)
+
+
+def multigrid_estimate(levels, sinogram, plan, cache, distance_axis, iterate, project, additive=None, weights=None):
+    """
+    @brief Estimate at full resolution given by the iterations of the coarse levels.
+
+    @param levels List of (factor, iterations), see multigrid_levels
+    @param sinogram Sinogram stack of the reconstructed slices
+    @param plan Plan of the full grid
+    @param cache Plan cache of the reconstructor, which receives the plans of the levels
+    @param distance_axis Axis of the distance bins in sinogram
+    @param iterate Function iterate(sinogram, plan, iterations, init, additive, weights) returning the volume
+                   reconstructed on a level
+    @param project Function project(image, plan) returning the projection of one image
+    @param additive Additive term of the model, laid out as sinogram, None for none; it is summed like the sinogram
+    @param weights Multiplicative weights of the model, laid out as sinogram, None for none; they are averaged
+
+    @return Volume (slices, nxd, nxd), used as the initial estimate of the full grid
+    """
+    estimate = None
+    for factor, iterations in levels:
+        coarse_plan = level_plan(cache, plan, factor)
+        coarse = downsample_sinogram(sinogram, factor, distance_axis)
+        coarse_additive = None if additive is None else downsample_sinogram(additive, factor, distance_axis)
+        coarse_weights = None if weights is None else downsample_sinogram(weights, factor, distance_axis) / factor
+        if estimate is not None:
+            estimate = scale_to_counts(upsample_volume(estimate, coarse_plan.nxd),
+                                       corrected_sinogram(coarse, coarse_additive, coarse_weights),
+                                       lambda image: project(image, coarse_plan))
+        estimate = iterate(coarse, coarse_plan, iterations, estimate, coarse_additive, coarse_weights)
+    return scale_to_counts(upsample_volume(estimate, plan.nxd), corrected_sinogram(sinogram, additive, weights),
+                           lambda image: project(image, plan))
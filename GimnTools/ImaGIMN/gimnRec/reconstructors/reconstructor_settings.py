@@ -0,0 +1,190 @@
+import numpy as np
+
+from GimnTools.ImaGIMN.gimnRec.corrections import attenuation_factors, correction_term
+from GimnTools.ImaGIMN.gimnRec.reconstructors.initialization import corrected_sinogram, initial_estimate
+
+
+# @file reconstructor_settings.py
+# @brief Settings and model terms shared by the slice reconstructors (rotation_reconstructor and line_integral_reconstructor).
+# @details The workers, the subset ordering, the plan cache and the corrections of the study
+# (attenuation and normalization) are kept here, so the reconstructors only differ in their plans,
+# projectors and algorithms. A reconstructor calls _init_settings in its constructor and provides
+# the sinogram property, _fbp_volume and _project_slice.
+
+
+class reconstructor_settings:
+    """
+    @brief Mixin with the settings and the terms of the model (additive, weights, initial estimate) of a slice reconstructor.
+    """
+
+    def _init_settings(self, workers=1, backend="process"):
+        """
+        @brief Initializes the settings, called by the constructor of the reconstructor.
+
+        @param workers Number of workers used to reconstruct the slices in parallel
+        @param backend Kind of worker, "process" or "thread" (see set_workers)
+        """
+        self._plans = {}
+        self._workers = workers
+        self._backend = backend
+        self._subset_ordering = "max_separation"
+        self._attenuation = None
+        self._normalization = None
+        self._corrections = {}
+
+    @property
+    def workers(self):
+        """
+        @brief Returns the number of processes used to reconstruct the slices.
+        @return Number of worker processes
+        """
+        return self._workers
+
+    @property
+    def backend(self):
+        """
+        @brief Returns how the slices are distributed to the workers, "process" or "thread".
+        """
+        return self._backend
+
+    def set_workers(self, workers, backend="process"):
+        """
+        @brief Sets the number of workers used to reconstruct the slices.
+
+        With the "process" backend the slices are distributed to a process pool, the sinogram,
+        the output volume and the system matrix being shared through shared memory. With the
+        "thread" backend the slices are reconstructed by a thread pool that shares the plan
+        directly; the MLEM/OSEM loops of the line integral and system matrix engines release the
+        interpreter lock while they run, the rotation projector does not, so the "thread" backend
+        gives little speedup for the rotation_reconstructor.
+
+        @param workers Number of workers, 1 reconstructs the slices sequentially
+        @param backend "process" or "thread"
+        """
+        self._workers = workers
+        self._backend = backend
+
+    @property
+    def subset_ordering(self):
+        """
+        @brief Returns how the plans of this reconstructor split and order the subsets.
+        """
+        return self._subset_ordering
+
+    def set_subset_ordering(self, ordering):
+        """
+        @brief Sets how the angles are split in subsets and the order the subsets are visited.
+
+        The ordering is part of the plan, so every OSEM method of this reconstructor uses it.
+
+        @param ordering One of reconstruction_plan.ORDERINGS, "max_separation" by default
+        """
+        self._subset_ordering = ordering
+
+    @property
+    def plans(self):
+        """
+        @brief Returns the reconstruction plans already computed by this reconstructor.
+        @return Dictionary of ReconstructionPlan indexed by their keys
+        """
+        return self._plans
+
+    def slice_sinogram(self, slices=None):
+        """
+        @brief Returns the sinogram of the selected slices.
+
+        @param slices Indices (list, array, integer or slice) of the slices, None for all of them
+
+        @return Sinogram stack (selected slices, ...)
+        """
+        if slices is None:
+            return self.sinogram
+        return self.sinogram[np.atleast_1d(np.arange(self.sinogram.shape[0])[slices])]
+
+    def get_additive(self, additive, slices=None):
+        """
+        @brief Returns the additive term of the model of the selected slices (additive= argument).
+
+        The expected counts of each bin are A x + r, with r the randoms and scatter of the measured
+        sinogram, so a background is modelled instead of subtracted from the data.
+
+        @param additive None, a number added to every bin, or an array laid out as the sinogram stack
+                        (or as one of its slices); a stack of the whole sinogram is restricted to slices
+        @param slices Indices of the reconstructed slices, None for all of them
+
+        @return Array laid out as the selected sinogram stack, or None
+        """
+        if additive is None:
+            return None
+        return correction_term(additive, self.sinogram, slices, "additive term")
+
+    def set_attenuation(self, mu_map, pixel_size=1.0, cache_dir=None):
+        """
+        @brief Sets the attenuation map of the study, folded into the model of MLEM/OSEM as multiplicative weights.
+
+        The attenuation correction factors are the projection of the mu-map with the engine of each
+        plan; they are computed on the first reconstruction of a geometry and reused by every later
+        one (see corrections.attenuation_factors).
+
+        @param mu_map Attenuation map (slices, nxd, nxd), or (nxd, nxd) for every slice; None removes it
+        @param pixel_size Length of a pixel in the units of 1/mu
+        @param cache_dir Directory where the factors are kept between sessions, None keeps them only in memory
+        """
+        self._attenuation = None if mu_map is None else (np.asarray(mu_map, dtype=np.float64), float(pixel_size), cache_dir)
+
+    def set_normalization(self, normalization):
+        """
+        @brief Sets the normalization sinogram of the detector, folded into the model of MLEM/OSEM as multiplicative weights.
+
+        @param normalization Normalization sinogram laid out as the sinogram stack (or as one of its
+                             slices), e.g. processing.normalizations.normalization_sinogram; None removes it
+        """
+        if normalization is not None:
+            correction_term(normalization, self.sinogram, None, "normalization")
+        self._normalization = normalization
+
+    def get_weights(self, weights, plan, slices=None):
+        """
+        @brief Returns the multiplicative weights of the model of the selected slices (weights= argument).
+
+        The expected counts of each bin are w A x + r: the weights of the call times 1 / ACF, the
+        attenuation of the study (set_attenuation), and times the normalization of the detector
+        (set_normalization), so the data is never divided by the corrections.
+
+        @param weights None, a number, or an array laid out as the sinogram stack (or as one of its slices)
+        @param plan Plan of the reconstruction, whose geometry the attenuation factors are projected in
+        @param slices Indices of the reconstructed slices, None for all of them
+
+        @return Array laid out as the selected sinogram stack, or None when there are no weights
+        """
+        if weights is not None:
+            weights = correction_term(weights, self.sinogram, slices, "weights")
+        if self._normalization is not None:
+            normalization = correction_term(self._normalization, self.sinogram, slices, "normalization")
+            weights = normalization if weights is None else weights * normalization
+        if self._attenuation is not None:
+            mu_map, pixel_size, cache_dir = self._attenuation
+            factors = attenuation_factors(mu_map, plan, pixel_size, cache_dir, self._corrections)
+            factors = correction_term(factors[0] if len(factors) == 1 else factors, self.sinogram, slices,
+                                      "attenuation correction factors")
+            weights = 1.0 / factors if weights is None else weights / factors
+        return weights
+
+    def get_initial_estimate(self, init, plan, slices=None, additive=None, weights=None):
+        """
+        @brief Returns the initial estimate of the iterative methods (init= argument).
+
+        @param init None, "fbp" or an array (see initialization.initial_estimate); an array with one
+                    image per slice of the whole stack is restricted to the selected slices
+        @param plan Plan of the reconstruction
+        @param slices Indices of the reconstructed slices, None for all of them
+        @param additive Additive term of the selected slices (see get_additive), subtracted before the FBP
+        @param weights Weights of the selected slices (see get_weights), which divide the sinogram before the FBP
+
+        @return Array (slices, nxd, nxd), or None for the uniform image
+        """
+        sinogram = corrected_sinogram(self.slice_sinogram(slices), additive, weights)
+        if slices is not None and not isinstance(init, str) and np.ndim(init) == 3 and len(init) == self.sinogram.shape[0]:
+            init = np.asarray(init)[np.atleast_1d(np.arange(len(init))[slices])]
+        return initial_estimate(init, lambda: self._fbp_volume(plan, sinogram), lambda image: self._project_slice(image, plan),
+                                sinogram, (plan.nxd, plan.nxd))
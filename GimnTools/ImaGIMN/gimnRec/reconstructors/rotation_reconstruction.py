@@ -4,13 +4,18 @@ from GimnTools.ImaGIMN.gimnRec.projectors import *
 from GimnTools.ImaGIMN.gimnRec.reconstruction_filters import *
 from GimnTools.ImaGIMN.processing.interpolators.reconstruction import *
 from GimnTools.ImaGIMN.gimnRec.corrections import *
+from GimnTools.ImaGIMN.gimnRec.reconstruction_plan import cached_plan, make_geometry
+from GimnTools.ImaGIMN.gimnRec.reconstructors.slice_parallel import reconstruct_slices
+from GimnTools.ImaGIMN.gimnRec.reconstructors.reconstructor_settings import reconstructor_settings
+from GimnTools.ImaGIMN.gimnRec.iteration_control import iteration_monitor, monitored_result
+from GimnTools.ImaGIMN.gimnRec.reconstructors.multiresolution import multigrid_estimate, multigrid_levels
 from scipy.ndimage import gaussian_filter
 from matplotlib import pyplot as plt
 
 
 import numpy as np
 
-class rotation_reconstructor(image):
+class rotation_reconstructor(reconstructor_settings, image):
     """
     @brief Creates a Reconstructor class that will inherit the image class.
 
@@ -31,7 +36,7 @@ class rotation_reconstructor(image):
     __reconstructed_osem = None
     __reconstructed_fbp = None
 
-    def __init__(self, path=None, sinogram=None, sinogram_order=("slice", "angles", "distances"), center_of_rotation=None, transpose=None):
+    def __init__(self, path=None, sinogram=None, sinogram_order=("slice", "angles", "distances"), center_of_rotation=None, transpose=None, workers=1, backend="process"):
         """
         @brief Constructs the reconstructor class, it will initiate the super class of reconstructor, that inherits an image class.
 
@@ -42,10 +47,13 @@ class rotation_reconstructor(image):
         @param sinogram_order Order of the sinogram dimensions, default is ("slice", "angles", "distances")
         @param center_of_rotation Center of rotation
         @param transpose Flag to transpose the sinogram
+        @param workers Number of workers used to reconstruct the slices in parallel
+        @param backend Kind of worker, "process" or "thread" (see set_workers)
         """
         #super(rotation_reconstructor, self).__init__(path=path, image=sinogram)
         self.__sinogram_order = sinogram_order
         self.__sinogram = self.pixels
+        self._init_settings(workers, backend)
 
     @property
     def sinogram(self):
@@ -79,7 +87,64 @@ class rotation_reconstructor(image):
         """
         self.__center_of_rotation = center_of_rotation
 
-    def mlem(self, iterations, interpolation, angles, verbose=False):
+    def get_plan(self, angles, interpolation, subsets=1):
+        """
+        @brief Returns the reconstruction plan for the given angles, interpolator and subsets.
+
+        The plan is computed only on the first call and shared by every slice, algorithm and
+        later call with the same geometry.
+
+        @param angles Angles for reconstruction, in degrees
+        @param interpolation Interpolator function
+        @param subsets Number of subsets
+
+        @return ReconstructionPlan of the "rotation" engine
+        """
+        geometry = make_geometry(self.sinogram.shape[1], center=self.__center_of_rotation)
+        return cached_plan(self.plans, geometry, angles, subsets, "rotation", interpolation, self.subset_ordering)
+
+    def _fbp_volume(self, plan, sinogram):
+        """
+        @brief FBP of every slice with the Ram-Lak filter and the rotation backprojector of the plan, without clipping.
+        """
+        return np.asarray([iradon_m(apply_filter_to_sinogram(ramLak, sino), plan.interpolator, center=plan.center,
+                                    angles=plan.angles)
+                           for sino in np.asarray(sinogram, dtype=np.float64)])
+
+    def _project_slice(self, image, plan):
+        """
+        @brief Projection of one image with the rotation projector of the plan.
+        """
+        return radon_m(image, plan.angles, plan.interpolator, center=plan.center)
+
+    def get_multigrid_estimate(self, multigrid, plan, sinogram, init=None, additive=None, weights=None):
+        """
+        @brief Returns the initial estimate given by the coarse levels of a multigrid reconstruction.
+
+        @param multigrid True or a list of (factor, iterations) levels (see multiresolution.multigrid_levels)
+        @param plan Plan of the full grid; the levels use its interpolator and subsets
+        @param sinogram Sinogram stack of the reconstructed slices
+        @param init Must be None, the coarsest level starts from the uniform image
+        @param additive Additive term of the selected slices (see get_additive)
+        @param weights Multiplicative weights of the selected slices (see get_weights)
+
+        @return Array (slices, nxd, nxd)
+        """
+        if init is not None:
+            raise ValueError("multigrid and init cannot be used together")
+        function = _mlem_slice if plan.subsets == 1 else _osem_slice
+
+        def iterate(coarse, coarse_plan, iterations, estimate, coarse_additive, coarse_weights):
+            return reconstruct_slices(function, coarse, (coarse_plan.nxd, coarse_plan.nxd), (coarse_plan, iterations),
+                                      self.workers, self.backend, init=estimate, additive=coarse_additive,
+                                      weights=coarse_weights)
+
+        return multigrid_estimate(multigrid_levels(multigrid), sinogram, plan, self.plans, 1, iterate, self._project_slice,
+                                  additive, weights)
+
+    def mlem(self, iterations, interpolation, angles, verbose=False, plan=None, on_iteration=None, tol=None, max_time=None,
+             checkpoint=None, checkpoint_every=None, checkpoint_seconds=None, resume=False,
+             save_iterates=None, iterates=None, init=None, slices=None, multigrid=None, additive=None, weights=None):
         """
         @brief Reconstructs the sinogram using the Maximum Likelihood Expectation Maximization (MLEM) algorithm for a given number of iterations.
 
@@ -87,8 +152,28 @@ class rotation_reconstructor(image):
 
         @param iterations Number of iterations
         @param interpolation Interpolator to be used, can be: linear_interpolation, beta_spline_interpolation, bilinear_interpolation, or beta_spline_interpolation_o5
-        @param angles Angles for reconstruction, should be a numpy array of angles in radians
+        @param angles Angles for reconstruction, should be a numpy array of angles in degrees
         @param verbose Flag to print the iteration number during reconstruction
+        @param plan ReconstructionPlan to be used, by default the cached plan of angles and interpolation
+        @param on_iteration Function called as on_iteration(state) after each iteration (see IterationState)
+        @param tol Stops a slice when the relative change of its estimate is below tol
+        @param max_time Stops the iterations after max_time seconds
+        @param checkpoint Directory where the checkpoints of the slices are written
+        @param checkpoint_every Writes a checkpoint every checkpoint_every iterations (1 if neither this nor checkpoint_seconds is given)
+        @param checkpoint_seconds Writes a checkpoint every checkpoint_seconds seconds
+        @param resume Continues from the checkpoints (True uses checkpoint, or the directory to resume from)
+        @param save_iterates Iterations (counted from 1) whose estimates are captured; the method then returns (rec, iterates)
+        @param iterates Array or h5py dataset (len(save_iterates), slices, nxd, nxd) that receives them, allocated when None
+        @param init Initial estimate: None for the uniform image, "fbp" for the positive FBP scaled to the
+                    counts of each slice, or an array (slices, nxd, nxd) or (nxd, nxd)
+        @param slices Indices of the slices to reconstruct (list, array or slice), None for all; the others are skipped
+        @param multigrid Coarse-to-fine start: True or a list of (factor, iterations) levels run before the iterations
+                         at full resolution, on grids factor times coarser (see multiresolution.multigrid_levels)
+        @param additive Additive term (randoms and scatter) of the expected counts, y / (A x + r) in the updates:
+                        a number or an array laid out as the sinogram (see get_additive)
+        @param weights Multiplicative weights of the expected counts w A x + r (normalization, other corrections): a
+                       number or an array laid out as the sinogram (see get_weights); the attenuation of set_attenuation
+                       is always included
 
         @return Reconstructed image using the MLEM algorithm
         """
@@ -96,112 +181,79 @@ class rotation_reconstructor(image):
             print("No sinogram Loaded")
             return -1
 
-        slices = self.sinogram.shape[0]
-        pixels = self.sinogram.shape[1]
-        rec = np.ones((self.sinogram.shape[0], self.sinogram.shape[1], self.sinogram.shape[1]))
-
-        for slice_z in range(slices):
-            sinogram = self.sinogram[slice_z, :, :]
-            imagem_estimada = np.ones([pixels, pixels])
-
-            for it in range(iterations):
-                if verbose:
-                    print("iteration- ", it)
-
-                imagem_estimada = np.nan_to_num(gaussian_filter(imagem_estimada, 0.1), copy=True, nan=1)
-                proje_estimada = radon_m(imagem_estimada, angles, interpolation, center=self.__center_of_rotation)
-                diff = sinogram / (proje_estimada + 10e-9)
-                imagem_estimada = iradon_m(diff, interpolation, angles) * imagem_estimada
-
-            rec[slice_z, :, :] = imagem_estimada
+        if plan is None:
+            plan = self.get_plan(angles, interpolation)
+        sinogram = self.slice_sinogram(slices)
+        additive = self.get_additive(additive, slices)
+        weights = self.get_weights(weights, plan, slices)
+        monitor = iteration_monitor(on_iteration, tol, max_time, checkpoint, checkpoint_every,
+                                    checkpoint_seconds, resume, save_iterates, iterates)
+        if multigrid is None:
+            init = self.get_initial_estimate(init, plan, slices, additive, weights)
+        else:
+            init = self.get_multigrid_estimate(multigrid, plan, sinogram, init, additive, weights)
+        rec = reconstruct_slices(_mlem_slice, sinogram, (plan.nxd, plan.nxd),
+                                 (plan, iterations, verbose, monitor), self.workers, self.backend, init=init,
+                                 additive=additive, weights=weights)
 
         self.__reconstructed_mlem = rec
-        return rec
+        return monitored_result(rec, monitor)
     
 
-    def osem(self, iterations, subsets_n, interpolation, angles, verbose=False, normalize=False):
+    def osem(self, iterations, subsets_n, interpolation, angles, verbose=False, normalize=False, plan=None,
+             on_iteration=None, tol=None, max_time=None, checkpoint=None, checkpoint_every=None,
+             checkpoint_seconds=None, resume=False, save_iterates=None, iterates=None, seed=None, init=None, slices=None,
+             multigrid=None, additive=None, weights=None):
         """
         @brief Reconstructs the sinogram using the Ordered Subset Expectation Maximization (OSEM) algorithm.
         
         @param iterations Number of iterations
         @param subsets_n Number of subsets
         @param interpolation Interpolator function
-        @param angles Array of projection angles in radians
+        @param angles Array of projection angles in degrees
         @param verbose Print progress information
         @param normalize Normalize output image
+        @param plan ReconstructionPlan to be used, by default the cached plan of angles, interpolation and subsets_n
+        @param on_iteration Function called as on_iteration(state) after each iteration (see IterationState)
+        @param tol Stops a slice when the relative change of its estimate is below tol
+        @param max_time Stops the iterations after max_time seconds
+        @param checkpoint Directory where the checkpoints of the slices are written
+        @param checkpoint_every Writes a checkpoint every checkpoint_every iterations (1 if neither this nor checkpoint_seconds is given)
+        @param checkpoint_seconds Writes a checkpoint every checkpoint_seconds seconds
+        @param resume Continues from the checkpoints (True uses checkpoint, or the directory to resume from)
+        @param save_iterates Iterations (counted from 1) whose estimates are captured; the method then returns (rec, iterates)
+        @param iterates Array or h5py dataset (len(save_iterates), slices, nxd, nxd) that receives them, allocated when None
+        @param seed None uses the subsets of the plan (see set_subset_ordering); a seed shuffles the angles
+                    randomly instead, each slice with its own generator derived from seed and the slice
+                    index, so the result does not depend on workers or backend
+        @param init Initial estimate (see mlem)
+        @param slices Indices of the slices to reconstruct (list, array or slice), None for all; the others are skipped
+        @param multigrid Coarse-to-fine start (see mlem); the coarse levels use the subsets of the plan
+        @param additive Additive term of the expected counts (see mlem)
+        @param weights Multiplicative weights of the expected counts (see mlem)
         
         @return Reconstructed image
         """
-        slices = self.sinogram.shape[0]
-        pixels = self.sinogram.shape[1]
-        rec = np.ones((slices, pixels, pixels))
-
-        for slice_z in range(slices):
-            if verbose:
-                print(f"Processing slice {slice_z+1}/{slices}")
-                
-            sinogram = self.sinogram[slice_z, :, :]
-            
-            # 1. Randomize projection order for better convergence
-            random_indices = np.random.permutation(len(angles))
-            shuffled_angles = angles[random_indices]
-            shuffled_sinogram = sinogram[:, random_indices]
-            
-            # 2. Split into subsets
-            angles_subsets = np.array_split(shuffled_angles, subsets_n)
-            sinogram_subsets = np.array_split(shuffled_sinogram, subsets_n, axis=1)
-            
-            # 3. Initialize reconstruction and normalization factor (sensibility image)
-            reconstruction = np.ones((pixels, pixels))
-            norm_factor = np.zeros((pixels, pixels))
-            
-            # 4. Precompute normalization factor (backprojection of 1s)
-            for i in range(subsets_n):
-                ones_proj = np.ones_like(sinogram_subsets[i])
-                norm_factor += backprojector(ones_proj, angles_subsets[i], 
-                                        interpolation, 
-                                        center=self.__center_of_rotation)
-            
-            # Avoid division by zero
-            norm_factor[norm_factor == 0] = 1e-6
-
-            # 5. OSEM iterations
-            for it in range(iterations):
-                if verbose:
-                    print(f"Iteration {it+1}/{iterations}")
-                    
-                for i in range(subsets_n):
-                    # Forward projection
-                    proj_estimate = projector(reconstruction, 
-                                            angles_subsets[i], 
-                                            interpolation,
-                                            center=self.__center_of_rotation)
-                    
-                    # Calculate correction factor
-                    corr = sinogram_subsets[i] / (proj_estimate + 1e-9)
-                    
-                    # Backproject correction factor
-                    bp_corr = backprojector(corr, angles_subsets[i], 
-                                        interpolation,
-                                        center=self.__center_of_rotation)
-                    
-                    # OSEM update
-                    reconstruction *= bp_corr / norm_factor
-                    
-                    # Optional: Display intermediate results
-                    if verbose and it % 5 == 0:
-                        plt.imshow(reconstruction)
-                        plt.title(f"Slice {slice_z} - Iteration {it+1}")
-                        plt.colorbar()
-                        plt.show()
-            
-            rec[slice_z, :, :] = reconstruction
+        if plan is None:
+            plan = self.get_plan(angles, interpolation, subsets_n)
+        sinogram = self.slice_sinogram(slices)
+        additive = self.get_additive(additive, slices)
+        weights = self.get_weights(weights, plan, slices)
+        monitor = iteration_monitor(on_iteration, tol, max_time, checkpoint, checkpoint_every,
+                                    checkpoint_seconds, resume, save_iterates, iterates)
+        if multigrid is None:
+            init = self.get_initial_estimate(init, plan, slices, additive, weights)
+        else:
+            init = self.get_multigrid_estimate(multigrid, plan, sinogram, init, additive, weights)
+        rec = reconstruct_slices(_osem_slice, sinogram, (plan.nxd, plan.nxd),
+                                 (plan, iterations, verbose, None if seed is None else np.random.SeedSequence(seed), monitor),
+                                 self.workers, self.backend, init=init, additive=additive, weights=weights)
 
         if normalize:
             rec = self.normalize(rec)
         
         self.__reconstructed_osem = rec
-        return rec
+        return monitored_result(rec, monitor)
 
     def fbp(self, interpolation, filter_type, angles):
         """
@@ -252,3 +304,121 @@ class rotation_reconstructor(image):
         image = image[:]
         # Additional normalization logic can be added here
         return norm
+
+
+def _mlem_slice(sinogram, plan, iterations, verbose=False, monitor=None, init=None, additive=None, weights=None):
+    """
+    @brief MLEM iterations of a single slice.
+
+    @param sinogram Sinogram of the slice, ordered (distances, angles)
+    @param plan ReconstructionPlan of the "rotation" engine
+    @param iterations Number of iterations
+    @param verbose Print the iteration number
+    @param monitor IterationMonitor of the slice, None runs all the iterations
+    @param init Initial image of the slice, None for the uniform image
+    @param additive Additive term of the slice, ordered as sinogram, None for none
+    @param weights Multiplicative weights of the slice, ordered as sinogram, None for none
+
+    @return Reconstructed slice
+    """
+    imagem_estimada = np.ones([plan.nxd, plan.nxd]) if init is None else init
+    additive = 0.0 if additive is None else additive
+    # a atualização não normaliza pela sensibilidade; com pesos ela é corrigida pela razão entre as sensibilidades
+    normalization = 1.0 if weights is None else plan.sensitivity / np.maximum(plan.weighted(weights).sensitivity, 1e-12)
+    weights = 1.0 if weights is None else weights
+    first = 0
+    if monitor is not None:
+        first = monitor.start(imagem_estimada)
+
+    for it in range(first, iterations):
+        if verbose:
+            print("iteration- ", it)
+
+        imagem_estimada = np.nan_to_num(gaussian_filter(imagem_estimada, 0.1), copy=True, nan=1)
+        proje_estimada = weights * radon_m(imagem_estimada, plan.angles, plan.interpolator, center=plan.center) + additive
+        diff = weights * sinogram / (proje_estimada + 10e-9)
+        imagem_estimada = iradon_m(diff, plan.interpolator, plan.angles) * imagem_estimada * normalization
+
+        if monitor is not None and monitor.update(it, imagem_estimada, sinogram, proje_estimada):
+            break
+
+    return imagem_estimada
+
+
+def _osem_slice(sinogram, plan, iterations, verbose=False, seed=None, monitor=None, init=None, additive=None,
+                weights=None):
+    """
+    @brief OSEM iterations of a single slice.
+
+    @param sinogram Sinogram of the slice, ordered (distances, angles)
+    @param plan ReconstructionPlan of the "rotation" engine
+    @param iterations Number of iterations
+    @param verbose Print progress information
+    @param seed Seed (or np.random.SeedSequence) of a random order of the angles, None uses the subsets of the plan
+    @param monitor IterationMonitor of the slice, None runs all the iterations
+    @param init Initial image of the slice, None for the uniform image
+    @param additive Additive term of the slice, ordered as sinogram, None for none
+    @param weights Multiplicative weights of the slice, ordered as sinogram, None for none
+
+    @return Reconstructed slice
+    """
+    subsets_n = plan.subsets
+    interpolation = plan.interpolator
+
+    # 1. Subsets of the plan, or a random order of the projections when a seed is given
+    # (ao retomar de um checkpoint o gerador volta ao estado salvo, repetindo a mesma ordem)
+    if seed is None:
+        subset_columns = plan.subset_indices
+    else:
+        rng = np.random.default_rng(seed) if monitor is None else monitor.random_generator(seed)
+        subset_columns = np.array_split(rng.permutation(plan.nphi), subsets_n)
+
+    # 2. Split into subsets
+    angles_subsets = [plan.angles[columns] for columns in subset_columns]
+    sinogram_subsets = [sinogram[:, columns] for columns in subset_columns]
+    additive_subsets = [0.0 if additive is None else additive[:, columns] for columns in subset_columns]
+    weight_subsets = [1.0 if weights is None else weights[:, columns] for columns in subset_columns]
+
+    # 3. Initialize reconstruction and normalization factor (sensibility image)
+    # The backprojection of 1s (of the weights) over all the subsets is the one of the plan
+    reconstruction = np.ones((plan.nxd, plan.nxd)) if init is None else init
+    norm_factor = plan.weighted(weights).sensitivity.copy()
+
+    # Avoid division by zero
+    norm_factor[norm_factor == 0] = 1e-6
+    projection = np.zeros(sinogram.shape)
+    first = 0
+    if monitor is not None:
+        first = monitor.start(reconstruction)
+
+    # 4. OSEM iterations
+    for it in range(first, iterations):
+        if verbose:
+            print(f"Iteration {it+1}/{iterations}")
+
+        for i in range(subsets_n):
+            # Forward projection
+            proj_estimate = (weight_subsets[i] * projector(reconstruction, angles_subsets[i], interpolation, center=plan.center)
+                             + additive_subsets[i])
+            projection[:, subset_columns[i]] = proj_estimate
+
+            # Calculate correction factor
+            corr = weight_subsets[i] * sinogram_subsets[i] / (proj_estimate + 1e-9)
+
+            # Backproject correction factor
+            bp_corr = backprojector(corr, angles_subsets[i], interpolation, center=plan.center)
+
+            # OSEM update
+            reconstruction *= bp_corr / norm_factor
+
+            # Optional: Display intermediate results
+            if verbose and it % 5 == 0:
+                plt.imshow(reconstruction)
+                plt.title(f"Iteration {it+1}")
+                plt.colorbar()
+                plt.show()
+
+        if monitor is not None and monitor.update(it, reconstruction, sinogram, projection):
+            break
+
+    return reconstruction
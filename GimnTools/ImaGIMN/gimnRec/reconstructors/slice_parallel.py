@@ -0,0 +1,266 @@
+import copy
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+from GimnTools.ImaGIMN.gimnRec.reconstruction_plan import ReconstructionPlan
+from GimnTools.ImaGIMN.gimnRec.iteration_control import IterationMonitor
+
+
+# @file slice_parallel.py
+# @brief Distributes the slices of a reconstruction over a pool of worker processes.
+# @details The sinogram, the output volume and the system matrix of the plans are placed in
+# multiprocessing.shared_memory blocks. The workers attach to those blocks once, when they start,
+# so the per-slice tasks only carry the slice index and nothing large is pickled or copied.
+# The workers are started by a fork server (or spawned) instead of forked from the caller: forking
+# a process whose Numba parallel kernels have already started their thread pool leaves the workers
+# (and the interpreter exit) deadlocked.
+# With the "thread" backend the slices are reconstructed by threads that share the plan directly,
+# which relies on the per-slice loops releasing the interpreter lock (see em_kernels).
+
+
+_worker = {}
+
+
+def reconstruct_slices(function, sinogram, image_shape, args=(), workers=1, backend="process", init=None, additive=None,
+                       weights=None):
+    """
+    @brief Applies a per-slice reconstruction function to every slice of a sinogram.
+
+    @param function Module level function called as function(sinogram[slice], *args), it must
+                    return the reconstructed slice
+    @param sinogram Sinogram stack, the first dimension is the slice
+    @param image_shape Shape of each reconstructed slice
+    @param args Extra arguments of function, the same for every slice (an IterationMonitor is
+                replaced by its copy for each slice and a np.random.SeedSequence by the child
+                sequence of the slice); a plan, or a tuple of plans, has its system matrix shared
+    @param workers Number of workers, 1 reconstructs the slices sequentially
+    @param backend "process" for a process pool over shared memory, "thread" for a thread pool
+    @param init Initial estimate (slices, *image_shape); when given, function is also called with
+                init= the copy of the slice's initial image
+    @param additive Additive term of the model, laid out as sinogram; when given, function is also
+                    called with additive= the term of the slice (shared like the sinogram)
+    @param weights Multiplicative weights of the model, laid out as sinogram; when given, function is
+                   also called with weights= the weights of the slice (shared like the sinogram)
+
+    @return Reconstructed volume with shape (slices, *image_shape)
+    """
+    slices = sinogram.shape[0]
+    rec = np.ones((slices,) + tuple(image_shape))
+    # o volume de saída guarda a estimativa inicial até a fatia ser reconstruída
+    if init is not None:
+        rec[...] = init
+    workers = min(int(workers or 1), slices)
+    terms = {name: term for name, term in (("additive", additive), ("weights", weights)) if term is not None}
+    monitors = [arg for arg in args if isinstance(arg, IterationMonitor)]
+    for monitor in monitors:
+        monitor.allocate(slices, image_shape)
+
+    if workers <= 1:
+        for slice_z in range(slices):
+            rec[slice_z] = function(sinogram[slice_z], *_slice_args(args, slice_z),
+                                    **_slice_kwargs(rec, init is not None, terms, slice_z))
+        return rec
+
+    if backend == "thread":
+        def reconstruct_slice(slice_z):
+            rec[slice_z] = function(sinogram[slice_z], *_slice_args(args, slice_z),
+                                    **_slice_kwargs(rec, init is not None, terms, slice_z))
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(reconstruct_slice, range(slices)))
+        return rec
+    if backend != "process":
+        raise ValueError(f"Unknown backend: {backend}")
+
+    blocks = []
+    try:
+        sino_spec = _share(np.asarray(sinogram, dtype=np.float64), blocks)
+        rec_spec = _share(rec, blocks)
+        term_specs = {name: _share(np.asarray(term, dtype=np.float64), blocks) for name, term in terms.items()}
+        matrices = {}
+        shared_args = tuple(_share_plan(arg, blocks, matrices) if isinstance(arg, ReconstructionPlan) else
+                            tuple(_share_plan(plan, blocks, matrices) for plan in arg) if _is_plan_tuple(arg) else
+                            _share_monitor(arg, blocks) if isinstance(arg, IterationMonitor) else arg
+                            for arg in args)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=_process_context(),
+                                 initializer=_init_worker,
+                                 initargs=(function, shared_args, sino_spec, rec_spec, init is not None,
+                                           term_specs)) as pool:
+            list(pool.map(_reconstruct_slice, range(slices)))
+        rec[:] = _view(blocks[1], rec_spec)
+        for monitor, shared in zip(monitors, [arg for arg in shared_args if isinstance(arg, IterationMonitor)]):
+            if monitor.iterates is not None:
+                block = next(block for block in blocks if block.name == shared.iterates[0])
+                monitor.iterates[...] = _view(block, shared.iterates)
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    return rec
+
+
+def _process_context():
+    """
+    @brief Multiprocessing context of the worker pools.
+
+    Where available the workers are forked from a fork server, a clean process that imports the
+    reconstructors only once and never runs a Numba parallel kernel; otherwise they are spawned.
+    """
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload([__name__])
+    return context
+
+
+def _slice_args(args, slice_z):
+    """
+    @brief Arguments of the per-slice function for one slice.
+
+    The random seed of a slice depends only on the seed of the call and on the slice index, so the
+    slices draw the same numbers with any number of workers and backend.
+    """
+    return tuple(arg.for_slice(slice_z) if isinstance(arg, IterationMonitor) else
+                 np.random.SeedSequence(arg.entropy, spawn_key=arg.spawn_key + (slice_z,))
+                 if isinstance(arg, np.random.SeedSequence) else arg for arg in args)
+
+
+def _slice_kwargs(rec, has_init, terms, slice_z):
+    """
+    @brief Keyword arguments with the initial image and the terms of the model (additive, weights) of a slice, when they are given.
+    """
+    kwargs = {"init": np.array(rec[slice_z], copy=True)} if has_init else {}
+    for name, term in terms.items():
+        kwargs[name] = term[slice_z]
+    return kwargs
+
+
+def _share(array, blocks):
+    """
+    @brief Copies an array into a new shared memory block.
+
+    @param array Array to be shared
+    @param blocks List where the created block is appended (the caller releases it)
+    @return Specification (name, shape, dtype) used by the workers to attach to the block
+    """
+    block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    blocks.append(block)
+    spec = (block.name, array.shape, array.dtype.str)
+    _view(block, spec)[...] = array
+    return spec
+
+
+def _view(block, spec):
+    """
+    @brief Numpy array backed by a shared memory block.
+    """
+    return np.ndarray(spec[1], dtype=np.dtype(spec[2]), buffer=block.buf)
+
+
+def _attach(spec):
+    """
+    @brief Attaches a worker to a shared memory block created by the parent process.
+
+    @return (block, array)
+    """
+    block = shared_memory.SharedMemory(name=spec[0])
+    return block, _view(block, spec)
+
+
+def _is_plan_tuple(arg):
+    """
+    @brief Checks whether an argument is a tuple of plans (e.g. the stages of a subset schedule).
+    """
+    return isinstance(arg, tuple) and len(arg) > 0 and all(isinstance(plan, ReconstructionPlan) for plan in arg)
+
+
+def _share_plan(plan, blocks, matrices=None):
+    """
+    @brief Copy of a plan whose system matrix lives in shared memory.
+
+    The sensitivity images are computed here, once, instead of in every worker. Plans that share
+    a system matrix (see ReconstructionPlan.with_subsets) share its block through matrices.
+    """
+    plan.sensitivity
+    plan.subset_sensitivity
+    shared = copy.copy(plan)
+    # as submatrizes das regiões de interesse seguem nos argumentos de quem as usa
+    shared._regions = {}
+    # as submatrizes dos subsets são refeitas sobre a matriz compartilhada
+    shared._subset_matrices = None
+    if plan.system_matrix is not None:
+        matrices = {} if matrices is None else matrices
+        if id(plan.system_matrix) not in matrices:
+            matrices[id(plan.system_matrix)] = _share(plan.system_matrix, blocks)
+        shared.system_matrix = matrices[id(plan.system_matrix)]
+    return shared
+
+
+def _attach_plan(plan, handles, attached):
+    """
+    @brief Attaches the system matrix of a shared plan, once per shared block.
+    """
+    if isinstance(plan.system_matrix, tuple):
+        name = plan.system_matrix[0]
+        if name not in attached:
+            block, attached[name] = _attach(plan.system_matrix)
+            handles.append(block)
+        plan.system_matrix = attached[name]
+
+
+def _share_monitor(monitor, blocks):
+    """
+    @brief Copy of a monitor whose captured estimates are gathered in shared memory.
+
+    The workers cannot write to the array (or HDF5 dataset) of the parent, so they write to a
+    shared block that is copied to it when all the slices are done.
+    """
+    shared = copy.copy(monitor)
+    if monitor.iterates is not None:
+        shared.iterates = _share(np.full(monitor.iterates.shape, np.nan), blocks)
+    return shared
+
+
+def _init_worker(function, args, sino_spec, rec_spec, init=False, term_specs=None):
+    """
+    @brief Initializer of the worker processes, attaches to the shared blocks.
+    """
+    handles = []
+    attached = {}
+    attached_args = []
+    for arg in args:
+        if isinstance(arg, ReconstructionPlan):
+            _attach_plan(arg, handles, attached)
+        if _is_plan_tuple(arg):
+            for plan in arg:
+                _attach_plan(plan, handles, attached)
+        if isinstance(arg, IterationMonitor) and isinstance(arg.iterates, tuple):
+            block, arg.iterates = _attach(arg.iterates)
+            handles.append(block)
+        attached_args.append(arg)
+    sino_block, sinogram = _attach(sino_spec)
+    rec_block, rec = _attach(rec_spec)
+    handles.extend([sino_block, rec_block])
+    terms = {}
+    for name, spec in (term_specs or {}).items():
+        block, terms[name] = _attach(spec)
+        handles.append(block)
+
+    _worker["function"] = function
+    _worker["args"] = tuple(attached_args)
+    _worker["sinogram"] = sinogram
+    _worker["rec"] = rec
+    _worker["init"] = init
+    _worker["terms"] = terms
+    _worker["handles"] = handles
+
+
+def _reconstruct_slice(slice_z):
+    """
+    @brief Task executed by the workers, reconstructs one slice into the shared output volume.
+    """
+    kwargs = _slice_kwargs(_worker["rec"], _worker["init"], _worker["terms"], slice_z)
+    _worker["rec"][slice_z] = _worker["function"](_worker["sinogram"][slice_z], *_slice_args(_worker["args"], slice_z), **kwargs)
+    return slice_z
@@ -5,6 +5,21 @@ from GimnTools.ImaGIMN.gimnRec.reconstructors.rotation_reconstruction import rot
 from GimnTools.ImaGIMN.gimnRec.reconstructors.line_integral_reconstructor import line_integral_reconstructor
 
 from GimnTools.ImaGIMN.gimnRec.corrections import *
+from GimnTools.ImaGIMN.gimnRec.reconstruction_filters import apply_filter_to_sinogram, ramLak
+from GimnTools.ImaGIMN.gimnRec.projectors import system_matrix_views
+from GimnTools.ImaGIMN.gimnRec.reconstruction_plan import cached_plan, make_geometry
+from GimnTools.ImaGIMN.gimnRec.reconstructors.slice_parallel import reconstruct_slices
+from GimnTools.ImaGIMN.gimnRec.reconstructors.acceleration import momentum_em
+from GimnTools.ImaGIMN.gimnRec.reconstructors import map_em
+from GimnTools.ImaGIMN.gimnRec.iteration_control import iteration_monitor, monitored_result
+from GimnTools.ImaGIMN.gimnRec.subset_schedule import subset_schedule
+from GimnTools.ImaGIMN.gimnRec.reconstructors.multiresolution import multigrid_estimate, multigrid_levels
+from GimnTools.ImaGIMN.gimnRec.reconstructors.dynamic import frame_term, stream_frames
+from GimnTools.ImaGIMN.gimnRec.priors import tv_gradient
+from GimnTools.ImaGIMN.gimnRec.reconstructors.em_kernels import mlem_system_matrix_kernel, osem_system_matrix_kernel
+from GimnTools.ImaGIMN.gimnRec.reconstructors.em_kernels import osem_system_matrix_rows_kernel
+from GimnTools.ImaGIMN.gimnRec.reconstructors.em_kernels import mlem_system_matrix_batch_kernel, osem_system_matrix_batch_kernel
+from GimnTools.ImaGIMN.gimnRec.reconstructors.em_kernels import osem_system_matrix_rows_batch_kernel
 
 
 
@@ -14,31 +29,15 @@ from GimnTools.ImaGIMN.gimnRec.corrections import *
 
 
 
-@njit
-def compute_tv_gradient(image, epsilon=1e-8):
-    rows, cols = image.shape
-    tv_grad = np.zeros_like(image)
-    for i in range(rows):
-        for j in range(cols):
-            val = 0.0
-            # Vizinho esquerdo
-            if i > 0:
-                diff = image[i, j] - image[i-1, j]
-                val += diff / np.sqrt(diff**2 + epsilon)
-            # Vizinho direito
-            if i < rows - 1:
-                diff = image[i, j] - image[i+1, j]
-                val += diff / np.sqrt(diff**2 + epsilon)
-            # Vizinho superior
-            if j > 0:
-                diff = image[i, j] - image[i, j-1]
-                val += diff / np.sqrt(diff**2 + epsilon)
-            # Vizinho inferior
-            if j < cols - 1:
-                diff = image[i, j] - image[i, j+1]
-                val += diff / np.sqrt(diff**2 + epsilon)
-            tv_grad[i, j] = val
-    return tv_grad
+def compute_tv_gradient(image, epsilon=1e-8, out=None):
+    """
+    @brief Gradient of the anisotropic total variation, sum over the 4 neighbours of (x_j - x_k) / sqrt((x_j - x_k)² + epsilon).
+    @param[in] image Image (or volume) whose TV gradient is computed.
+    @param[in] epsilon Small value for numerical stability.
+    @param[in] out Preallocated array that receives the gradient.
+    @return The TV gradient (see priors.tv_gradient).
+    """
+    return tv_gradient(image, epsilon, out=out)
 
 
 @njit
@@ -93,7 +92,7 @@ class reconstructor_system_matrix_cpu(line_integral_reconstructor):
     correction_center = 0  # Center of rotation for correction
     sens_img = 0  # Sensitivity image
 
-    def __init__(self, sinogram=None, center_of_rotation=None, transpose=None):
+    def __init__(self, sinogram=None, center_of_rotation=None, transpose=None, workers=1, backend="process"):
         """
         @brief Constructor for the reconstructor_system_matrix_cpu class.
         @param[in] path Optional file path for data.
@@ -101,8 +100,10 @@ class reconstructor_system_matrix_cpu(line_integral_reconstructor):
         @param[in] sinogram_order Tuple defining the order of dimensions in the sinogram.
         @param[in] center_of_rotation Center of rotation for the image.
         @param[in] transpose Optional transpose parameter for image adjustment.
+        @param[in] workers Number of workers used to reconstruct the slices in parallel.
+        @param[in] backend Kind of worker, "process" or "thread". Threads share one system matrix.
         """
-        super(reconstructor_system_matrix_cpu, self).__init__(sinogram, center_of_rotation)
+        super(reconstructor_system_matrix_cpu, self).__init__(sinogram, center_of_rotation, workers, backend)
 
         self.nxd = self.sinogram.shape[2]
         self.nrd = int(self.nxd)
@@ -122,6 +123,16 @@ class reconstructor_system_matrix_cpu(line_integral_reconstructor):
         # Reshape the image and apply the system matrix to generate the sinogram
         return np.reshape(np.matmul(sys_mat, np.reshape(image, (self.nxd * self.nxd, 1))), (self.nphi, self.nrd))
 
+    def forward_project_views(self, image, sys_mat, block_size=1):
+        """
+        @brief Streams the forward projection of the image one block of views at a time.
+        @param[in] image The image to be forward-projected.
+        @param[in] sys_mat The system matrix for projection.
+        @param[in] block_size Number of views yielded per block.
+        @return Generator of (indices, views), each block of views with shape (len(indices), nrd).
+        """
+        return system_matrix_views(image, sys_mat, self.nrd, block_size)
+
     def backproject(self, sino, sys_mat):
         """
         @brief Backprojects the sinogram using the system matrix to generate the image.
@@ -132,166 +143,847 @@ class reconstructor_system_matrix_cpu(line_integral_reconstructor):
         # Reshape the sinogram and apply the transposed system matrix to generate the image
         return np.reshape(np.matmul(sys_mat.T, np.reshape(sino, (self.nrd * self.nphi, 1))), (self.nxd, self.nxd))
 
-    def mlem(self, num_its, angles):
+    def get_plan(self, angles, subsets=1):
+        """
+        @brief Returns the reconstruction plan (system matrix, subsets and sensitivity images).
+        @details The plan is computed only once and shared by every slice, algorithm and later call.
+        Plans with a different number of subsets reuse the same system matrix.
+        @param[in] angles Array of projection angles (in degrees).
+        @param[in] subsets Number of subsets.
+        @return ReconstructionPlan of the "system_matrix" engine.
+        """
+        geometry = make_geometry(self.nxd, self.nrd, self.correction_center)
+        return cached_plan(self.plans, geometry, angles, subsets, "system_matrix", ordering=self.subset_ordering)
+
+    def _fbp_volume(self, plan, sinogram):
+        """
+        @brief FBP of every slice: Ram-Lak filter along the distances and backprojection with the system matrix.
+        @param[in] plan ReconstructionPlan of the "system_matrix" engine.
+        @param[in] sinogram Sinogram stack of the reconstructed slices.
+        @return Volume (slices, nxd, nxd), without clipping.
+        """
+        filtered = np.asarray([apply_filter_to_sinogram(ramLak, np.asarray(sino, dtype=np.float64).T).T
+                               for sino in sinogram])
+        return _unstack_columns(plan.system_matrix.T @ _stack_columns(filtered), plan.nxd)
+
+    def _project_slice(self, image, plan):
+        """
+        @brief Projection of one image with the system matrix of the plan.
+        """
+        return plan.system_matrix @ image.ravel()
+
+    def get_multigrid_estimate(self, multigrid, plan, sinogram, init=None, additive=None, weights=None):
+        """
+        @brief Returns the initial estimate given by the coarse levels of a multigrid reconstruction.
+        @param[in] multigrid True or a list of (factor, iterations) levels (see multiresolution.multigrid_levels).
+        @param[in] plan ReconstructionPlan of the full grid; the levels use its subsets.
+        @param[in] sinogram Sinogram stack of the reconstructed slices, ordered (slices, angles, distances).
+        @param[in] init Must be None, the coarsest level starts from the uniform image.
+        @param[in] additive Additive term of the selected slices (see get_additive).
+        @param[in] weights Multiplicative weights of the selected slices (see get_weights).
+        @return Volume (slices, nxd, nxd).
+        """
+        if init is not None:
+            raise ValueError("multigrid and init cannot be used together")
+
+        def iterate(coarse, coarse_plan, num_its, estimate, coarse_additive, coarse_weights):
+            return reconstruct_slices(_osem_slice, coarse, (coarse_plan.nxd, coarse_plan.nxd), (coarse_plan, num_its),
+                                      self.workers, self.backend, init=estimate, additive=coarse_additive,
+                                      weights=coarse_weights)
+
+        return multigrid_estimate(multigrid_levels(multigrid), sinogram, plan, self.plans, 2, iterate, self._project_slice,
+                                  additive, weights)
+
+    def _start_estimate(self, init, plan, sinogram, slices, roi, multigrid, additive, weights):
+        """
+        @brief Initial estimate of mlem and osem: the coarse levels of multigrid, or init ("fbp" by default with a roi).
+        """
+        if multigrid is not None:
+            return self.get_multigrid_estimate(multigrid, plan, sinogram, init, additive, weights)
+        if init is None and roi is not None:
+            init = "fbp"
+        return self.get_initial_estimate(init, plan, slices, additive, weights)
+
+    def _reconstruct_region(self, sinogram, plan, num_its, monitor, init, roi, margin, additive=None, weights=None):
+        """
+        @brief MLEM/OSEM (the subsets of the plan) restricted to an in-plane region of interest.
+        @param[in] sinogram Sinogram stack of the reconstructed slices.
+        @param[in] plan ReconstructionPlan of the "system_matrix" engine.
+        @param[in] num_its Number of iterations.
+        @param[in] monitor IterationMonitor of the call.
+        @param[in] init Initial volume (slices, nxd, nxd), which also gives the activity outside the region.
+        @param[in] roi Region of interest (x0, x1, y0, y1).
+        @param[in] margin Pixels added around roi.
+        @param[in] additive Additive term of the selected slices, None for none.
+        @param[in] weights Multiplicative weights of the selected slices, None for none.
+        @return Volume (slices, nxd, nxd), zero outside the region.
+        """
+        region = plan.region(roi, margin)
+        return reconstruct_slices(_region_slice, sinogram, (self.nxd, self.nxd), (plan, region, num_its, monitor),
+                                  self.workers, self.backend, init=init, additive=additive, weights=weights)
+
+    def mlem(self, num_its, angles, plan=None, batched=False, on_iteration=None, tol=None, max_time=None,
+             checkpoint=None, checkpoint_every=None, checkpoint_seconds=None, resume=False,
+             save_iterates=None, iterates=None, init=None, slices=None, roi=None, margin=4, multigrid=None, additive=None,
+             weights=None):
         """
         @brief Performs image reconstruction using the Maximum Likelihood Expectation Maximization (MLEM) algorithm.
         @param[in] num_its Number of iterations for MLEM.
-        @param[in] angles Array of projection angles (in radians).
+        @param[in] angles Array of projection angles (in degrees).
+        @param[in] plan ReconstructionPlan to be used, by default the cached plan of angles.
+        @param[in] batched Reconstructs all the slices at once, as the columns of a (nxd², slices) matrix,
+                   so the system matrix is read once per iteration instead of once per slice.
+        @param[in] on_iteration Function called as on_iteration(state) after each iteration (see IterationState).
+        @param[in] tol Stops a slice when the relative change of its estimate is below tol.
+        @param[in] max_time Stops the iterations after max_time seconds.
+        @param[in] checkpoint Directory where the checkpoints of the slices are written.
+        @param[in] checkpoint_every Writes a checkpoint every checkpoint_every iterations (1 if neither this nor checkpoint_seconds is given).
+        @param[in] checkpoint_seconds Writes a checkpoint every checkpoint_seconds seconds.
+        @param[in] resume Continues from the checkpoints (True uses checkpoint, or the directory to resume from).
+        @param[in] save_iterates Iterations (counted from 1) whose estimates are captured; the method then returns (rec, iterates).
+        @param[in] iterates Array or h5py dataset (len(save_iterates), slices, nxd, nxd) that receives them, allocated when None.
+        @param[in] init Initial estimate: None for the uniform image, "fbp" for the positive FBP scaled to the counts
+                   of each slice, or an array (slices, nxd, nxd) or (nxd, nxd).
+        @param[in] slices Indices of the slices to reconstruct (list, array or slice), None for all; the others are skipped.
+        @param[in] roi In-plane region of interest (x0, x1, y0, y1), columns x0:x1 and rows y0:y1 of the image. Only the
+                   region plus margin is iterated, against the projection of the initial estimate outside it ("fbp"
+                   by default); the pixels outside the region are zero in the result.
+        @param[in] margin Pixels added around roi, which absorb the error of the initial estimate at its border.
+        @param[in] multigrid Coarse-to-fine start: True or a list of (factor, iterations) levels run before the iterations at
+                   full resolution, on grids factor times coarser (see multiresolution.multigrid_levels).
+        @param[in] additive Additive term (randoms and scatter) of the expected counts, y / (A x + r) in the updates: a number
+                   or an array laid out as the sinogram (see get_additive).
+        @param[in] weights Multiplicative weights of the expected counts w A x + r (normalization, other corrections): a number
+                   or an array laid out as the sinogram (see get_weights); the attenuation of set_attenuation is always included.
         @return Reconstructed image after MLEM.
         """
-        # Initialize the reconstruction image with ones
-        recon = np.ones((self.slice, self.nxd, self.nxd))
-        slice_count = self.slice_n()
-        
-        for slice_z in range(self.sinogram.shape[0]):
-            # Select the sinogram slice to be reconstructed
-            sino_for_reconstruction = self.sinogram[slice_z]
-            # Calculate the center of rotation for correction
-            # Generate the system matrix
-            sys_mat = system_matrix(nxd=self.nxd, nrd=self.nrd, nphi=self.nphi, angles=angles)
-            # Generate a sinogram of ones for sensitivity image calculation
-            sino_ones = np.ones_like(sino_for_reconstruction)
-            # Compute the sensitivity image by backprojecting the sinogram of ones
-            sens_image = self.backproject(sino_ones, sys_mat)
-
-            # Perform the MLEM iteration
-            for it in range(num_its):
-                # print(it)
-                # Forward project the current reconstruction estimate
-                fpsino = self.forward_project(recon[slice_z, :, :], sys_mat)
-                # Compute the ratio between the original sinogram and the forward projection
-
-              
-                ratio = sino_for_reconstruction / (fpsino + 1.0e-9)
-                # Compute the correction factor by backprojecting the ratio
-                correction = self.backproject(ratio, sys_mat) / (sens_image + 1e-9)
-                # Update the reconstruction by multiplying with the correction factor
-                recon[slice_z, :, :] *= correction    
-            #recon [slice_z] = (recon[slice_z]/recon[slice_z].sum())*slice_count[slice_z]
-
-
-        return recon
-
-
-    def osem(self, num_its, num_subsets, angles, show_images=False):
+        if plan is None:
+            plan = self.get_plan(angles)
+        sinogram = self.slice_sinogram(slices)
+        additive = self.get_additive(additive, slices)
+        weights = self.get_weights(weights, plan, slices)
+        monitor = iteration_monitor(on_iteration, tol, max_time, checkpoint, checkpoint_every,
+                                    checkpoint_seconds, resume, save_iterates, iterates)
+        init = self._start_estimate(init, plan, sinogram, slices, roi, multigrid, additive, weights)
+        if roi is not None:
+            if batched:
+                raise ValueError("roi is not available with batched=True")
+            return monitored_result(self._reconstruct_region(sinogram, plan, num_its, monitor, init, roi, margin, additive,
+                                                             weights), monitor)
+        if batched:
+            recon = _mlem_batch(sinogram, plan, num_its, monitor, init, additive, weights)
+        else:
+            recon = reconstruct_slices(_mlem_slice, sinogram, (self.nxd, self.nxd), (plan, num_its, monitor), self.workers, self.backend,
+                                       init=init, additive=additive, weights=weights)
+        return monitored_result(recon, monitor)
+
+
+    def osem(self, num_its, num_subsets, angles, show_images=False, plan=None, batched=False,
+             on_iteration=None, tol=None, max_time=None, checkpoint=None, checkpoint_every=None,
+             checkpoint_seconds=None, resume=False, save_iterates=None, iterates=None, schedule=None, init=None, slices=None,
+             roi=None, margin=4, multigrid=None, additive=None, weights=None):
+        """
+        @brief Performs image reconstruction using the Ordered Subset Expectation Maximization (OSEM) algorithm.
+        @param[in] num_its Number of iterations for OSEM.
+        @param[in] num_subsets Number of subsets.
+        @param[in] angles Array of projection angles (in degrees).
+        @param[in] show_images Shows each reconstructed slice.
+        @param[in] plan ReconstructionPlan to be used, by default the cached plan of angles and num_subsets.
+        @param[in] batched Reconstructs all the slices at once, one matrix-matrix product per subset.
+        @param[in] on_iteration Function called as on_iteration(state) after each iteration (see IterationState).
+        @param[in] tol Stops a slice when the relative change of its estimate is below tol.
+        @param[in] max_time Stops the iterations after max_time seconds.
+        @param[in] checkpoint Directory where the checkpoints of the slices are written.
+        @param[in] checkpoint_every Writes a checkpoint every checkpoint_every iterations (1 if neither this nor checkpoint_seconds is given).
+        @param[in] checkpoint_seconds Writes a checkpoint every checkpoint_seconds seconds.
+        @param[in] resume Continues from the checkpoints (True uses checkpoint, or the directory to resume from).
+        @param[in] save_iterates Iterations (counted from 1) whose estimates are captured; the method then returns (rec, iterates).
+        @param[in] iterates Array or h5py dataset (len(save_iterates), slices, nxd, nxd) that receives them, allocated when None.
+        @param[in] schedule Subset schedule: list of (iterations, subsets) stages, "adaptive" or a SubsetSchedule; None keeps num_subsets.
+        @param[in] init Initial estimate (see mlem).
+        @param[in] slices Indices of the slices to reconstruct (list, array or slice), None for all; the others are skipped.
+        @param[in] roi In-plane region of interest (x0, x1, y0, y1), see mlem.
+        @param[in] margin Pixels added around roi (see mlem).
+        @param[in] multigrid Coarse-to-fine start (see mlem).
+        @param[in] additive Additive term of the expected counts (see mlem).
+        @param[in] weights Multiplicative weights of the expected counts (see mlem).
+        @return Reconstructed image after OSEM.
+        """
         print("iterations: ", num_its, " subsets: ", num_subsets)
         print("sino shape: ", self.sinogram.shape)
 
-        # Precompute system matrix
-        sys_mat = system_matrix(self.nxd, self.nrd, self.nphi, angles, self.correction_center)
-        
-        # Create angle indices
-        angle_indices = np.arange(self.nphi)
-        subset_angle_indices = np.array_split(angle_indices, num_subsets)
-        
-        # Precompute subset matrices and sensitivity images
-        subset_matrices = []
-        subset_sens = []
-        for angle_indices in subset_angle_indices:
-            # Calculate row indices for this subset
-            rows = []
-            for angle_idx in angle_indices:
-                rows.extend(range(angle_idx * self.nrd, (angle_idx + 1) * self.nrd))
-            subset_matrix = sys_mat[rows, :]
-            subset_matrices.append(subset_matrix)
-            
-            # Precompute subset sensitivity
-            ones_vec = np.ones(subset_matrix.shape[0])
-            sens_sub = subset_matrix.T @ ones_vec
-            subset_sens.append(sens_sub.reshape(self.nxd, self.nxd))
-
-        # Initialize reconstruction
-        recon = np.ones((self.slice, self.nxd, self.nxd))
-
-        for slice_z in range(self.slice):
-            # print("slice : ", slice_z)
-            sino = self.sinogram[slice_z]
-            
-            # Prepare sinogram subsets
-            sino_subsets = []
-            for angle_indices in subset_angle_indices:
-                sino_sub = sino[angle_indices, :].flatten()
-                sino_subsets.append(sino_sub)
-
-            # OSEM iterations
-            for it in range(num_its):
-                # print("Iteration-", it+1)
-                for ss in range(num_subsets):
-                    sub_mat = subset_matrices[ss]
-                    sub_sino = sino_subsets[ss]
-                    sens_sub = subset_sens[ss]
-                    
-                    # Forward projection
-                    fpsino = sub_mat @ recon[slice_z].ravel()
-                    
-                    # Compute ratio with clipping
-                    ratio = sub_sino / (fpsino + 1e-12)
-                    
-                    # Backproject and update
-                    back_ratio = sub_mat.T @ ratio
-                    recon[slice_z] *= back_ratio.reshape(self.nxd, self.nxd) / (sens_sub + 1e-12)
-
-            if show_images:
+        if plan is None:
+            plan = self.get_plan(angles, num_subsets)
+        sinogram = self.slice_sinogram(slices)
+        additive = self.get_additive(additive, slices)
+        weights = self.get_weights(weights, plan, slices)
+        monitor = iteration_monitor(on_iteration, tol, max_time, checkpoint, checkpoint_every,
+                                    checkpoint_seconds, resume, save_iterates, iterates)
+
+        init = self._start_estimate(init, plan, sinogram, slices, roi, multigrid, additive, weights)
+        if roi is not None:
+            if batched or schedule is not None:
+                raise ValueError("roi is not available with batched=True or a schedule")
+            return monitored_result(self._reconstruct_region(sinogram, plan, num_its, monitor, init, roi, margin, additive,
+                                                             weights), monitor)
+        if schedule is not None:
+            if batched:
+                raise ValueError("schedule is not available with batched=True")
+            schedule = subset_schedule(schedule)
+            recon = reconstruct_slices(_scheduled_osem_slice, sinogram, (self.nxd, self.nxd),
+                                       (self.get_schedule_plans(schedule, plan), num_its, schedule, monitor),
+                                       self.workers, self.backend, init=init, additive=additive, weights=weights)
+        elif batched:
+            recon = _osem_batch(sinogram, plan, num_its, monitor, init, additive, weights)
+        else:
+            recon = reconstruct_slices(_osem_slice, sinogram, (self.nxd, self.nxd), (plan, num_its, monitor), self.workers, self.backend,
+                                       init=init, additive=additive, weights=weights)
+
+        if show_images:
+            from matplotlib import pyplot as plt
+            for slice_z in range(len(recon)):
                 plt.imshow(recon[slice_z], cmap='gray')
                 plt.title(f"Slice {slice_z}")
                 plt.show()
 
-        return recon
-   
+        return monitored_result(recon, monitor)
 
-    def osem_tv(self, num_its, num_subsets, angles, beta=0.1, tv_epsilon=1e-8, sens_image=None, show_images=False):
+    def reconstruct_frames(self, sinograms, num_its, angles, num_subsets=1, output=None, frames_per_batch=4, plan=None,
+                           batched=True, additive=None, weights=None, on_frame=None):
+        """
+        @brief Reconstructs the time frames of a dynamic study with one plan, system matrix and sensitivity.
+        Each frame is laid out as the sinogram stack of the reconstructor. With batched the slices of
+        the frames_per_batch frames of a batch are the columns of the batched kernels, so every
+        iteration reads the system matrix once for all of them; each frame is written to output as
+        soon as its batch is done.
+        @param[in] sinograms Sinograms (frames, slices, angles, distances): an array, memmap or h5py dataset.
+        @param[in] num_its Number of iterations of every frame.
+        @param[in] angles Array of projection angles.
+        @param[in] num_subsets 1 for MLEM, more for OSEM with num_subsets subsets.
+        @param[in] output None for an array in memory, the path of a .npy file written frame by frame, or an array or
+                   h5py dataset (frames, slices, nxd, nxd) (see dynamic.frame_output).
+        @param[in] frames_per_batch Number of frames reconstructed together.
+        @param[in] plan ReconstructionPlan to be used, by default the cached plan of angles and num_subsets.
+        @param[in] batched Reconstructs the slices of a batch as matrix columns; False uses the slice workers.
+        @param[in] additive Additive term: a number, an array laid out as one frame, shared by every frame, or laid out
+                   as sinograms with the term of each frame.
+        @param[in] weights Multiplicative weights shared by every frame (see get_weights); the attenuation and
+                   normalization of the reconstructor are included.
+        @param[in] on_frame Function called as on_frame(frame, volume) after each frame is written.
+        @return output with the reconstructed frames.
+        """
+        if plan is None:
+            plan = self.get_plan(angles, num_subsets)
+        weights = self.get_weights(weights, plan)
+        # com pesos a sensibilidade de cada fatia é calculada uma vez e repetida para os quadros do lote
+        sens = None if weights is None or not batched else _batch_sensitivity(plan, _stack_columns(weights))
+
+        def reconstruct(stack, start, stop, stack_additive):
+            stack_weights = frame_term(weights, sinograms, start, stop, "weights")
+            if not batched:
+                function = _mlem_slice if plan.subsets == 1 else _osem_slice
+                return reconstruct_slices(function, stack, (self.nxd, self.nxd), (plan, num_its), self.workers, self.backend,
+                                          additive=stack_additive, weights=stack_weights)
+            stack_sens = None if sens is None else np.tile(sens, (1, 1, stop - start))
+            if plan.subsets == 1:
+                return _mlem_batch(stack, plan, num_its, None, None, stack_additive, stack_weights,
+                                   None if stack_sens is None else stack_sens[0])
+            return _osem_batch(stack, plan, num_its, None, None, stack_additive, stack_weights, stack_sens)
+
+        return stream_frames(sinograms, reconstruct, self.sinogram.shape, (self.nxd, self.nxd), frames_per_batch, output,
+                             additive, on_frame)
+
+
+    def osem_tv(self, num_its, num_subsets, angles, beta=0.1, tv_epsilon=1e-8, sens_image=None, show_images=False, plan=None,
+                on_iteration=None, tol=None, max_time=None, checkpoint=None, checkpoint_every=None,
+                checkpoint_seconds=None, resume=False, save_iterates=None, iterates=None, init=None, slices=None):
             """
             OSEM com regularização de Variação Total (TV) para reconstrução de última geração.
             
             Parâmetros:
             beta: Força da regularização (controla suavização)
             tv_epsilon: Pequeno valor para estabilidade numérica
+            plan: ReconstructionPlan usado, por padrão o plano em cache para angles e num_subsets
+            on_iteration, tol, max_time, checkpoint, checkpoint_every, checkpoint_seconds, resume, save_iterates, iterates:
+            monitoramento, critérios de parada, checkpoints e captura de iterações (ver mlem)
+            init: estimativa inicial (ver mlem)
+            slices: índices das fatias reconstruídas (ver mlem)
             """
-            recon = np.ones((self.slice, self.nxd, self.nxd))
-            slice_count = self.slice_n()
-
-            for slice_z in range(self.sinogram.shape[0]):
-                # print(f"Processando slice {slice_z}")
-                sino = self.sinogram[slice_z]
-                self.correction_center = rot_center(sino)
-                
-                # Gerar matriz do sistema
-                sys_mat = system_matrix(self.nxd, self.nrd, self.nphi, angles)
-                
-                # Calcular imagem de sensibilidade
-                if sens_image is None:
-                    sino_ones = np.ones_like(sino)
-                    sens_img = self.backproject(sino_ones, sys_mat)
-                else:
-                    sens_img = sens_image
-
-                # Preparar subconjuntos
-                sino1d = sino.reshape(-1, 1)
-                sub_sino = np.array_split(sino1d, num_subsets)
-                sub_mat = np.array_split(sys_mat, num_subsets, axis=0)
-
-                for it in range(num_its):
-                    # print(f"Iteração {it+1}/{num_its}")
-                    
-                    # Loop por subconjuntos
-                    for ss in range(num_subsets):
-                        # Projeção direta
-                        fp = sub_mat[ss] @ recon[slice_z].ravel()
-                        # Calcular razão
-                        ratio = sub_sino[ss] / (fp.reshape(-1, 1) + 1e-10)
-                        ratio = np.clip(ratio, 0, 10)  # Limitar razões extremas
-                        
-                        # Retroprojeção e atualização
-                        correction = sub_mat[ss].T @ ratio
-                        recon[slice_z] *= correction.reshape(self.nxd, self.nxd)
-                    
-                    # Aplicar regularização TV após cada iteração completa
-                    tv_grad = compute_tv_gradient(recon[slice_z], tv_epsilon)
-                    recon[slice_z] /= (sens_img + beta * tv_grad + 1e-9)
-                    
-                    # Normalização
-                    recon[slice_z] = (recon[slice_z] / recon[slice_z].sum()) * slice_count[slice_z]
-
-
-            return recon
+            if plan is None:
+                plan = self.get_plan(angles, num_subsets)
+            sinogram = self.slice_sinogram(slices)
+            monitor = iteration_monitor(on_iteration, tol, max_time, checkpoint, checkpoint_every,
+                                        checkpoint_seconds, resume, save_iterates, iterates)
+            recon = reconstruct_slices(_osem_tv_slice, sinogram, (self.nxd, self.nxd),
+                                       (plan, num_its, beta, tv_epsilon, sens_image, monitor), self.workers, self.backend,
+                                       init=self.get_initial_estimate(init, plan, slices))
+            return monitored_result(recon, monitor)
+
+    def accelerated_osem(self, num_its, num_subsets, angles, momentum="nesterov", relaxation=0.5, restart=True,
+                         plan=None, on_iteration=None, tol=None, max_time=None, checkpoint=None, checkpoint_every=None,
+                         checkpoint_seconds=None, resume=False, save_iterates=None, iterates=None, init=None, slices=None,
+                         additive=None, weights=None):
+        """
+        @brief OSEM (MLEM when num_subsets is 1) accelerated by Nesterov or relaxed momentum with adaptive restart.
+        @details Each iteration extrapolates the estimate along its last update and applies one OSEM pass of the
+        system matrix to the extrapolated point (see acceleration.momentum_em).
+        @param[in] num_its Number of iterations (passes over all the subsets).
+        @param[in] num_subsets Number of subsets.
+        @param[in] angles Array of projection angles (in degrees).
+        @param[in] momentum "nesterov" or "relaxed".
+        @param[in] relaxation Constant momentum of the "relaxed" scheme.
+        @param[in] restart Adaptive restart of the momentum.
+        @param[in] plan ReconstructionPlan to be used, by default the cached plan of angles and num_subsets.
+        @param[in] on_iteration, tol, max_time, checkpoint, checkpoint_every, checkpoint_seconds, resume, save_iterates,
+                   iterates Monitoring, stopping rules, checkpoints and captured iterations (see mlem); a resumed run
+                   restarts the momentum.
+        @param[in] init Initial estimate (see mlem).
+        @param[in] slices Indices of the slices to reconstruct (list, array or slice), None for all; the others are skipped.
+        @param[in] additive Additive term of the expected counts (see mlem).
+        @param[in] weights Multiplicative weights of the expected counts (see mlem).
+        @return Reconstructed image.
+        """
+        if plan is None:
+            plan = self.get_plan(angles, num_subsets)
+        sinogram = self.slice_sinogram(slices)
+        additive = self.get_additive(additive, slices)
+        weights = self.get_weights(weights, plan, slices)
+        monitor = iteration_monitor(on_iteration, tol, max_time, checkpoint, checkpoint_every,
+                                    checkpoint_seconds, resume, save_iterates, iterates)
+        recon = reconstruct_slices(_accelerated_osem_slice, sinogram, (self.nxd, self.nxd),
+                                   (plan, num_its, momentum, relaxation, restart, monitor), self.workers, self.backend,
+                                   init=self.get_initial_estimate(init, plan, slices, additive, weights), additive=additive,
+                                   weights=weights)
+        return monitored_result(recon, monitor)
+
+    def bsrem(self, num_its, num_subsets, angles, prior="relative_difference", beta=0.1, delta=1.0, relaxation=1.0,
+              relaxation_decay=0.1, upper=None, plan=None, on_iteration=None, tol=None, max_time=None, checkpoint=None,
+              checkpoint_every=None, checkpoint_seconds=None, resume=False, save_iterates=None, iterates=None,
+              init=None, slices=None):
+        """
+        @brief Regularized reconstruction with BSREM (block sequential regularized EM).
+        @details Converges to the maximum of the penalized likelihood L(x) - beta R(x) thanks to the
+        decreasing relaxation relaxation / (1 + relaxation_decay n) (see map_em.bsrem).
+        @param[in] num_its Number of iterations (passes over all the subsets).
+        @param[in] num_subsets Number of subsets.
+        @param[in] angles Array of projection angles (in degrees).
+        @param[in] prior "quadratic", "logcosh" or "relative_difference" (see priors.prior_gradient).
+        @param[in] beta Regularization strength.
+        @param[in] delta Parameter of the prior potential.
+        @param[in] relaxation Initial relaxation.
+        @param[in] relaxation_decay Decay of the relaxation per iteration.
+        @param[in] upper Upper bound of the estimate, None for no bound.
+        @param[in] plan ReconstructionPlan to be used, by default the cached plan of angles and num_subsets.
+        @param[in] on_iteration, tol, max_time, checkpoint, checkpoint_every, checkpoint_seconds, resume, save_iterates,
+                   iterates Monitoring, stopping rules, checkpoints and captured iterations (see mlem).
+        @param[in] init Initial estimate (see mlem).
+        @param[in] slices Indices of the slices to reconstruct (list, array or slice), None for all; the others are skipped.
+        @return Reconstructed image.
+        """
+        if plan is None:
+            plan = self.get_plan(angles, num_subsets)
+        sinogram = self.slice_sinogram(slices)
+        monitor = iteration_monitor(on_iteration, tol, max_time, checkpoint, checkpoint_every,
+                                    checkpoint_seconds, resume, save_iterates, iterates)
+        recon = reconstruct_slices(_bsrem_slice, sinogram, (self.nxd, self.nxd),
+                                   (plan, num_its, prior, beta, delta, relaxation, relaxation_decay, upper, monitor),
+                                   self.workers, self.backend, init=self.get_initial_estimate(init, plan, slices))
+        return monitored_result(recon, monitor)
+
+    def osl_map_em(self, num_its, num_subsets, angles, prior="huber", beta=0.1, delta=1.0, axial=False, plan=None,
+                   on_iteration=None, tol=None, max_time=None, checkpoint=None, checkpoint_every=None,
+                   checkpoint_seconds=None, resume=False, save_iterates=None, iterates=None, init=None, slices=None):
+        """
+        @brief Regularized reconstruction with one-step-late MAP-EM over ordered subsets.
+        @details The prior gradient is evaluated at the current estimate and added to the sensitivity in the
+        denominator of the EM update (see map_em.osl_em). With beta = 0 it is OSEM.
+        @param[in] num_its Number of iterations (passes over all the subsets).
+        @param[in] num_subsets Number of subsets.
+        @param[in] angles Array of projection angles (in degrees).
+        @param[in] prior "quadratic", "huber" or "relative_difference" (see priors.prior_gradient).
+        @param[in] beta Regularization strength.
+        @param[in] delta Parameter of the prior potential.
+        @param[in] axial False regularizes each slice with its 8 in-plane neighbours; True reconstructs the
+                   whole volume at once with the 26 neighbours, coupling neighbouring slices.
+        @param[in] plan ReconstructionPlan to be used, by default the cached plan of angles and num_subsets.
+        @param[in] on_iteration, tol, max_time, checkpoint, checkpoint_every, checkpoint_seconds, resume, save_iterates,
+                   iterates Monitoring, stopping rules, checkpoints and captured iterations (see mlem); with
+                   axial=True the metrics have one value per slice, as in the batched mode.
+        @param[in] init Initial estimate (see mlem).
+        @param[in] slices Indices of the slices to reconstruct (list, array or slice), None for all; the others are skipped.
+        @return Reconstructed image.
+        """
+        if plan is None:
+            plan = self.get_plan(angles, num_subsets)
+        sinogram = self.slice_sinogram(slices)
+        monitor = iteration_monitor(on_iteration, tol, max_time, checkpoint, checkpoint_every,
+                                    checkpoint_seconds, resume, save_iterates, iterates)
+        init = self.get_initial_estimate(init, plan, slices)
+        if axial:
+            recon = _osl_volume(sinogram, plan, num_its, prior, beta, delta, monitor, init)
+        else:
+            recon = reconstruct_slices(_osl_slice, sinogram, (self.nxd, self.nxd),
+                                       (plan, num_its, prior, beta, delta, monitor), self.workers, self.backend,
+                                       init=init)
+        return monitored_result(recon, monitor)
+
+
+def _additive(additive, sino):
+    """
+    @brief Flattened additive term passed to the kernels, zeros when the slice has none.
+    """
+    return np.zeros_like(sino) if additive is None else np.ascontiguousarray(additive, dtype=np.float64).ravel()
 
+
+def _weights(weights, sino):
+    """
+    @brief Flattened multiplicative weights passed to the kernels, ones when the slice has none.
+    """
+    return np.ones_like(sino) if weights is None else np.ascontiguousarray(weights, dtype=np.float64).ravel()
+
+
+def _mlem_slice(sino, plan, num_its, monitor=None, init=None, additive=None, weights=None):
+    """
+    @brief MLEM iterations of a single slice.
+    @param[in] sino Sinogram of the slice, ordered (angles, distances).
+    @param[in] plan ReconstructionPlan of the "system_matrix" engine.
+    @param[in] num_its Number of iterations.
+    @param[in] monitor IterationMonitor of the slice, None runs all the iterations.
+    @param[in] init Initial image of the slice, None for the uniform image.
+    @param[in] additive Additive term of the slice, ordered as sino, None for none.
+    @param[in] weights Multiplicative weights of the slice, ordered as sino, None for none.
+    @return Reconstructed slice.
+    """
+    recon = np.ones(plan.nxd * plan.nxd) if init is None else init.ravel()
+    plan = plan.weighted(weights)
+    sino = np.ascontiguousarray(sino, dtype=np.float64).ravel()
+    additive = _additive(additive, sino)
+    weights = _weights(weights, sino)
+    projection = np.zeros_like(sino)
+    sens = plan.sensitivity.ravel()
+    if monitor is None:
+        mlem_system_matrix_kernel(plan.system_matrix, sino, additive, weights, sens, num_its, recon, projection)
+        return recon.reshape(plan.nxd, plan.nxd)
+
+    for it in range(monitor.start(recon), num_its):
+        mlem_system_matrix_kernel(plan.system_matrix, sino, additive, weights, sens, 1, recon, projection)
+        if monitor.update(it, recon, sino, projection):
+            break
+    return recon.reshape(plan.nxd, plan.nxd)
+
+
+def _osem_iterations(plan, sino, additive, weights, recon, projection, subset_sens, num_its):
+    """
+    @brief OSEM iterations with the kernel that fits the subsets of the plan.
+    @param[in] plan ReconstructionPlan of the "system_matrix" engine.
+    @param[in] sino Flattened sinogram of the slice.
+    @param[in] additive Flattened additive term of the slice.
+    @param[in] weights Flattened multiplicative weights of the slice.
+    @param[in] recon Flattened estimate, updated in place.
+    @param[in] projection Flattened projection of the estimate, updated in place.
+    @param[in] subset_sens Flattened sensitivity of each subset.
+    @param[in] num_its Number of iterations.
+    """
+    bounds = plan.subset_bounds
+    if bounds is not None:
+        osem_system_matrix_kernel(plan.system_matrix, sino, additive, weights, bounds, subset_sens, num_its, recon, projection)
+    else:
+        # subsets intercalados: o kernel percorre as linhas de cada subset sem copiar a matriz
+        rows, offsets = plan.subset_row_order
+        osem_system_matrix_rows_kernel(plan.system_matrix, sino, additive, weights, rows, offsets, subset_sens, num_its, recon,
+                                       projection)
+
+
+def _osem_slice(sino, plan, num_its, monitor=None, init=None, additive=None, weights=None):
+    """
+    @brief OSEM iterations of a single slice.
+    @param[in] sino Sinogram of the slice, ordered (angles, distances).
+    @param[in] plan ReconstructionPlan of the "system_matrix" engine.
+    @param[in] num_its Number of iterations.
+    @param[in] monitor IterationMonitor of the slice, None runs all the iterations.
+    @param[in] init Initial image of the slice, None for the uniform image.
+    @param[in] additive Additive term of the slice, ordered as sino, None for none.
+    @param[in] weights Multiplicative weights of the slice, ordered as sino, None for none.
+    @return Reconstructed slice.
+    """
+    recon = np.ones(plan.nxd * plan.nxd) if init is None else init.ravel()
+    plan = plan.weighted(weights)
+    sino = np.ascontiguousarray(sino, dtype=np.float64).ravel()
+    additive = _additive(additive, sino)
+    weights = _weights(weights, sino)
+    projection = np.zeros_like(sino)
+    subset_sens = np.asarray([sens.ravel() for sens in plan.subset_sensitivity])
+    if monitor is None:
+        _osem_iterations(plan, sino, additive, weights, recon, projection, subset_sens, num_its)
+        return recon.reshape(plan.nxd, plan.nxd)
+
+    first = monitor.start(recon)
+    for it in range(first, num_its):
+        _osem_iterations(plan, sino, additive, weights, recon, projection, subset_sens, 1)
+        if monitor is not None and monitor.update(it, recon, sino, projection):
+            break
+    return recon.reshape(plan.nxd, plan.nxd)
+
+
+def _region_slice(sino, plan, region, num_its, monitor=None, init=None, additive=None, weights=None):
+    """
+    @brief MLEM/OSEM iterations of a single slice restricted to a region of interest.
+    @details The activity outside the region is the initial estimate; its projection is computed once and added to the
+    projection of the region in the ratio of every subset, so the iterations only read the submatrices of the region.
+    @param[in] sino Sinogram of the slice, ordered (angles, distances).
+    @param[in] plan ReconstructionPlan of the "system_matrix" engine.
+    @param[in] region Region of the plan (see ReconstructionPlan.region).
+    @param[in] num_its Number of iterations.
+    @param[in] monitor IterationMonitor of the slice, None runs all the iterations.
+    @param[in] init Initial image of the slice.
+    @param[in] additive Additive term of the slice, ordered as sino, None for none.
+    @param[in] weights Multiplicative weights of the slice, ordered as sino, None for none.
+    @return Reconstructed slice, zero outside the region.
+    """
+    columns, subset_rows, matrices, sensitivities = region
+    recon = init.ravel()
+    sino = np.ascontiguousarray(sino, dtype=np.float64).ravel()
+    if weights is not None:
+        sensitivities = [matrix.T @ np.ravel(weights)[rows] for rows, matrix in zip(subset_rows, matrices)]
+    weights = _weights(weights, sino)
+    # projeção da atividade fora da região, fixa durante as iterações
+    outside = recon.copy()
+    outside[columns] = 0.0
+    background = weights * (plan.system_matrix @ outside) + _additive(additive, sino)
+    projection = background.copy()
+    first = 0
+    if monitor is not None:
+        first = monitor.start(recon)
+    estimate = recon[columns].copy()
+    for it in range(first, num_its):
+        for rows, matrix, sens in zip(subset_rows, matrices, sensitivities):
+            fpsino = weights[rows] * (matrix @ estimate) + background[rows]
+            projection[rows] = fpsino
+            estimate *= (matrix.T @ (weights[rows] * sino[rows] / (fpsino + 1e-12))) / (sens + 1e-12)
+        recon[columns] = estimate
+        if monitor is not None and monitor.update(it, recon, sino, projection):
+            break
+    result = np.zeros(plan.nxd * plan.nxd)
+    result[columns] = estimate
+    return result.reshape(plan.nxd, plan.nxd)
+
+
+def _scheduled_osem_slice(sino, plans, num_its, schedule, monitor=None, init=None, additive=None, weights=None):
+    """
+    @brief OSEM iterations of a single slice with a subset schedule.
+    @param[in] sino Sinogram of the slice, ordered (angles, distances).
+    @param[in] plans Plans of every number of subsets of the schedule (see get_schedule_plans).
+    @param[in] num_its Number of iterations.
+    @param[in] schedule SubsetSchedule.
+    @param[in] monitor IterationMonitor of the slice, None runs all the iterations.
+    @param[in] init Initial image of the slice, None for the uniform image.
+    @param[in] additive Additive term of the slice, ordered as sino, None for none.
+    @param[in] weights Multiplicative weights of the slice, ordered as sino, None for none.
+    @return Reconstructed slice.
+    """
+    plans = {plan.subsets: plan.weighted(weights) for plan in plans}
+    subset_sens = {subsets: np.asarray([sens.ravel() for sens in plan.subset_sensitivity])
+                   for subsets, plan in plans.items()}
+    plan = next(iter(plans.values()))
+    schedule = schedule.for_slice(plan.subsets)
+    recon = np.ones(plan.nxd * plan.nxd) if init is None else init.ravel()
+    sino = np.ascontiguousarray(sino, dtype=np.float64).ravel()
+    additive = _additive(additive, sino)
+    weights = _weights(weights, sino)
+    projection = np.zeros_like(sino)
+    first = 0
+    if monitor is not None:
+        first = monitor.start(recon)
+    for it in range(first, num_its):
+        subsets = schedule.subsets_at(it)
+        _osem_iterations(plans[subsets], sino, additive, weights, recon, projection, subset_sens[subsets], 1)
+        if monitor is not None and monitor.update(it, recon, sino, projection):
+            break
+        schedule.update(sino, projection)
+    return recon.reshape(plan.nxd, plan.nxd)
+
+
+def _accelerated_osem_slice(sino, plan, num_its, momentum, relaxation, restart, monitor=None, init=None, additive=None,
+                            weights=None):
+    """
+    @brief Momentum-accelerated OSEM iterations of a single slice.
+    @param[in] sino Sinogram of the slice, ordered (angles, distances).
+    @param[in] plan ReconstructionPlan of the "system_matrix" engine.
+    @param[in] num_its Number of iterations.
+    @param[in] momentum "nesterov" or "relaxed".
+    @param[in] relaxation Constant momentum of the "relaxed" scheme.
+    @param[in] restart Adaptive restart of the momentum.
+    @param[in] monitor IterationMonitor of the slice, None runs all the iterations.
+    @param[in] init Initial image of the slice, None for the uniform image.
+    @param[in] additive Additive term of the slice, ordered as sino, None for none.
+    @param[in] weights Multiplicative weights of the slice, ordered as sino, None for none.
+    @return Reconstructed slice.
+    """
+    plan = plan.weighted(weights)
+    sino = np.ascontiguousarray(sino, dtype=np.float64).ravel()
+    additive = _additive(additive, sino)
+    weights = _weights(weights, sino)
+    projection = np.zeros_like(sino)
+    subset_sens = np.asarray([sens.ravel() for sens in plan.subset_sensitivity])
+
+    def em_pass(recon, projection):
+        _osem_iterations(plan, sino, additive, weights, recon, projection, subset_sens, 1)
+
+    recon = momentum_em(em_pass, np.ones(plan.nxd * plan.nxd) if init is None else init.ravel(), num_its, momentum, relaxation, restart,
+                        monitor, sino, projection)
+    return recon.reshape(plan.nxd, plan.nxd)
+
+
+def _bsrem_slice(sino, plan, num_its, prior, beta, delta, relaxation, relaxation_decay, upper, monitor=None, init=None):
+    """
+    @brief BSREM iterations of a single slice.
+    @param[in] sino Sinogram of the slice, ordered (angles, distances).
+    @param[in] plan ReconstructionPlan of the "system_matrix" engine.
+    @param[in] num_its Number of iterations.
+    @param[in] prior, beta, delta, relaxation, relaxation_decay, upper See reconstructor_system_matrix_cpu.bsrem.
+    @param[in] monitor IterationMonitor of the slice, None runs all the iterations.
+    @param[in] init Initial image of the slice, None for the uniform image.
+    @return Reconstructed slice.
+    """
+    nxd = plan.nxd
+    sino = np.ascontiguousarray(sino, dtype=np.float64).ravel()
+    projection = np.zeros_like(sino)
+    matrices = plan.subset_matrices
+
+    def subset_backprojection(ss, estimate):
+        rows = plan.subset_rows[ss]
+        fp = matrices[ss] @ estimate.ravel()
+        projection[rows] = fp
+        ratio = np.divide(sino[rows], fp, out=np.zeros_like(fp), where=fp > 0)
+        return (matrices[ss].T @ ratio).reshape(nxd, nxd)
+
+    return map_em.bsrem(subset_backprojection, plan.subset_sensitivity, np.ones((nxd, nxd)) if init is None else init, num_its,
+                        prior, beta, delta, relaxation, relaxation_decay, upper, monitor, sino, projection,
+                        plan.neighbourhood(2))
+
+
+def _osl_slice(sino, plan, num_its, prior, beta, delta, monitor=None, init=None):
+    """
+    @brief One-step-late MAP-EM iterations of a single slice.
+    @param[in] sino Sinogram of the slice, ordered (angles, distances).
+    @param[in] plan ReconstructionPlan of the "system_matrix" engine.
+    @param[in] num_its Number of iterations.
+    @param[in] prior, beta, delta See reconstructor_system_matrix_cpu.osl_map_em.
+    @param[in] monitor IterationMonitor of the slice, None runs all the iterations.
+    @param[in] init Initial image of the slice, None for the uniform image.
+    @return Reconstructed slice.
+    """
+    nxd = plan.nxd
+    sino = np.ascontiguousarray(sino, dtype=np.float64).ravel()
+    projection = np.zeros_like(sino)
+    matrices = plan.subset_matrices
+
+    def subset_backprojection(ss, estimate):
+        rows = plan.subset_rows[ss]
+        fp = matrices[ss] @ estimate.ravel()
+        projection[rows] = fp
+        ratio = np.divide(sino[rows], fp, out=np.zeros_like(fp), where=fp > 0)
+        return (matrices[ss].T @ ratio).reshape(nxd, nxd)
+
+    return map_em.osl_em(subset_backprojection, plan.subset_sensitivity, np.ones((nxd, nxd)) if init is None else init, num_its,
+                         prior, beta, delta, plan.neighbourhood(2), monitor, sino, projection)
+
+
+def _osl_volume(sinogram, plan, num_its, prior, beta, delta, monitor=None, init=None):
+    """
+    @brief One-step-late MAP-EM of all the slices at once, with a prior that couples neighbouring slices.
+    @param[in] sinogram Sinogram stack, ordered (slices, angles, distances).
+    @param[in] plan ReconstructionPlan of the "system_matrix" engine.
+    @param[in] num_its Number of iterations.
+    @param[in] prior, beta, delta See reconstructor_system_matrix_cpu.osl_map_em.
+    @param[in] monitor IterationMonitor, the metrics have one value per slice.
+    @param[in] init Initial volume (slices, nxd, nxd), None for the uniform image.
+    @return Reconstructed volume (slices, nxd, nxd).
+    """
+    nxd = plan.nxd
+    sinos = _stack_columns(sinogram)
+    slices = sinos.shape[1]
+    projection = np.zeros_like(sinos)
+    matrices = plan.subset_matrices
+    if monitor is not None:
+        monitor.allocate(slices, (nxd, nxd))
+
+    def subset_backprojection(ss, estimate):
+        rows = plan.subset_rows[ss]
+        fp = matrices[ss] @ estimate.reshape(slices, -1).T
+        projection[rows] = fp
+        ratio = np.divide(sinos[rows], fp, out=np.zeros_like(fp), where=fp > 0)
+        return _unstack_columns(matrices[ss].T @ ratio, nxd)
+
+    estimate = np.ones((slices, nxd, nxd)) if init is None else init
+    return map_em.osl_em(subset_backprojection, plan.subset_sensitivity, estimate, num_its,
+                         prior, beta, delta, plan.neighbourhood(3), monitor, sinos, projection)
+
+
+def _stack_columns(sinogram):
+    """
+    @brief Lays a sinogram stack (slices, angles, distances) out as a (angles * distances, slices) matrix.
+    """
+    slices = sinogram.shape[0]
+    return np.ascontiguousarray(np.reshape(sinogram, (slices, -1)).T, dtype=np.float64)
+
+
+def _unstack_columns(recons, nxd):
+    """
+    @brief Converts the (nxd * nxd, slices) estimates back to a (slices, nxd, nxd) volume.
+    """
+    return np.ascontiguousarray(recons.T).reshape(-1, nxd, nxd)
+
+
+def _batch_sensitivity(plan, weight_columns):
+    """
+    @brief Sensitivity images of each subset for weights laid out as (angles * distances, slices).
+    @return Array (subsets, nxd * nxd, slices).
+    """
+    return np.asarray([plan.rows_of(rows).T @ weight_columns[rows] for rows in plan.subset_rows])
+
+
+def _mlem_batch(sinogram, plan, num_its, monitor=None, init=None, additive=None, weights=None, sens=None):
+    """
+    @brief MLEM iterations of all the slices of a sinogram stack at once.
+    @param[in] sinogram Sinogram stack, ordered (slices, angles, distances).
+    @param[in] plan ReconstructionPlan of the "system_matrix" engine.
+    @param[in] num_its Number of iterations.
+    @param[in] monitor IterationMonitor, the metrics have one value per slice and tol stops when every slice converged.
+    @param[in] init Initial volume (slices, nxd, nxd), None for the uniform image.
+    @param[in] additive Additive term laid out as sinogram, None for none.
+    @param[in] weights Multiplicative weights laid out as sinogram, None for none.
+    @param[in] sens Sensitivity images (nxd * nxd, slices) of the weights, computed when None.
+    @return Reconstructed volume (slices, nxd, nxd).
+    """
+    sinos = _stack_columns(sinogram)
+    recons = np.ones((plan.nxd * plan.nxd, sinos.shape[1])) if init is None else _stack_columns(init)
+    additives = np.zeros_like(sinos) if additive is None else _stack_columns(additive)
+    weight_columns = np.ones_like(sinos) if weights is None else _stack_columns(weights)
+    projection = np.zeros_like(sinos)
+    if monitor is not None:
+        monitor.allocate(sinos.shape[1], (plan.nxd, plan.nxd))
+    # com pesos cada fatia tem a sua imagem de sensibilidade, uma coluna por fatia
+    if sens is None:
+        sens = plan.sensitivity.reshape(-1, 1) if weights is None else plan.system_matrix.T @ weight_columns
+    if monitor is None:
+        mlem_system_matrix_batch_kernel(plan.system_matrix, sinos, additives, weight_columns, sens, num_its, recons, projection)
+        return _unstack_columns(recons, plan.nxd)
+
+    for it in range(monitor.start(recons), num_its):
+        mlem_system_matrix_batch_kernel(plan.system_matrix, sinos, additives, weight_columns, sens, 1, recons, projection)
+        if monitor.update(it, recons, sinos, projection, axis=0):
+            break
+    return _unstack_columns(recons, plan.nxd)
+
+
+def _osem_batch(sinogram, plan, num_its, monitor=None, init=None, additive=None, weights=None, subset_sens=None):
+    """
+    @brief OSEM iterations of all the slices of a sinogram stack at once.
+    @param[in] sinogram Sinogram stack, ordered (slices, angles, distances).
+    @param[in] plan ReconstructionPlan of the "system_matrix" engine.
+    @param[in] num_its Number of iterations.
+    @param[in] monitor IterationMonitor, the metrics have one value per slice and tol stops when every slice converged.
+    @param[in] init Initial volume (slices, nxd, nxd), None for the uniform image.
+    @param[in] additive Additive term laid out as sinogram, None for none.
+    @param[in] weights Multiplicative weights laid out as sinogram, None for none.
+    @param[in] subset_sens Sensitivity images (subsets, nxd * nxd, slices) of the weights, computed when None.
+    @return Reconstructed volume (slices, nxd, nxd).
+    """
+    sinos = _stack_columns(sinogram)
+    recons = np.ones((plan.nxd * plan.nxd, sinos.shape[1])) if init is None else _stack_columns(init)
+    additives = np.zeros_like(sinos) if additive is None else _stack_columns(additive)
+    weight_columns = np.ones_like(sinos) if weights is None else _stack_columns(weights)
+    projection = np.zeros_like(sinos)
+    if monitor is not None:
+        monitor.allocate(sinos.shape[1], (plan.nxd, plan.nxd))
+    if subset_sens is None and weights is None:
+        subset_sens = np.asarray([sens.reshape(-1, 1) for sens in plan.subset_sensitivity])
+    elif subset_sens is None:
+        subset_sens = _batch_sensitivity(plan, weight_columns)
+    if monitor is None:
+        _osem_batch_iterations(plan, sinos, additives, weight_columns, recons, projection, subset_sens, num_its)
+        return _unstack_columns(recons, plan.nxd)
+
+    for it in range(monitor.start(recons), num_its):
+        _osem_batch_iterations(plan, sinos, additives, weight_columns, recons, projection, subset_sens, 1)
+        if monitor.update(it, recons, sinos, projection, axis=0):
+            break
+    return _unstack_columns(recons, plan.nxd)
+
+
+def _osem_batch_iterations(plan, sinos, additives, weights, recons, projection, subset_sens, num_its):
+    """
+    @brief OSEM iterations of the stacked slices with the kernel that fits the subsets of the plan.
+    @param[in] plan ReconstructionPlan of the "system_matrix" engine.
+    @param[in] sinos Sinograms (nrd * nphi, slices), one flat slice per column.
+    @param[in] additives Additive terms laid out as sinos.
+    @param[in] weights Multiplicative weights laid out as sinos.
+    @param[in] recons Estimates (nxd * nxd, slices), updated in place.
+    @param[in] projection Projections of the estimates laid out as sinos, updated in place.
+    @param[in] subset_sens Sensitivity images (subsets, nxd * nxd, 1 or slices).
+    @param[in] num_its Number of iterations.
+    """
+    bounds = plan.subset_bounds
+    if bounds is not None:
+        osem_system_matrix_batch_kernel(plan.system_matrix, sinos, additives, weights, bounds, subset_sens, num_its, recons,
+                                        projection)
+    else:
+        # subsets intercalados: o kernel percorre as linhas de cada subset sem copiar a matriz
+        rows, offsets = plan.subset_row_order
+        osem_system_matrix_rows_batch_kernel(plan.system_matrix, sinos, additives, weights, rows, offsets, subset_sens, num_its,
+                                             recons, projection)
+
+
+def _osem_tv_slice(sino, plan, num_its, beta, tv_epsilon, sens_image=None, monitor=None, init=None):
+    """
+    @brief OSEM iterations with TV regularization of a single slice.
+    @param[in] sino Sinogram of the slice, ordered (angles, distances).
+    @param[in] plan ReconstructionPlan of the "system_matrix" engine.
+    @param[in] num_its Number of iterations.
+    @param[in] beta Regularization strength.
+    @param[in] tv_epsilon Small value for numerical stability.
+    @param[in] sens_image Sensitivity image, by default the one of the plan.
+    @param[in] monitor IterationMonitor of the slice, None runs all the iterations.
+    @param[in] init Initial image of the slice, None for the uniform image.
+    @return Reconstructed slice.
+    """
+    nxd = plan.nxd
+    sens_img = plan.sensitivity if sens_image is None else sens_image
+    slice_count = sino.sum()
+    recon = np.ones((nxd, nxd)) if init is None else init
+
+    # Preparar subconjuntos
+    sub_mat = plan.subset_matrices
+    sub_sino = [sino[angle_indices, :].reshape(-1, 1) for angle_indices in plan.subset_indices]
+    projection = np.zeros(sino.shape)
+    tv_grad = np.empty((nxd, nxd))
+    first = 0
+    if monitor is not None:
+        first = monitor.start(recon)
+
+    for it in range(first, num_its):
+        # Loop por subconjuntos
+        for ss in range(plan.subsets):
+            # Projeção direta
+            fp = sub_mat[ss] @ recon.ravel()
+            projection[plan.subset_indices[ss]] = fp.reshape(-1, plan.nrd)
+            # Calcular razão
+            ratio = sub_sino[ss] / (fp.reshape(-1, 1) + 1e-10)
+            ratio = np.clip(ratio, 0, 10)  # Limitar razões extremas
+
+            # Retroprojeção e atualização
+            correction = sub_mat[ss].T @ ratio
+            recon *= correction.reshape(nxd, nxd)
+
+        # Aplicar regularização TV após cada iteração completa
+        compute_tv_gradient(recon, tv_epsilon, out=tv_grad)
+        recon /= (sens_img + beta * tv_grad + 1e-9)
+
+        # Normalização
+        recon = (recon / recon.sum()) * slice_count
+
+        if monitor is not None and monitor.update(it, recon, sino, projection):
+            break
+
+    return recon
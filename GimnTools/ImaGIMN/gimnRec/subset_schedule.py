@@ -0,0 +1,124 @@
+import copy
+import numpy as np
+
+from GimnTools.ImaGIMN.gimnRec.iteration_control import poisson_log_likelihood
+
+
+# @file subset_schedule.py
+# @brief Number of subsets used by each OSEM iteration.
+# @details Many subsets make the first iterations cheap and fast to converge, but fixed-subset OSEM
+# ends in a limit cycle instead of the maximum likelihood. A SubsetSchedule reduces the number of
+# subsets towards MLEM as the estimate converges, on a fixed schedule or when the log-likelihood
+# stagnates. The plans of every number of subsets are taken from the plan cache of the reconstructor
+# before the slices start, so the subset matrices and sensitivity images are computed only once.
+
+
+class SubsetSchedule:
+    """
+    @brief Fixed or adaptive schedule of the number of subsets.
+
+    - fixed: stages [(iterations, subsets), ...] run in order, the last one until the end
+    - adaptive: starts with the subsets of the call and divides them by factor (down to
+      min_subsets) whenever the relative increase of the Poisson log-likelihood in an iteration
+      falls below stagnation
+
+    The fixed schedule depends only on the iteration index, so it is resumed exactly from a
+    checkpoint; the adaptive one starts again from the subsets of the call.
+    """
+
+    def __init__(self, stages=None, stagnation=None, factor=2, min_subsets=1):
+        """
+        @brief Creates the schedule.
+
+        @param stages List of (iterations, subsets) of the fixed schedule
+        @param stagnation Relative log-likelihood increase that triggers the reduction of the adaptive schedule
+        @param factor Divisor of the number of subsets at each reduction
+        @param min_subsets Number of subsets of the last stage of the adaptive schedule (1 is MLEM)
+        """
+        if (stages is None) == (stagnation is None):
+            raise ValueError("A subset schedule needs either stages or stagnation")
+        if stages is not None:
+            stages = [(int(iterations), int(subsets)) for iterations, subsets in stages]
+            if not stages or any(iterations < 1 or subsets < 1 for iterations, subsets in stages):
+                raise ValueError("The stages must have at least one iteration and one subset")
+        if factor < 2 or min_subsets < 1:
+            raise ValueError("factor must be at least 2 and min_subsets at least 1")
+        self.stages = stages
+        self.stagnation = stagnation
+        self.factor = int(factor)
+        self.min_subsets = int(min_subsets)
+        self.subsets = None
+        self._previous = None
+
+    def subset_counts(self, subsets):
+        """
+        @brief Numbers of subsets the schedule may use, in the order they are used.
+
+        @param subsets Number of subsets of the call, the first stage of the adaptive schedule
+        @return List of numbers of subsets
+        """
+        if self.stages is not None:
+            return list(dict.fromkeys(count for _, count in self.stages))
+        counts = [int(subsets)]
+        while counts[-1] > self.min_subsets:
+            counts.append(max(self.min_subsets, counts[-1] // self.factor))
+        return counts
+
+    def for_slice(self, subsets):
+        """
+        @brief Independent copy of the schedule used by the loop of one slice.
+
+        @param subsets Number of subsets of the call
+        @return SubsetSchedule
+        """
+        schedule = copy.copy(self)
+        schedule.subsets = self.subset_counts(subsets)[0]
+        schedule._previous = None
+        return schedule
+
+    def subsets_at(self, iteration):
+        """
+        @brief Number of subsets of an iteration (counted from 0).
+        """
+        if self.stages is None:
+            return self.subsets
+        end = 0
+        for iterations, subsets in self.stages:
+            end += iterations
+            if iteration < end:
+                return subsets
+        return self.stages[-1][1]
+
+    def update(self, sinogram, projection):
+        """
+        @brief Registers the projection computed by an iteration and reduces the subsets on stagnation.
+
+        @param sinogram Measured sinogram
+        @param projection Projection computed by the iteration, laid out as sinogram
+        """
+        if self.stages is not None or self.subsets <= self.min_subsets:
+            return
+        likelihood = poisson_log_likelihood(sinogram, projection)
+        if self._previous is not None and likelihood - self._previous < self.stagnation * abs(self._previous):
+            self.subsets = max(self.min_subsets, self.subsets // self.factor)
+            likelihood = None
+        self._previous = likelihood
+
+
+def subset_schedule(schedule):
+    """
+    @brief Converts the schedule= argument of the reconstructors into a SubsetSchedule.
+
+    @param schedule SubsetSchedule, list of (iterations, subsets) stages, "adaptive" (stagnation 1e-3)
+                    or a float with the stagnation of the adaptive schedule
+    @return SubsetSchedule
+    """
+    if isinstance(schedule, SubsetSchedule):
+        return schedule
+    if isinstance(schedule, str):
+        if schedule != "adaptive":
+            raise ValueError(f"Unknown subset schedule: {schedule}")
+        return SubsetSchedule(stagnation=1e-3)
+    if np.isscalar(schedule):
+        return SubsetSchedule(stagnation=float(schedule))
+    return SubsetSchedule(stages=schedule)
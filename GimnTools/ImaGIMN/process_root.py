@@ -12,6 +12,23 @@ import numpy as np
 
 
 
+def read_coincidences(file_name, branches, tree="Coincidences"):
+    """
+        @brief
+        Reads the branches of the coincidence tree of a ROOT file as numpy arrays, one array per branch.
+        @param file_name
+            Path to the ROOT file containing the coincidence event data.
+        @param branches
+            Names of the branches to read.
+        @param tree
+            Name of the tree of coincidences ("Coincidences" for GATE, "tomographicCoincidences" for PETSYS).
+        @return
+            Dictionary of numpy arrays indexed by branch name.
+    """
+    with up.open(file_name) as file:
+        return file[tree].arrays(branches, library='np')
+
+
 def coincidence_to_lor(file_name:str,detector_config:dict,detectors_angles:dict,parameters,matrix=[64,64,64],rsectors={ 0 : "detector-1",1 : "detector-2"}):
     """
         @brief
@@ -47,8 +64,7 @@ def coincidence_to_lor(file_name:str,detector_config:dict,detectors_angles:dict,
     import matplotlib.pyplot as plt
 
     PETSYS = systemSpace(detectors_angles,"y",detector_config,"y")
-    file = up.open(file_name)
-    coincidences = file['Coincidences'].arrays(parameters,library='np')
+    coincidences = read_coincidences(file_name, parameters)
     events = (coincidences['globalPosX1'].shape[0])
     
     if (detector_config["process_as"] =="GateGlobalPositions") or  (detector_config["process_as"] =="PaulGlobalPosition"):
@@ -0,0 +1 @@
+from GimnTools.ImaGIMN.processing.normalizations.component_normalization import *
@@ -0,0 +1,220 @@
+import hashlib
+import os
+import numpy as np
+
+from GimnTools.ImaGIMN.gimnRec.corrections import cached_correction
+
+
+# @file component_normalization.py
+# @brief Component-based normalization of the detector from a uniform (flood) acquisition.
+# @details The counts of a sinogram bin b are modelled as N_b (A x)_b, with the normalization
+# N_b = E_b g_b split in two components: E_b, the mean product eps_i eps_j of the efficiencies of
+# the crystals whose lines of response fall in b, and g_b, the geometric factor of its radial
+# position. The crystal efficiencies come from the fan sums of the uniform acquisition and the
+# geometric factors from its counts summed over the angles, so both are estimated from many more
+# counts than a single bin has. Everything is done with np.bincount over the coincidences, without
+# a loop over the events. The normalization sinogram is the weights= of the reconstructors
+# (set_normalization), so the measured data is never divided by it.
+
+
+def crystal_efficiencies(crystal1, crystal2, crystals=None, groups=None):
+    """
+    @brief Crystal efficiencies from the fan sums of a uniform acquisition.
+
+    With a uniform source the fan sum of a crystal (the coincidences it takes part in) is its
+    efficiency times the summed efficiencies of the crystals it faces, a constant shared by the
+    crystals of the same detector head; each group is therefore scaled to a mean of one.
+
+    @param crystal1 Global index of the crystal of the first event of each coincidence
+    @param crystal2 Global index of the crystal of the second event of each coincidence
+    @param crystals Number of crystals, by default the largest index + 1
+    @param groups Group (detector head) of each crystal, None for a single group
+    @return Array (crystals,), zero for the crystals without counts
+    """
+    crystal1 = np.asarray(crystal1, dtype=np.int64)
+    crystal2 = np.asarray(crystal2, dtype=np.int64)
+    if crystals is None:
+        crystals = int(max(crystal1.max(initial=-1), crystal2.max(initial=-1))) + 1
+    fan_sums = (np.bincount(crystal1, minlength=crystals) + np.bincount(crystal2, minlength=crystals)).astype(np.float64)
+    groups = np.zeros(crystals, dtype=np.int64) if groups is None else np.asarray(groups, dtype=np.int64)
+    if groups.shape != (crystals,):
+        raise ValueError(f"groups must give the group of each of the {crystals} crystals")
+    # média das somas de leque de cada grupo, sem os cristais mortos
+    totals = np.bincount(groups, weights=fan_sums)
+    live = np.bincount(groups, weights=(fan_sums > 0).astype(np.float64))
+    means = np.divide(totals, live, out=np.zeros_like(totals), where=live > 0)[groups]
+    return np.divide(fan_sums, means, out=np.zeros_like(fan_sums), where=means > 0)
+
+
+def event_bins(coordinates, shape, ranges=None):
+    """
+    @brief Flat index of the sinogram bin of each coincidence, binned as np.histogramdd.
+
+    @param coordinates Sequence with the coordinate of every coincidence along each dimension of the
+                       sinogram (e.g. slice, distance and angle)
+    @param shape Number of bins of each dimension
+    @param ranges (low, high) of each dimension, None (or a None entry) for the range of the
+                  coordinates, as the np.histogram2d of bin/reconstructPetsys.py
+    @return Integer array, -1 for the coincidences outside the ranges
+    """
+    if len(coordinates) != len(shape):
+        raise ValueError("coordinates must have one array per dimension of shape")
+    index = np.zeros(np.shape(coordinates[0]), dtype=np.int64)
+    outside = np.zeros(index.shape, dtype=bool)
+    for dim, (values, bins) in enumerate(zip(coordinates, shape)):
+        values = np.asarray(values, dtype=np.float64)
+        if ranges is None or ranges[dim] is None:
+            low, high = (values.min(), values.max()) if values.size else (0.0, 1.0)
+        else:
+            low, high = ranges[dim]
+        if high <= low:
+            low, high = low - 0.5, high + 0.5
+        position = np.floor((values - low) * bins / (high - low)).astype(np.int64)
+        # o último bin é fechado, como em np.histogramdd
+        position[values == high] = bins - 1
+        outside |= (position < 0) | (position >= bins)
+        index = index * bins + np.clip(position, 0, bins - 1)
+    index[outside] = -1
+    return index
+
+
+def efficiency_sinogram(efficiencies, crystal1, crystal2, bins, shape):
+    """
+    @brief Mean product of the crystal efficiencies of the lines of response of each sinogram bin.
+
+    The mean is weighted by the coincidences of the uniform acquisition, so it follows the pairs of
+    crystals that actually reach each bin.
+
+    @param efficiencies Crystal efficiencies (see crystal_efficiencies)
+    @param crystal1 Global index of the crystal of the first event of each coincidence
+    @param crystal2 Global index of the crystal of the second event of each coincidence
+    @param bins Flat index of the bin of each coincidence, -1 outside the sinogram (see event_bins)
+    @param shape Shape of the sinogram
+    @return Array of shape, zero in the bins without coincidences
+    """
+    size = int(np.prod(shape))
+    bins = np.asarray(bins, dtype=np.int64)
+    inside = bins >= 0
+    products = efficiencies[np.asarray(crystal1)[inside]] * efficiencies[np.asarray(crystal2)[inside]]
+    sums = np.bincount(bins[inside], weights=products, minlength=size)
+    counts = np.bincount(bins[inside], minlength=size)
+    return np.divide(sums, counts, out=np.zeros(size), where=counts > 0).reshape(shape)
+
+
+def geometric_factors(uniform, efficiency, expected=None, angle_axis=-1):
+    """
+    @brief Geometric factors of each radial bin of each slice, from a uniform acquisition and the efficiency sinogram.
+
+    The gantry is assumed rotationally symmetric, so the factors are the ratio between the counts
+    and the modelled counts summed over the angles, which also averages out the noise of the bins.
+
+    @param uniform Sinogram of the uniform acquisition
+    @param efficiency Efficiency sinogram (see efficiency_sinogram)
+    @param expected Counts of the source seen by an ideal detector, laid out as uniform (e.g. the
+                    projection of a cylinder); None for a source that reaches every bin alike (a flood)
+    @param angle_axis Axis of the angles
+    @return Array laid out as uniform with an angle axis of size one, with a mean of one over the bins with counts
+    """
+    model = efficiency if expected is None else efficiency * np.asarray(expected, dtype=np.float64)
+    counts = np.sum(uniform, axis=angle_axis, keepdims=True, dtype=np.float64)
+    modelled = np.sum(model, axis=angle_axis, keepdims=True)
+    factors = np.divide(counts, modelled, out=np.zeros_like(counts), where=modelled > 0)
+    positive = factors > 0
+    return factors / factors[positive].mean() if np.any(positive) else factors
+
+
+def normalization_sinogram(crystal1, crystal2, bins, shape, crystals=None, groups=None, expected=None, angle_axis=-1,
+                           cache_dir=None, cache=None):
+    """
+    @brief Normalization sinogram N = E g of a uniform acquisition, the weights= of the reconstructors.
+
+    @param crystal1 Global index of the crystal of the first event of each coincidence
+    @param crystal2 Global index of the crystal of the second event of each coincidence
+    @param bins Flat index of the bin of each coincidence, -1 outside the sinogram (see event_bins)
+    @param shape Shape of the sinogram, laid out as the sinograms of the reconstructor that uses it
+    @param crystals Number of crystals, by default the largest index + 1
+    @param groups Group (detector head) of each crystal, None for a single group
+    @param expected Counts of the source seen by an ideal detector (see geometric_factors)
+    @param angle_axis Axis of the angles in shape
+    @param cache_dir Directory of the sinograms saved on disk, None keeps them only in memory
+    @param cache Dictionary of the sinograms already computed, None for none
+
+    @return Array of shape, zero in the bins the uniform acquisition does not reach
+    """
+    crystal1 = np.asarray(crystal1, dtype=np.int64)
+    crystal2 = np.asarray(crystal2, dtype=np.int64)
+    bins = np.asarray(bins, dtype=np.int64)
+    shape = tuple(int(size) for size in shape)
+
+    def compute():
+        efficiencies = crystal_efficiencies(crystal1, crystal2, crystals, groups)
+        efficiency = efficiency_sinogram(efficiencies, crystal1, crystal2, bins, shape)
+        uniform = np.bincount(bins[bins >= 0], minlength=int(np.prod(shape))).reshape(shape)
+        return efficiency * geometric_factors(uniform, efficiency, expected, angle_axis)
+
+    key = _digest(crystal1, crystal2, bins, shape, crystals, groups, expected, angle_axis)
+    return cached_correction(key, "norm", compute, cache_dir, cache)
+
+
+def normalization_from_root(file_name, shape, coordinates, crystals=("crystalID1", "crystalID2"),
+                            sectors=("rsectorID1", "rsectorID2"), crystals_per_sector=64, tree="Coincidences", ranges=None,
+                            expected=None, angle_axis=-1, cache_dir=None, cache=None):
+    """
+    @brief Normalization sinogram of a uniform acquisition stored in a ROOT file (process_root.read_coincidences).
+
+    The cache key is the path, size and modification time of the file and the arguments, so the
+    file is read only the first time.
+
+    @param file_name Path to the ROOT file of the uniform acquisition
+    @param shape Shape of the sinogram
+    @param coordinates Branches with the coordinate of each dimension of shape, in its order (e.g.
+                       ("slice_1", "rSino_1", "angleSino_1") of PETSYS)
+    @param crystals Branches with the crystal of the two events
+    @param sectors Branches with the detector head (rsector) of the two events, None when the crystal
+                   indices are already global
+    @param crystals_per_sector Crystals of a head; the global index is sector * crystals_per_sector + crystal
+    @param tree Name of the tree of coincidences
+    @param ranges Ranges of the coordinates (see event_bins)
+    @param expected Counts of the source seen by an ideal detector (see geometric_factors)
+    @param angle_axis Axis of the angles in shape
+    @param cache_dir Directory of the sinograms saved on disk, None keeps them only in memory
+    @param cache Dictionary of the sinograms already computed, None for none
+
+    @return Array of shape
+    """
+    # process_root importa uproot e pandas, só carregados quando um arquivo ROOT é lido
+    from GimnTools.ImaGIMN.process_root import read_coincidences
+
+    status = os.stat(file_name)
+    key = _digest(os.path.abspath(file_name), status.st_size, status.st_mtime_ns, tuple(shape), tuple(coordinates),
+                  tuple(crystals), sectors, crystals_per_sector, tree, ranges, expected, angle_axis)
+
+    def compute():
+        branches = list(coordinates) + list(crystals) + ([] if sectors is None else list(sectors))
+        data = read_coincidences(file_name, branches, tree)
+        crystal1, crystal2 = (np.asarray(data[branch], dtype=np.int64) for branch in crystals)
+        groups = None
+        if sectors is not None:
+            crystal1 = crystal1 + np.asarray(data[sectors[0]], dtype=np.int64) * crystals_per_sector
+            crystal2 = crystal2 + np.asarray(data[sectors[1]], dtype=np.int64) * crystals_per_sector
+            count = (int(max(crystal1.max(initial=-1), crystal2.max(initial=-1))) // crystals_per_sector + 1) * crystals_per_sector
+            groups = np.arange(count) // crystals_per_sector
+        bins = event_bins([data[branch] for branch in coordinates], shape, ranges)
+        return normalization_sinogram(crystal1, crystal2, bins, shape, None if groups is None else groups.size, groups,
+                                      expected, angle_axis)
+
+    return cached_correction(key, "norm", compute, cache_dir, cache)
+
+
+def _digest(*parts):
+    """
+    @brief Hexadecimal sha1 of arrays (contents, shape and type) and other values (repr).
+    """
+    digest = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            digest.update(repr((part.shape, part.dtype.str)).encode())
+            digest.update(np.ascontiguousarray(part).tobytes())
+        else:
+            digest.update(repr(part).encode())
+    return digest.hexdigest()
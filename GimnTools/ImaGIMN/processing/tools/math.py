@@ -1,7 +1,7 @@
 import numpy as np
 
 from scipy.ndimage import rotate as rt_scipy
-from numba import njit
+from numba import njit, prange
 
 import itk
 from itk import BSplineInterpolateImageFunction
@@ -152,51 +152,85 @@ def interpolate_channels(image, transformed_coords, interpolation_func):
     """
     Interpolates the image values using a specified interpolation function, considering RGB channels.
 
-    @param image (numpy.ndarray): Input image.
+    Every trailing dimension after the first two is treated as a channel, so an RGB image, a
+    multi-channel image or a stack of slices moved to the last axis (see rotate_stack) are all
+    interpolated in a single compiled call. The rows of the output are distributed over the
+    available cores and the source coordinates of each pixel are computed only once for all
+    of its channels.
+
+    @param image (numpy.ndarray): Input image with shape (height, width, ...).
     @param transformed_coords (numpy.ndarray): Transformed coordinates.
-    @param interpolation_func (function): Interpolation function to use.
+    @param interpolation_func (function): Interpolation function to use (must be compiled with numba).
 
     @return Interpolated image with channels.
     """
+    image = np.asarray(image)
+    if image.ndim == 2:
+        return interpolate(image, transformed_coords, interpolation_func)
+
     height, width = image.shape[:2]
+    stack = np.ascontiguousarray(image.reshape(height, width, -1))
+    transformed_x = np.ascontiguousarray(transformed_coords[..., 0], dtype=np.float64)
+    transformed_y = np.ascontiguousarray(transformed_coords[..., 1], dtype=np.float64)
 
-    # Extract the transformed x and y coordinates
-    transformed_x = transformed_coords[..., 0]
-    transformed_y = transformed_coords[..., 1]
+    rotated_image = np.zeros_like(stack)
+    interpolate_channels_kernel(stack, transformed_x, transformed_y, interpolation_func, rotated_image)
+    return rotated_image.reshape(image.shape)
 
-    if len(image.shape) > 2:
-        count = image.shape[2]
-    else:
-        count = 1
 
-    # Apply the interpolation function to get the pixel values in the rotated image
-    rotated_image = np.zeros_like(image)
-    for channel in range(count):
-        for y in range(height):
-            for x in range(width):
-                src_x = transformed_x[y, x]
-                src_y = transformed_y[y, x]
+@njit(parallel=True)
+def interpolate_channels_kernel(image, transformed_x, transformed_y, interpolation_func, rotated_image):
+    """
+    Compiled kernel of interpolate_channels, writes the interpolated channels into rotated_image.
+
+    @param image (numpy.ndarray): Contiguous input image with shape (height, width, channels).
+    @param transformed_x (numpy.ndarray): Source x coordinate of every output pixel.
+    @param transformed_y (numpy.ndarray): Source y coordinate of every output pixel.
+    @param interpolation_func (function): Interpolation function to use.
+    @param rotated_image (numpy.ndarray): Preallocated output with the same shape as image.
+    """
+    height, width, count = image.shape
+
+    for y in prange(height):
+        for x in range(width):
+            src_x = transformed_x[y, x]
+            src_y = transformed_y[y, x]
 
-                x0 = int(src_x)
-                y0 = int(src_y)
+            x0 = int(src_x)
+            y0 = int(src_y)
 
-                # Calculate the neighboring pixel coordinates
-                x1 = x0 + 1
-                y1 = y0 + 1
+            # Calculate the coordinate differences
+            dx = src_x - x0
+            dy = src_y - y0
 
-                # Calculate the coordinate differences
-                dx = src_x - x0
-                dy = src_y - y0
+            # Neighboring pixel coordinates, clamped to the image borders
+            row0 = max(0, min(height - 1, y0))
+            row1 = max(0, min(height - 1, y0 + 1))
+            col0 = max(0, min(width - 1, x0))
+            col1 = max(0, min(width - 1, x0 + 1))
 
-                # Get the neighboring pixel values
-                pixel00 = image[max(0, min(height - 1, y0)), max(0, min(width - 1, x0)), channel]
-                pixel01 = image[max(0, min(height - 1, y0)), max(0, min(width - 1, x1)), channel]
-                pixel10 = image[max(0, min(height - 1, y1)), max(0, min(width - 1, x0)), channel]
-                pixel11 = image[max(0, min(height - 1, y1)), max(0, min(width - 1, x1)), channel]
+            for channel in range(count):
+                rotated_image[y, x, channel] = interpolation_func(image[row0, col0, channel],
+                                                                  image[row0, col1, channel],
+                                                                  image[row1, col0, channel],
+                                                                  image[row1, col1, channel],
+                                                                  dx, dy)
 
-                # Calculate the interpolated value
-                interpolated_value = interpolation_func(pixel00, pixel01, pixel10, pixel11, dx, dy)
 
-                rotated_image[y, x, channel] = interpolated_value
+def rotate_stack(volume, angle, interpolation_func, center=None):
+    """
+    Rotates every slice of a volume in-plane using a specified interpolation function.
+
+    The slices are handled as channels of a single image, so the whole volume is rotated by one
+    parallel call of interpolate_channels.
 
-    return rotated_image
\ No newline at end of file
+    @param volume (numpy.ndarray): Input volume with shape (slices, height, width).
+    @param angle (float): Angle of rotation in degrees.
+    @param interpolation_func (function): Interpolation function to use.
+    @param center (tuple, optional): Rotation center (default is the image center).
+
+    @return Rotated volume with shape (slices, height, width).
+    """
+    channels_last = np.moveaxis(np.asarray(volume), 0, -1)
+    rotated = rotate(channels_last, angle, interpolation_func, center=center, channels=True)
+    return np.moveaxis(rotated, -1, 0)
\ No newline at end of file
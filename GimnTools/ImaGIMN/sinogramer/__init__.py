@@ -2,5 +2,7 @@ from GimnTools.ImaGIMN.sinogramer.sinogramer import *
 #from sinogramer.sinogramer import *
 from GimnTools.ImaGIMN.sinogramer.systemSpace import *
 #from sinogramer.systemSpace import *
+from GimnTools.ImaGIMN.sinogramer.oblique import *
+from GimnTools.ImaGIMN.sinogramer.rebinning import *
 from GimnTools.ImaGIMN.sinogramer.conf import *
 #from sinogramer.conf import *
\ No newline at end of file
@@ -0,0 +1,92 @@
+import numpy as np
+
+
+class ObliqueSinogram:
+    """
+    @brief Fully 3D sinogram, with the oblique (cross-ring) lines of response kept in segments.
+
+    Sinogramer.get_slice_seg adds the two rings of a coincidence and stores every event in a
+    direct plane, which throws away its axial tilt. Here the events are stored by ring difference
+    d = ring2 - ring1: segment d has one plane for each ring pair (i, i + d) that exists, so
+    rings - |d| planes, each one a sinogram (distances, angles) in the order of the 2D stack.
+    The plane i of segment d is centred at the axial position i + |d| / 2, in rings.
+
+    ring1 is the ring at the start of the line of response of direct_radon and ring2 the ring
+    at its end.
+    """
+
+    def __init__(self, rings, distances, angles, max_ring_difference=None):
+        """
+        @brief Creates an empty oblique sinogram.
+
+        @param rings Number of detector rings (axial crystal rows)
+        @param distances Number of distance bins
+        @param angles Number of angle bins
+        @param max_ring_difference Largest ring difference kept, by default rings - 1 (all of them)
+        """
+        if max_ring_difference is None:
+            max_ring_difference = rings - 1
+        self.rings = int(rings)
+        self.distances = int(distances)
+        self.angles = int(angles)
+        self.max_ring_difference = int(min(max_ring_difference, rings - 1))
+        self.segments = {d: np.zeros((self.rings - abs(d), self.distances, self.angles))
+                         for d in self.ring_differences}
+
+    @property
+    def ring_differences(self):
+        """
+        @brief Ring differences of the segments, from -max_ring_difference to max_ring_difference.
+        """
+        return range(-self.max_ring_difference, self.max_ring_difference + 1)
+
+    @property
+    def shape(self):
+        """
+        @brief Tuple (rings, distances, angles) of the geometry.
+        """
+        return (self.rings, self.distances, self.angles)
+
+    def segment(self, ring_difference):
+        """
+        @brief Returns the segment (rings - |d|, distances, angles) of a ring difference.
+        """
+        return self.segments[ring_difference]
+
+    def axial_positions(self, ring_difference):
+        """
+        @brief Returns the axial position, in rings, of the centre of each plane of a segment.
+        """
+        return np.arange(self.rings - abs(ring_difference)) + abs(ring_difference) / 2
+
+    def fill(self, distance_bins, angle_bins, ring1, ring2, counts=1):
+        """
+        @brief Adds events to the sinogram.
+
+        All the arguments may be arrays, one entry per event. Events outside the bins or with a
+        ring difference above max_ring_difference are discarded.
+
+        @param distance_bins Distance bin of each event
+        @param angle_bins Angle bin of each event
+        @param ring1 Ring at the start of each line of response
+        @param ring2 Ring at the end of each line of response
+        @param counts Counts added by each event
+        """
+        distance_bins, angle_bins, ring1, ring2, counts = np.broadcast_arrays(
+            np.asarray(distance_bins, dtype=np.int64), np.asarray(angle_bins, dtype=np.int64),
+            np.asarray(ring1, dtype=np.int64), np.asarray(ring2, dtype=np.int64), np.asarray(counts))
+        difference = ring2 - ring1
+        valid = ((np.abs(difference) <= self.max_ring_difference)
+                 & (ring1 >= 0) & (ring1 < self.rings) & (ring2 >= 0) & (ring2 < self.rings)
+                 & (distance_bins >= 0) & (distance_bins < self.distances)
+                 & (angle_bins >= 0) & (angle_bins < self.angles))
+        plane = np.minimum(ring1, ring2)
+        for d in np.unique(difference[valid]):
+            events = valid & (difference == d)
+            np.add.at(self.segments[int(d)], (plane[events], distance_bins[events], angle_bins[events]), counts[events])
+
+    def total_counts(self):
+        """
+        @brief Returns the number of counts over all the segments.
+        """
+        return sum(segment.sum() for segment in self.segments.values())
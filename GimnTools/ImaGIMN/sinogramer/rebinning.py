@@ -0,0 +1,131 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from numba import njit
+
+
+# @file rebinning.py
+# @brief Rebinning of an ObliqueSinogram into the 2D (slice, distances, angles) stack.
+# @details The rebinned stack has the 2 * rings - 1 planes of Sinogramer.get_slice_seg (plane
+# ring1 + ring2), so it is reconstructed by the 2D reconstructors at the cost of a 2D study.
+# SSRB puts every oblique plane in the direct plane at its axial centre; FORE shifts every
+# frequency of the 2D Fourier transform of the plane to the axial position given by the
+# frequency-distance relation, which keeps most of the axial resolution lost by SSRB. The
+# segments are independent, so they are rebinned in parallel and added at the end.
+
+
+def ssrb(oblique, normalize=True, workers=1):
+    """
+    @brief Single-slice rebinning of an oblique sinogram.
+
+    The plane i of segment d, centred at the axial position i + |d| / 2, is added to the direct
+    plane 2 i + |d|.
+
+    @param oblique ObliqueSinogram to rebin
+    @param normalize Divides every plane by the number of oblique planes added to it; False keeps the counts
+    @param workers Number of threads over the segments
+
+    @return Stack (2 * rings - 1, distances, angles)
+    """
+    def rebin(d):
+        out = np.zeros((2 * oblique.rings - 1, oblique.distances, oblique.angles))
+        contributions = np.zeros(2 * oblique.rings - 1)
+        planes = abs(d) + 2 * np.arange(oblique.rings - abs(d))
+        out[planes] = oblique.segment(d)
+        contributions[planes] = 1
+        return out, contributions
+
+    stack, contributions = _sum_segments(rebin, oblique.ring_differences, workers)
+    if normalize:
+        stack /= np.maximum(contributions, 1)[:, None, None]
+    return stack
+
+
+def fore(oblique, radius, omega_limit=2, k_limit=2, workers=1):
+    """
+    @brief Fourier rebinning (FORE) of an oblique sinogram.
+
+    Each plane of segment d is extended to 360 degrees with the plane of segment -d (a line at
+    phi + 180 is the line at phi with the distance and the ring order reversed) and transformed
+    with a 2D FFT over (distance, angle). The frequency (omega, k) of the plane at axial position
+    z is added to the direct plane at z - k tan(theta) / omega, with tan(theta) = d / (2 radius)
+    rings per pixel, split linearly between the two nearest direct planes. Low frequencies
+    (|omega| < omega_limit and |k| < k_limit bins) and frequencies outside the consistency region
+    |k| > |omega| R, where the relation does not hold, are placed at z as in SSRB. Every frequency
+    of every direct plane is then divided by the number of contributions it received.
+
+    @param oblique ObliqueSinogram to rebin
+    @param radius Radius of the detector, in pixels
+    @param omega_limit Radial frequency bins rebinned by SSRB
+    @param k_limit Angular frequency bins rebinned by SSRB
+    @param workers Number of threads over the segments
+
+    @return Stack (2 * rings - 1, distances, angles)
+    """
+    planes_out = 2 * oblique.rings - 1
+    n_s, n_phi = oblique.distances, oblique.angles
+    omega = 2 * np.pi * np.fft.fftfreq(n_s)[:, None]
+    k = np.round(np.fft.fftfreq(2 * n_phi) * 2 * n_phi)[None, :]
+    fov = (n_s - 1) / 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # Deslocamento axial, em anéis, por unidade de tan(theta)
+        shift = np.where(np.abs(omega) > 0, -k / omega, 0.0)
+    low = (np.abs(np.fft.fftfreq(n_s) * n_s)[:, None] < omega_limit) & (np.abs(k) < k_limit)
+    shift[low | (np.abs(k) > np.abs(omega) * fov)] = 0.0
+    shift = np.ascontiguousarray(np.broadcast_to(shift, (n_s, 2 * n_phi)))
+
+    def rebin(d):
+        extended = np.concatenate([oblique.segment(d), oblique.segment(-d)[:, ::-1, :]], axis=2)
+        spectrum = np.fft.fft2(extended, axes=(1, 2))
+        out = np.zeros((planes_out, n_s, 2 * n_phi), dtype=np.complex128)
+        weights = np.zeros((planes_out, n_s, 2 * n_phi))
+        # o kernel solta o GIL, então os segmentos são de fato acumulados em paralelo
+        _fore_scatter(spectrum, shift, abs(d) / 2, d / (2 * radius), out, weights)
+        return out, weights
+
+    spectrum, weights = _sum_segments(rebin, oblique.ring_differences, workers)
+    spectrum /= np.maximum(weights, 1e-12)
+    return np.real(np.fft.ifft2(spectrum, axes=(1, 2)))[:, :, :n_phi]
+
+
+@njit(nogil=True)
+def _fore_scatter(spectrum, shift, offset, slope, out, weights):
+    """
+    @brief Adds every frequency of the planes of one segment to the two nearest direct planes of FORE.
+
+    @param spectrum 2D FFT of the extended planes of the segment (planes, distances, 2 * angles)
+    @param shift Axial shift of each frequency per unit of tan(theta), in rings
+    @param offset Axial position of the first plane of the segment, |d| / 2
+    @param slope tan(theta) of the segment, d / (2 radius)
+    @param out Spectrum of the direct planes, accumulated in place
+    @param weights Contributions of each frequency of the direct planes, accumulated in place
+    """
+    last = out.shape[0] - 1
+    for i in range(spectrum.shape[0]):
+        for w in range(spectrum.shape[1]):
+            for kk in range(spectrum.shape[2]):
+                # Posição no grid dos planos diretos (2 z), limitada ao eixo axial
+                target = min(max(2 * (i + offset + shift[w, kk] * slope), 0.0), last)
+                lower = int(np.floor(target))
+                upper = min(lower + 1, last)
+                fraction = target - lower
+                out[lower, w, kk] += (1 - fraction) * spectrum[i, w, kk]
+                weights[lower, w, kk] += 1 - fraction
+                out[upper, w, kk] += fraction * spectrum[i, w, kk]
+                weights[upper, w, kk] += fraction
+
+
+def _sum_segments(rebin, ring_differences, workers):
+    """
+    @brief Rebins the segments in parallel and adds the partial results.
+
+    @param rebin Function rebin(d) returning a tuple of arrays for the segment d
+    @param ring_differences Ring differences of the segments
+    @param workers Number of threads
+
+    @return Tuple with the sums of the arrays returned by rebin
+    """
+    total = None
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for partial in executor.map(rebin, ring_differences):
+            total = list(partial) if total is None else [t + p for t, p in zip(total, partial)]
+    return tuple(total)
@@ -222,6 +222,22 @@ class Sinogramer:
             y = pos[1]
             #print(f"x {x} , y {y} , z {z}")
             self.sinogram[z,x,y] += 1
+
+    def fill_oblique(self, oblique, distance, angle, pair_pos_axis):
+        """
+        @brief Fills an oblique sinogram, keeping the ring difference of the event.
+
+        Unlike fill_sino with get_slice_seg, the two rings are not merged into a direct plane,
+        so the axial tilt of the line of response is kept for the fully 3D reconstruction.
+
+        @param oblique ObliqueSinogram with the distance and angle bins of this sinogram.
+        @param distance The distance value (float) to be used for filling.
+        @param angle The angle value (float) to be used for filling.
+        @param pair_pos_axis A tuple with the rings (crystal rows) of the two events.
+        """
+        pos = self.get_pixel_position(distance, angle)
+        if pos is not None:
+            oblique.fill(pos[0], pos[1], pair_pos_axis[0], pair_pos_axis[1])
     
 
 
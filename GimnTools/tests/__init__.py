@@ -1,2 +1,5 @@
 from GimnTools.tests import test_reconstruction
-from GimnTools.tests import tests
\ No newline at end of file
+from GimnTools.tests import tests
+from GimnTools.tests import test_tools
+from GimnTools.tests import test_projectors
+from GimnTools.tests import test_iterative
\ No newline at end of file
@@ -0,0 +1,581 @@
+import unittest
+import tempfile
+import shutil
+import subprocess
+import sys
+import textwrap
+from pathlib import Path
+import numpy as np
+
+from GimnTools.ImaGIMN.gimnRec.reconstructors.line_integral_reconstructor import line_integral_reconstructor
+from GimnTools.ImaGIMN.gimnRec.reconstructors.system_matrix_reconstruction import reconstructor_system_matrix_cpu, _osem_batch
+from GimnTools.ImaGIMN.gimnRec.reconstructors.rotation_reconstruction import rotation_reconstructor
+from GimnTools.ImaGIMN.gimnRec.reconstructors.list_mode_reconstruction import list_mode_reconstructor
+from GimnTools.ImaGIMN.gimnRec.reconstructors.fully_3d_reconstruction import fully_3d_reconstructor
+from GimnTools.ImaGIMN.sinogramer.oblique import ObliqueSinogram
+from GimnTools.ImaGIMN.processing.interpolators.reconstruction import bilinear_interpolation
+from GimnTools.ImaGIMN.gimnRec.reconstruction_plan import ReconstructionPlan, make_geometry, subset_ordering, ORDERINGS
+from GimnTools.ImaGIMN.gimnRec.projectors import direct_radon, project_events
+from GimnTools.ImaGIMN.gimnRec.backprojectors import backproject_events
+from GimnTools.ImaGIMN.gimnRec.priors import tv_gradient
+from GimnTools.ImaGIMN.gimnRec.subset_schedule import SubsetSchedule
+from GimnTools.ImaGIMN.gimnRec.iteration_control import poisson_log_likelihood
+from GimnTools.ImaGIMN.gimnRec.corrections import attenuation_factors
+
+
+class TestGimnToolsIterative(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_dir = Path(tempfile.mkdtemp(prefix="gimntools_test_"))
+        cls.pixels = 16
+        cls.number_of_angles = 12
+        cls.number_of_slices = 2
+
+        image = np.zeros((cls.pixels, cls.pixels))
+        image[4:12, 5:11] = 5.0
+        image[6:9, 6:8] = 20.0
+        cls.image = image
+
+        cls.angles = np.linspace(0, 180, cls.number_of_angles, endpoint=False)
+        sinogram = direct_radon(image, cls.angles)
+        cls.stack = np.asarray([sinogram * (i + 1) for i in range(cls.number_of_slices)])
+
+        cls.angles_sm = np.linspace(180, 0, cls.number_of_angles, endpoint=False)
+        cls.stack_sm = np.transpose(cls.stack, (0, 2, 1))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.test_dir, ignore_errors=True)
+
+    def test_plan_is_shared_between_subsets(self):
+        """Testa que planos com subsets diferentes compartilham a matriz do sistema"""
+        reconstructor = reconstructor_system_matrix_cpu(self.stack_sm)
+        mlem_plan = reconstructor.get_plan(self.angles_sm)
+        osem_plan = reconstructor.get_plan(self.angles_sm, 4)
+        self.assertIs(mlem_plan.system_matrix, osem_plan.system_matrix)
+        self.assertIs(reconstructor.get_plan(self.angles_sm, 4), osem_plan)
+        self.assertEqual(len(osem_plan.subset_matrices), 4)
+        # as submatrizes dos subsets intercalados são copiadas uma vez só
+        self.assertIs(osem_plan.subset_matrices, osem_plan.subset_matrices)
+        self.assertIs(osem_plan.weighted(np.ones(osem_plan.nrd * osem_plan.nphi)).subset_matrices, osem_plan.subset_matrices)
+        np.testing.assert_allclose(sum(osem_plan.subset_sensitivity), mlem_plan.sensitivity)
+
+    def test_plan_serialization(self):
+        """Testa que o plano salvo e carregado produz a mesma reconstrução"""
+        plan = ReconstructionPlan(make_geometry(self.pixels), self.angles, 3, "line_integral")
+        path = self.test_dir / "plan.npz"
+        plan.save(path)
+        loaded = ReconstructionPlan.load(path)
+        self.assertEqual(loaded.key, plan.key)
+        np.testing.assert_allclose(loaded.sensitivity, plan.sensitivity)
+
+        reconstructor = line_integral_reconstructor(self.stack)
+        expected = reconstructor.osem(1, 3, self.angles)
+        np.testing.assert_allclose(reconstructor.osem(1, 3, self.angles, plan=loaded), expected)
+
+    def test_subset_orderings(self):
+        """Testa as ordens dos subsets e o seu uso pelos reconstrutores"""
+        for ordering in ORDERINGS:
+            subsets = subset_ordering(16, 8, ordering)
+            np.testing.assert_array_equal(np.sort(np.concatenate(subsets)), np.arange(16))
+        bit_reversal = subset_ordering(16, 8, "bit_reversal")
+        self.assertEqual([int(indices[0]) for indices in bit_reversal], [0, 4, 2, 6, 1, 5, 3, 7])
+        self.assertEqual([int(indices[0]) for indices in subset_ordering(16, 8, "max_separation")][:2], [0, 4])
+        with self.assertRaises(ValueError):
+            ReconstructionPlan(make_geometry(self.pixels), self.angles, 3, "line_integral", ordering="random")
+
+        plan = ReconstructionPlan(make_geometry(self.pixels), self.angles, 3, "line_integral", ordering="golden_angle")
+        path = self.test_dir / "plan_ordering.npz"
+        plan.save(path)
+        loaded = ReconstructionPlan.load(path)
+        self.assertEqual(loaded.ordering, "golden_angle")
+        self.assertEqual(loaded.key, plan.key)
+
+        # Subsets intercalados da matriz do sistema usam o kernel por linhas, igual ao laço sobre as submatrizes
+        reconstructor = reconstructor_system_matrix_cpu(self.stack_sm)
+        plan = reconstructor.get_plan(self.angles_sm, 4)
+        self.assertIsNone(plan.subset_bounds)
+        recon = reconstructor.osem(2, 4, self.angles_sm)
+        expected = np.ones(self.pixels * self.pixels)
+        sino = self.stack_sm[0].ravel()
+        subset_sens = [sens.ravel() for sens in plan.subset_sensitivity]
+        for _ in range(2):
+            for rows, sub_sens in zip(plan.subset_rows, subset_sens):
+                sub_mat = plan.system_matrix[rows]
+                expected *= (sub_mat.T @ (sino[rows] / (sub_mat @ expected + 1e-12))) / (sub_sens + 1e-12)
+        np.testing.assert_allclose(recon[0], expected.reshape(self.pixels, self.pixels), rtol=1e-6, atol=1e-8)
+        # o lote de fatias usa o kernel por linhas com várias colunas, igual às fatias uma a uma
+        np.testing.assert_allclose(_osem_batch(self.stack_sm, plan, 2), recon, rtol=1e-6, atol=1e-8)
+
+        reconstructor.set_subset_ordering("contiguous")
+        plan = reconstructor.get_plan(self.angles_sm, 4)
+        self.assertIsNotNone(plan.subset_bounds)
+        for indices, expected in zip(plan.subset_indices, np.array_split(np.arange(self.number_of_angles), 4)):
+            np.testing.assert_array_equal(indices, expected)
+
+        rotation = rotation_reconstructor()
+        rotation.set_sinogram(self.stack)
+        self.assertTrue(np.all(np.isfinite(rotation.osem(1, 3, bilinear_interpolation, self.angles))))
+
+    def test_subset_schedule(self):
+        """Testa o OSEM com número de subsets decrescente, fixo ou adaptativo"""
+        schedule = SubsetSchedule(stages=[(2, 6), (2, 3), (1, 1)])
+        self.assertEqual([schedule.subsets_at(it) for it in range(6)], [6, 6, 3, 3, 1, 1])
+        self.assertEqual(SubsetSchedule(stagnation=1e-3).subset_counts(8), [8, 4, 2, 1])
+
+        reconstructor = line_integral_reconstructor(self.stack)
+        np.testing.assert_allclose(reconstructor.osem(3, 3, self.angles, schedule=[(3, 3)]),
+                                   reconstructor.osem(3, 3, self.angles))
+
+        rng = np.random.default_rng(3)
+        noisy = rng.poisson(self.stack_sm * 2).astype(np.float64)
+        reconstructor = reconstructor_system_matrix_cpu(noisy)
+        matrix = reconstructor.get_plan(self.angles_sm).system_matrix
+
+        def log_likelihood(rec):
+            return sum(poisson_log_likelihood(noisy[z].ravel(), matrix @ rec[z].ravel()) for z in range(len(rec)))
+
+        fixed = log_likelihood(reconstructor.osem(20, 6, self.angles_sm))
+        self.assertGreater(log_likelihood(reconstructor.osem(20, 6, self.angles_sm, schedule=[(4, 6), (4, 3), (12, 1)])), fixed)
+        self.assertGreater(log_likelihood(reconstructor.osem(20, 6, self.angles_sm, schedule="adaptive")), fixed)
+        # planos de 6, 3 e 1 subsets, todos do cache
+        self.assertEqual(len(reconstructor.plans), 3)
+        with self.assertRaises(ValueError):
+            reconstructor.osem(2, 6, self.angles_sm, batched=True, schedule="adaptive")
+
+    def test_fbp_initial_estimate(self):
+        """Testa o início das iterações pela FBP positiva e escalada às contagens, ou por um array"""
+        reconstructor = line_integral_reconstructor(self.stack)
+        plan = reconstructor.get_plan(self.angles)
+        init = reconstructor.get_initial_estimate("fbp", plan)
+        self.assertGreater(init.min(), 0)
+        for slice_z in range(self.number_of_slices):
+            np.testing.assert_allclose(direct_radon(init[slice_z], self.angles).sum(), self.stack[slice_z].sum(), rtol=0.2)
+
+        def error(rec):
+            return np.abs(rec[0] - self.image).mean()
+
+        self.assertLess(error(reconstructor.mlem(2, self.angles, init="fbp")), error(reconstructor.mlem(2, self.angles)))
+        np.testing.assert_allclose(reconstructor.osem(1, 3, self.angles, init=self.image)[0], self.image, atol=1e-6)
+        with self.assertRaises(ValueError):
+            reconstructor.osem(1, 3, self.angles, init="zeros")
+
+        reconstructor = reconstructor_system_matrix_cpu(self.stack_sm)
+        self.assertLess(error(reconstructor.mlem(1, self.angles_sm, init="fbp")), error(reconstructor.mlem(1, self.angles_sm)))
+        sequential = reconstructor.osem(2, 3, self.angles_sm, init="fbp")
+        np.testing.assert_allclose(reconstructor.osem(2, 3, self.angles_sm, init="fbp", batched=True), sequential)
+        reconstructor.set_workers(2)
+        np.testing.assert_allclose(reconstructor.osem(2, 3, self.angles_sm, init="fbp"), sequential)
+
+    def test_region_of_interest(self):
+        """Testa a reconstrução de parte das fatias e de uma região de interesse no plano"""
+        reconstructor = line_integral_reconstructor(self.stack)
+        np.testing.assert_allclose(reconstructor.osem(2, 3, self.angles, slices=[1], init="fbp"),
+                                   reconstructor.osem(2, 3, self.angles, init="fbp")[[1]])
+
+        reconstructor = reconstructor_system_matrix_cpu(self.stack_sm)
+        full = reconstructor.osem(3, 3, self.angles_sm, init="fbp")
+        np.testing.assert_allclose(reconstructor.osem(3, 3, self.angles_sm, roi=(0, self.pixels, 0, self.pixels)), full, atol=1e-9)
+        region = reconstructor.osem(3, 3, self.angles_sm, roi=(5, 11, 6, 9), margin=2, slices=slice(1, 2))
+        self.assertEqual(region.shape, (1, self.pixels, self.pixels))
+        self.assertEqual(np.abs(region[0, :4]).max(), 0.0)
+        np.testing.assert_allclose(region[0, 6:9, 5:11], full[1, 6:9, 5:11], atol=0.1 * full[1].max())
+        with self.assertRaises(ValueError):
+            reconstructor.mlem(1, self.angles_sm, roi=(5, 11, 6, 9), batched=True)
+
+    def test_multigrid(self):
+        """Testa o início grosso-para-fino: níveis em grids menores, com os planos no cache"""
+        def error(rec):
+            return np.abs(rec[0] - self.image).mean()
+
+        reconstructor = line_integral_reconstructor(self.stack)
+        self.assertLess(error(reconstructor.mlem(2, self.angles, multigrid=True)), error(reconstructor.mlem(2, self.angles)))
+        self.assertEqual(sorted(plan.nxd for plan in reconstructor.plans.values()), [4, 8, 16])
+        with self.assertRaises(ValueError):
+            reconstructor.osem(1, 3, self.angles, multigrid=[(3, 1)])
+        with self.assertRaises(ValueError):
+            reconstructor.osem(1, 3, self.angles, multigrid=True, init="fbp")
+
+        reconstructor = reconstructor_system_matrix_cpu(self.stack_sm)
+        sequential = reconstructor.osem(2, 3, self.angles_sm, multigrid=[(2, 2)])
+        self.assertTrue(np.all(np.isfinite(sequential)))
+        np.testing.assert_allclose(reconstructor.osem(2, 3, self.angles_sm, multigrid=[(2, 2)], batched=True), sequential)
+
+    def test_additive_term(self):
+        """Testa o termo aditivo (randoms e espalhamento) no modelo A x + r"""
+        def error(rec):
+            return np.abs(rec[0] - self.image).mean()
+
+        background = 0.2 * self.stack.max()
+        reconstructor = line_integral_reconstructor(self.stack + background)
+        self.assertLess(error(reconstructor.mlem(10, self.angles, additive=background)),
+                        error(reconstructor.mlem(10, self.angles)))
+        np.testing.assert_allclose(line_integral_reconstructor(self.stack).osem(2, 3, self.angles, additive=0.0),
+                                   line_integral_reconstructor(self.stack).osem(2, 3, self.angles))
+        with self.assertRaises(ValueError):
+            reconstructor.mlem(1, self.angles, additive=-1.0)
+
+        reconstructor = rotation_reconstructor()
+        reconstructor.set_sinogram(self.stack + background)
+        self.assertLess(error(reconstructor.mlem(5, bilinear_interpolation, self.angles, additive=background)),
+                        error(reconstructor.mlem(5, bilinear_interpolation, self.angles)))
+
+        additive = np.full(self.stack_sm.shape, background)
+        reconstructor = reconstructor_system_matrix_cpu(self.stack_sm + additive)
+        sequential = reconstructor.osem(2, 3, self.angles_sm, additive=additive)
+        self.assertLess(error(sequential), error(reconstructor.osem(2, 3, self.angles_sm)))
+        np.testing.assert_allclose(reconstructor.osem(2, 3, self.angles_sm, additive=additive, batched=True), sequential)
+        np.testing.assert_allclose(reconstructor.osem(2, 3, self.angles_sm, additive=additive, slices=[1]), sequential[[1]])
+
+    def test_attenuation(self):
+        """Testa a atenuação no modelo w A x + r e o cache dos fatores de correção"""
+        def error(rec):
+            return np.abs(rec[0] - self.image).mean()
+
+        mu_map = np.full((self.pixels, self.pixels), 0.05)
+        plan = line_integral_reconstructor(self.stack).get_plan(self.angles)
+        cache_dir = self.test_dir / "acf"
+        factors = attenuation_factors(mu_map, plan, cache_dir=cache_dir)
+        files = list(cache_dir.glob("acf_*.npy"))
+        self.assertEqual(len(files), 1)
+        modified = files[0].stat().st_mtime_ns
+        np.testing.assert_allclose(attenuation_factors(mu_map, plan, cache_dir=cache_dir), factors)
+        self.assertEqual(files[0].stat().st_mtime_ns, modified)
+
+        reconstructor = line_integral_reconstructor(self.stack / factors[0])
+        uncorrected = reconstructor.mlem(10, self.angles)
+        reconstructor.set_attenuation(mu_map, cache_dir=cache_dir)
+        self.assertLess(error(reconstructor.mlem(10, self.angles)), error(uncorrected))
+        self.assertEqual(len(list(cache_dir.glob("acf_*.npy"))), 1)
+        np.testing.assert_allclose(line_integral_reconstructor(self.stack).osem(2, 3, self.angles, weights=1.0),
+                                   line_integral_reconstructor(self.stack).osem(2, 3, self.angles))
+        with self.assertRaises(ValueError):
+            reconstructor.mlem(1, self.angles, weights=-1.0)
+
+        reconstructor = reconstructor_system_matrix_cpu(self.stack_sm)
+        factors = attenuation_factors(mu_map, reconstructor.get_plan(self.angles_sm, 3))
+        reconstructor = reconstructor_system_matrix_cpu(self.stack_sm / factors[0])
+        uncorrected = reconstructor.osem(2, 3, self.angles_sm)
+        reconstructor.set_attenuation(mu_map)
+        sequential = reconstructor.osem(2, 3, self.angles_sm)
+        self.assertLess(error(sequential), error(uncorrected))
+        np.testing.assert_allclose(reconstructor.osem(2, 3, self.angles_sm, batched=True), sequential)
+        np.testing.assert_allclose(reconstructor.mlem(2, self.angles_sm, batched=True), reconstructor.mlem(2, self.angles_sm))
+
+    def test_reconstruct_frames(self):
+        """Testa a reconstrução dinâmica: quadros em lotes com um só plano, gravados quadro a quadro"""
+        frames = np.asarray([self.stack_sm * scale for scale in (1.0, 0.5, 2.0)])
+        normalization = np.linspace(0.5, 1.5, self.stack_sm[0].size).reshape(self.stack_sm[0].shape)
+        reconstructor = reconstructor_system_matrix_cpu(frames.sum(axis=0))
+        reconstructor.set_normalization(normalization)
+        written = []
+        output = self.test_dir / "frames.npy"
+        result = reconstructor.reconstruct_frames(frames, 2, self.angles_sm, 3, output=output, frames_per_batch=2,
+                                                  additive=0.1, on_frame=lambda frame, volume: written.append(frame))
+        self.assertEqual(written, [0, 1, 2])
+        self.assertEqual(result.shape, (3, self.number_of_slices, self.pixels, self.pixels))
+        for frame, sinogram in enumerate(frames):
+            expected = reconstructor_system_matrix_cpu(sinogram).osem(2, 3, self.angles_sm, additive=0.1, weights=normalization)
+            np.testing.assert_allclose(result[frame], expected)
+        np.testing.assert_allclose(np.load(output), result)
+        np.testing.assert_allclose(reconstructor.reconstruct_frames(frames, 2, self.angles_sm, 3, batched=False,
+                                                                    additive=0.1), result)
+
+        frames = np.asarray([self.stack, 2 * self.stack])
+        result = line_integral_reconstructor(self.stack).reconstruct_frames(frames, 2, self.angles, frames_per_batch=1)
+        np.testing.assert_allclose(result[1], line_integral_reconstructor(2 * self.stack).mlem(2, self.angles))
+        with self.assertRaises(ValueError):
+            line_integral_reconstructor(self.stack).reconstruct_frames(frames[:, :1], 1, self.angles)
+
+    def test_slice_parallel_reconstruction(self):
+        """Testa a reconstrução das fatias em paralelo com memória compartilhada"""
+        reconstructor = reconstructor_system_matrix_cpu(self.stack_sm)
+        sequential = reconstructor.osem(2, 3, self.angles_sm)
+        reconstructor.set_workers(2)
+        parallel = reconstructor.osem(2, 3, self.angles_sm)
+        np.testing.assert_allclose(parallel, sequential)
+
+        reconstructor = line_integral_reconstructor(self.stack, workers=2)
+        np.testing.assert_allclose(reconstructor.mlem(1, self.angles),
+                                   line_integral_reconstructor(self.stack).mlem(1, self.angles))
+
+    def test_process_pool_after_parallel_kernel(self):
+        """Testa se o pool de processos termina depois de um kernel paralelo do Numba já ter rodado"""
+        script = textwrap.dedent("""
+            import numpy as np
+            from GimnTools.ImaGIMN.gimnRec.priors import prior_gradient
+            from GimnTools.ImaGIMN.gimnRec.projectors import direct_radon
+            from GimnTools.ImaGIMN.gimnRec.reconstructors.line_integral_reconstructor import line_integral_reconstructor
+
+            if __name__ == "__main__":
+                prior_gradient(np.random.rand(8, 16, 16))
+                image = np.zeros((16, 16))
+                image[4:12, 5:11] = 5.0
+                angles = np.linspace(0, 180, 12, endpoint=False)
+                stack = np.asarray([direct_radon(image, angles)] * 2)
+                rec = line_integral_reconstructor(stack, workers=2).mlem(1, angles)
+                assert np.allclose(rec, line_integral_reconstructor(stack).mlem(1, angles))
+            """)
+        result = subprocess.run([sys.executable, "-c", script], capture_output=True, timeout=300,
+                                cwd=Path(__file__).resolve().parents[2])
+        self.assertEqual(result.returncode, 0, result.stderr.decode(errors="replace"))
+
+    def test_thread_backend_reconstruction(self):
+        """Testa a reconstrução das fatias em threads, com os laços compilados sem GIL"""
+        reconstructor = reconstructor_system_matrix_cpu(self.stack_sm, workers=2, backend="thread")
+        np.testing.assert_allclose(reconstructor.mlem(2, self.angles_sm),
+                                   reconstructor_system_matrix_cpu(self.stack_sm).mlem(2, self.angles_sm))
+
+        reconstructor = line_integral_reconstructor(self.stack)
+        sequential = reconstructor.osem(1, 3, self.angles)
+        reconstructor.set_workers(2, backend="thread")
+        np.testing.assert_allclose(reconstructor.osem(1, 3, self.angles), sequential)
+
+    def test_batched_system_matrix_reconstruction(self):
+        """Testa a reconstrução de todas as fatias de uma vez, com as fatias como colunas"""
+        reconstructor = reconstructor_system_matrix_cpu(self.stack_sm)
+        np.testing.assert_allclose(reconstructor.mlem(3, self.angles_sm, batched=True),
+                                   reconstructor.mlem(3, self.angles_sm), rtol=1e-10)
+        np.testing.assert_allclose(reconstructor.osem(2, 3, self.angles_sm, batched=True),
+                                   reconstructor.osem(2, 3, self.angles_sm), rtol=1e-10)
+
+    def test_iteration_callback_and_early_stopping(self):
+        """Testa o callback por iteração, as métricas e os critérios de parada"""
+        reconstructor = reconstructor_system_matrix_cpu(self.stack_sm)
+        states = []
+        monitored = reconstructor.mlem(4, self.angles_sm, on_iteration=states.append)
+        np.testing.assert_allclose(monitored, reconstructor.mlem(4, self.angles_sm))
+        self.assertEqual([(state.slice, state.iteration) for state in states],
+                         [(z, it) for z in range(self.number_of_slices) for it in range(4)])
+        likelihood = [state.log_likelihood for state in states if state.slice == 0]
+        self.assertTrue(np.all(np.diff(likelihood) > 0))
+
+        states = []
+        line_integral_reconstructor(self.stack).osem(20, 3, self.angles, tol=1e9,
+                                                     on_iteration=states.append)
+        self.assertEqual(len(states), self.number_of_slices)
+
+        states = []
+        reconstructor.osem(5, 3, self.angles_sm, batched=True, max_time=0, on_iteration=states.append)
+        self.assertEqual(len(states), 1)
+        self.assertEqual(np.shape(states[0].residual), (self.number_of_slices,))
+
+    def test_checkpoint_and_resume(self):
+        """Testa a retomada de uma reconstrução a partir dos checkpoints"""
+        checkpoint = self.test_dir / "checkpoints"
+        reconstructor = reconstructor_system_matrix_cpu(self.stack_sm)
+        reconstructor.osem(2, 3, self.angles_sm, checkpoint=checkpoint)
+        self.assertEqual(sorted(path.name for path in checkpoint.iterdir()),
+                         [f"slice_{z:04d}.npz" for z in range(self.number_of_slices)])
+        states = []
+        resumed = reconstructor.osem(5, 3, self.angles_sm, resume=checkpoint, on_iteration=states.append)
+        np.testing.assert_allclose(resumed, reconstructor.osem(5, 3, self.angles_sm))
+        self.assertEqual(sorted({state.iteration for state in states}), [2, 3, 4])
+
+        checkpoint = self.test_dir / "checkpoints_li"
+        reconstructor = line_integral_reconstructor(self.stack)
+        reconstructor.osem(1, 3, self.angles, checkpoint=checkpoint)
+        np.testing.assert_allclose(reconstructor.osem(3, 3, self.angles, checkpoint=checkpoint, resume=True),
+                                   reconstructor.osem(3, 3, self.angles))
+
+    def test_rotation_osem_random_order(self):
+        """Testa se a ordem aleatória do OSEM por rotação não depende dos workers e é retomada do checkpoint"""
+        reconstructor = rotation_reconstructor()
+        reconstructor.set_sinogram(self.stack)
+        sequential = reconstructor.osem(2, 3, bilinear_interpolation, self.angles, seed=7)
+        reconstructor.set_workers(2, backend="thread")
+        np.testing.assert_allclose(reconstructor.osem(2, 3, bilinear_interpolation, self.angles, seed=7), sequential)
+
+        checkpoint = self.test_dir / "checkpoints_rotation"
+        reconstructor.set_workers(1)
+        reconstructor.osem(1, 3, bilinear_interpolation, self.angles, seed=7, checkpoint=checkpoint)
+        resumed = reconstructor.osem(2, 3, bilinear_interpolation, self.angles, seed=7, checkpoint=checkpoint,
+                                     resume=True)
+        np.testing.assert_allclose(resumed, sequential)
+
+    def test_save_iterates(self):
+        """Testa a captura das estimativas de várias iterações em uma única execução"""
+        reconstructor = reconstructor_system_matrix_cpu(self.stack_sm)
+        rec, iterates = reconstructor.osem(4, 3, self.angles_sm, save_iterates=[1, 2, 4])
+        self.assertEqual(iterates.shape, (3, self.number_of_slices, self.pixels, self.pixels))
+        for snapshot, iterations in zip(iterates, [1, 2, 4]):
+            np.testing.assert_allclose(snapshot, reconstructor.osem(iterations, 3, self.angles_sm))
+        np.testing.assert_allclose(iterates[-1], rec)
+
+        batched = reconstructor.mlem(2, self.angles_sm, batched=True, save_iterates=[1, 2])[1]
+        np.testing.assert_allclose(batched[0], reconstructor.mlem(1, self.angles_sm))
+
+        import h5py
+        reconstructor = line_integral_reconstructor(self.stack, workers=2)
+        with h5py.File(self.test_dir / "iterates.h5", "w") as store:
+            dataset = store.create_dataset("osem", (2, self.number_of_slices, self.pixels, self.pixels))
+            reconstructor.osem(2, 3, self.angles, save_iterates=[1, 2], iterates=dataset)
+            np.testing.assert_allclose(dataset[0], reconstructor.osem(1, 3, self.angles))
+
+    def test_save_iterates_with_resume(self):
+        """Testa se as estimativas capturadas antes da interrupção são recuperadas ao retomar"""
+        checkpoint = self.test_dir / "checkpoints_iterates"
+        reconstructor = reconstructor_system_matrix_cpu(self.stack_sm)
+        expected = reconstructor.osem(4, 3, self.angles_sm, save_iterates=[1, 2, 4])[1]
+        reconstructor.osem(2, 3, self.angles_sm, checkpoint=checkpoint, save_iterates=[1, 2, 4])
+        iterates = reconstructor.osem(4, 3, self.angles_sm, resume=checkpoint, save_iterates=[1, 2, 4])[1]
+        np.testing.assert_allclose(iterates, expected)
+
+        # fatias já convergidas não rodam mais iterações, mas devolvem as estimativas salvas
+        checkpoint = self.test_dir / "checkpoints_converged"
+        converged = reconstructor.osem(4, 3, self.angles_sm, checkpoint=checkpoint, tol=np.inf, save_iterates=[1, 2])[1]
+        iterates = reconstructor.osem(4, 3, self.angles_sm, resume=checkpoint, save_iterates=[1, 2])[1]
+        np.testing.assert_allclose(iterates, converged)
+
+        iterates = reconstructor.osem(4, 3, self.angles_sm, max_time=0.0, save_iterates=[1, 2, 4])[1]
+        self.assertFalse(np.any(np.isnan(iterates[0])))
+        self.assertTrue(np.all(np.isnan(iterates[1:])))
+
+    def test_accelerated_osem(self):
+        """Testa se o EM com momento atinge uma verossimilhança maior no mesmo número de iterações"""
+        for reconstructor, angles in [(line_integral_reconstructor(self.stack[:1]), self.angles),
+                                      (reconstructor_system_matrix_cpu(self.stack_sm[:1]), self.angles_sm)]:
+            likelihood = {}
+            for momentum, relaxation in [("relaxed", 0.0), ("nesterov", 0.5), ("relaxed", 0.5)]:
+                states = []
+                rec = reconstructor.accelerated_osem(8, 1, angles, momentum=momentum, relaxation=relaxation,
+                                                     on_iteration=states.append)
+                self.assertTrue(np.all(rec > 0))
+                likelihood[(momentum, relaxation)] = states[-1].log_likelihood
+            self.assertGreater(likelihood[("nesterov", 0.5)], likelihood[("relaxed", 0.0)])
+            self.assertGreater(likelihood[("relaxed", 0.5)], likelihood[("relaxed", 0.0)])
+
+    def test_osl_map_em(self):
+        """Testa o MAP-EM one-step-late: sem prior é o OSEM, com prior converge em 2D e com acoplamento axial"""
+        reconstructor = reconstructor_system_matrix_cpu(self.stack_sm)
+        np.testing.assert_allclose(reconstructor.osl_map_em(3, 3, self.angles_sm, beta=0.0),
+                                   reconstructor.osem(3, 3, self.angles_sm), rtol=1e-6, atol=1e-6)
+        plan = reconstructor.get_plan(self.angles_sm, 3)
+        self.assertIs(plan.neighbourhood(3), plan.neighbourhood(3))
+        self.assertEqual(plan.neighbourhood(3)[0].shape, (26, 3))
+
+        for reconstructor, angles in [(line_integral_reconstructor(self.stack), self.angles),
+                                      (reconstructor_system_matrix_cpu(self.stack_sm), self.angles_sm)]:
+            slicewise = reconstructor.osl_map_em(15, 3, angles, prior="huber", beta=0.1)
+            for prior, beta in [("quadratic", 0.01), ("huber", 0.1), ("relative_difference", 0.1)]:
+                states = []
+                rec = reconstructor.osl_map_em(15, 3, angles, prior=prior, beta=beta, axial=True,
+                                               on_iteration=states.append)
+                self.assertEqual(rec.shape, (self.number_of_slices, self.pixels, self.pixels))
+                self.assertTrue(np.all(np.isfinite(rec)) and np.all(rec >= 0))
+                self.assertTrue(np.all(states[-1].relative_change < 0.01))
+            self.assertFalse(np.allclose(rec, slicewise))
+
+    def test_list_mode_osem(self):
+        """Testa o OSEM list-mode: par projetor/retroprojetor adjunto e eventos equivalentes ao sinograma pesado"""
+        rng = np.random.default_rng(0)
+        offsets = rng.uniform(-7, 7, 200)
+        angles = rng.uniform(0, 180, 200)
+        weights = rng.random(200)
+        projection = np.zeros(200)
+        project_events(self.image, offsets, angles, projection)
+        back = np.zeros_like(self.image)
+        backproject_events(back, offsets, angles, weights)
+        self.assertAlmostEqual(np.dot(projection, weights), np.sum(back * self.image))
+
+        # Um evento por bin, no centro do bin, reproduz o direct_radon
+        center = (self.pixels - 1) / 2
+        bins = np.tile(np.arange(self.pixels) - center, self.number_of_angles)
+        bin_angles = np.repeat(self.angles, self.pixels)
+        projection = np.zeros(bins.size)
+        project_events(self.image, bins, bin_angles, projection)
+        np.testing.assert_allclose(projection.reshape(self.number_of_angles, self.pixels).T, self.stack[0])
+
+        # Os bins com contagens como pesos equivalem à lista com os eventos repetidos
+        counts = rng.poisson(self.stack[0]).T.ravel()
+        binned = {'distance': bins, 'angle': bin_angles, 'slice': np.zeros(bins.size, int)}
+        listed = {key: np.repeat(value, counts) for key, value in binned.items()}
+        listed['slice'][:] = 1
+        expected = list_mode_reconstructor(binned, self.pixels, self.angles, weights=counts).mlem(5)[0]
+        reconstructor = list_mode_reconstructor(listed, self.pixels, self.angles)
+        self.assertEqual(reconstructor.slices, 2)
+        rec = reconstructor.mlem(5)
+        np.testing.assert_array_equal(rec[0], 0)
+        np.testing.assert_allclose(rec[1], expected, rtol=1e-6, atol=1e-9)
+
+        # Sem ruído, o MLEM list-mode converge para uma imagem consistente com o sinograma
+        rec = list_mode_reconstructor(binned, self.pixels, self.angles, weights=self.stack[0].T.ravel()).mlem(50)[0]
+        np.testing.assert_allclose(direct_radon(rec, self.angles), self.stack[0], atol=0.01 * self.stack[0].max())
+        self.assertGreater(np.corrcoef(rec.ravel(), self.image.ravel())[0, 1], 0.99)
+
+        # Com o fluxo de eventos em ordem temporal, poucas iterações de OSEM equivalem a muitas de MLEM
+        shuffled = rng.permutation(listed['angle'].size)
+        stream = {key: value[shuffled] for key, value in listed.items()}
+        reconstructor = list_mode_reconstructor(stream, self.pixels, self.angles)
+        osem = reconstructor.osem(3, 4)[1]
+        self.assertGreater(np.corrcoef(osem.ravel(), reconstructor.mlem(12)[1].ravel())[0, 1], 0.95)
+
+    def test_fully_3d_osem(self):
+        """Testa o sinograma oblíquo por diferença de anéis e a reconstrução 3D com todos os segmentos"""
+        oblique = ObliqueSinogram(4, self.pixels, self.number_of_angles, max_ring_difference=2)
+        oblique.fill([3, 3, 5, 7], [0, 0, 1, 2], [0, 0, 3, 0], [2, 2, 1, 3])
+        self.assertEqual(oblique.segment(2)[0, 3, 0], 2)
+        self.assertEqual(oblique.segment(-2)[1, 5, 1], 1)
+        self.assertEqual(oblique.total_counts(), 3)
+        self.assertEqual(oblique.segment(1).shape, (3, self.pixels, self.number_of_angles))
+
+        volume = np.asarray([self.image * k for k in (0.5, 1.0, 1.0, 0.5)])
+        oblique = ObliqueSinogram(4, self.pixels, self.number_of_angles)
+        reconstructor = fully_3d_reconstructor(oblique, 12.0)
+        for d, segment in reconstructor.forward_project(volume, self.angles).items():
+            oblique.segment(d)[...] = segment
+        rec = reconstructor.osem(10, 3, self.angles)
+        self.assertEqual(rec.shape, volume.shape)
+        self.assertGreater(np.corrcoef(rec.ravel(), volume.ravel())[0, 1], 0.99)
+
+        # Os segmentos oblíquos aumentam a sensibilidade em relação aos planos diretos
+        direct = ObliqueSinogram(4, self.pixels, self.number_of_angles, max_ring_difference=0)
+        plan = reconstructor.get_plan(self.angles)
+        self.assertGreater(reconstructor.subset_sensitivity(plan).sum(),
+                           2 * fully_3d_reconstructor(direct, 12.0).subset_sensitivity(plan).sum())
+        with self.assertRaises(ValueError):
+            fully_3d_reconstructor(oblique, 5.0)
+
+    def test_tv_gradient(self):
+        """Testa o gradiente compilado da TV contra diferenças finitas, em 2D e 3D"""
+        epsilon = 1e-3
+
+        def total_variation(volume, isotropic):
+            differences = [np.diff(volume, axis=axis, append=np.take(volume, [-1], axis=axis))
+                           for axis in range(volume.ndim)]
+            if isotropic:
+                return np.sum(np.sqrt(sum(d ** 2 for d in differences) + epsilon))
+            return np.sum([np.sum(np.sqrt(d ** 2 + epsilon) - np.sqrt(epsilon)) for d in differences])
+
+        rng = np.random.default_rng(0)
+        for volume in (rng.random((6, 7)), rng.random((3, 4, 5))):
+            for isotropic in (False, True):
+                numeric = np.zeros_like(volume)
+                for index in np.ndindex(volume.shape):
+                    step = np.zeros_like(volume)
+                    step[index] = 1e-6
+                    numeric[index] = (total_variation(volume + step, isotropic) -
+                                      total_variation(volume - step, isotropic)) / 2e-6
+                out = np.empty_like(volume)
+                gradient = tv_gradient(volume, epsilon, isotropic, out=out)
+                self.assertIs(gradient, out)
+                np.testing.assert_allclose(gradient, numeric, atol=1e-6)
+
+    def test_bsrem(self):
+        """Testa o BSREM: sem prior e sem relaxação é o OSEM, com prior converge para uma imagem positiva"""
+        reconstructor = reconstructor_system_matrix_cpu(self.stack_sm[:1])
+        osem = reconstructor.osem(3, 3, self.angles_sm)
+        rec = reconstructor.bsrem(3, 3, self.angles_sm, beta=0.0, relaxation_decay=0.0)
+        np.testing.assert_allclose(rec, osem, rtol=1e-6, atol=1e-6)
+
+        for reconstructor, angles in [(line_integral_reconstructor(self.stack[:1]), self.angles),
+                                      (reconstructor_system_matrix_cpu(self.stack_sm[:1]), self.angles_sm)]:
+            for prior in ("quadratic", "logcosh", "relative_difference"):
+                states = []
+                rec = reconstructor.bsrem(20, 3, angles, prior=prior, beta=0.5, on_iteration=states.append)
+                self.assertTrue(np.all(np.isfinite(rec)) and np.all(rec >= 0))
+                self.assertLess(states[-1].relative_change, 0.01)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -35,6 +35,7 @@ def GenerateSinogramFromPetsys(aqdName, BgName, e1_min, e1_max, e2_min, e2_max):
                                       "slice_1","chipID_1","chipID_2","rSinoAnger_1","angleSinoAnger_1"], library="pd")
 
     sinograms = []
+    backgrounds = []
     slices_unique = np.sort(data["slice_1"].unique())
 
     for slice_z in slices_unique:
@@ -52,24 +53,28 @@ def GenerateSinogramFromPetsys(aqdName, BgName, e1_min, e1_max, e2_min, e2_max):
 
         hist_bg = np.histogram2d(bgfiltered["rSino_1"], bgfiltered["angleSino_1"], bins=[n_distances, n_angles])[0]
         hist_fg = np.histogram2d(filtered["rSino_1"], filtered["angleSino_1"], bins=[n_distances, n_angles])[0]
-        result = hist_fg - hist_bg
-        sinograms.append(result)
+        # o background entra no modelo como termo aditivo (A x + r) em vez de ser subtraído
+        sinograms.append(hist_fg)
+        backgrounds.append(hist_bg)
 
-    return np.asarray(sinograms)
+    return np.asarray(sinograms), np.asarray(backgrounds)
 
 
 def reconstruct(path_acq, path_bg, method, algorithm, iterations, subsets,
                 e1_min, e1_max, e2_min, e2_max):
 
-    sino_3D = GenerateSinogramFromPetsys(path_acq, path_bg, e1_min, e1_max, e2_min, e2_max)
+    sino_3D, background = GenerateSinogramFromPetsys(path_acq, path_bg, e1_min, e1_max, e2_min, e2_max)
+    if algorithm == "fbp":
+        # a FBP não tem modelo de Poisson, o background é subtraído
+        sino_3D, background = sino_3D - background, None
     angles = np.linspace(0, 180, sino_3D.shape[2], endpoint=True)
 
     if method == "LineIntegral":
         reconstructor = line_integral_reconstructor(sino_3D)
         if algorithm == "mlem":
-            img = reconstructor.mlem(iterations * subsets, angles)
+            img = reconstructor.mlem(iterations * subsets, angles, additive=background)
         elif algorithm == "osem":
-            img = reconstructor.osem(iterations, subsets, angles)
+            img = reconstructor.osem(iterations, subsets, angles, additive=background)
         elif algorithm == "fbp":
             img = reconstructor.fbp(ramLak, angles)
         else:
@@ -79,9 +84,9 @@ def reconstruct(path_acq, path_bg, method, algorithm, iterations, subsets,
         reconstructor = rotation_reconstructor()
         reconstructor.set_sinogram(sino_3D)
         if algorithm == "mlem":
-            img = reconstructor.mlem(iterations * subsets, bilinear_interpolation, angles)
+            img = reconstructor.mlem(iterations * subsets, bilinear_interpolation, angles, additive=background)
         elif algorithm == "osem":
-            img = reconstructor.osem(iterations, subsets, bilinear_interpolation, angles)
+            img = reconstructor.osem(iterations, subsets, bilinear_interpolation, angles, additive=background)
         elif algorithm == "fbp":
             img = reconstructor.fbp(bilinear_interpolation, ramLak, angles)
         else:
@@ -89,11 +94,13 @@ def reconstruct(path_acq, path_bg, method, algorithm, iterations, subsets,
 
     elif method == "SystemMatrix":
         stack = np.transpose(sino_3D, (0, 2, 1))
+        if background is not None:
+            background = np.transpose(background, (0, 2, 1))
         reconstructor = reconstructor_system_matrix_cpu(stack)
         if algorithm == "mlem":
-            img = reconstructor.mlem(iterations * subsets, angles)
+            img = reconstructor.mlem(iterations * subsets, angles, additive=background)
         elif algorithm == "osem":
-            img = reconstructor.osem(iterations, subsets, angles)
+            img = reconstructor.osem(iterations, subsets, angles, additive=background)
         elif algorithm == "fbp":
             img = np.zeros_like(reconstructor.mlem(iterations * subsets, angles))  # FBP não implementado aqui
         else: